@@ -3,10 +3,20 @@ Audits an OSM file for errors
 
 Modified from the original audit.py module found in the case study quizzes
 """
-import xml.etree.cElementTree as ET
-from collections import defaultdict
+from __future__ import print_function
+
+from collections import namedtuple, OrderedDict
+import argparse
+import multiprocessing
+import os
 import re
 import pprint
+from expander import AbbreviationExpander
+import auditreport
+from auditreport import AuditReport, ReportCache
+import instrument
+import osmparse
+import rules
 
 OSMFILE = "napoli.osm"
 
@@ -19,60 +29,30 @@ street_type_re = re.compile(r'(^(?:IV\s+|V?I{0,3}\s+)?)(\w+)', re.IGNORECASE)
 roman_numeral_re = re.compile(r'\bIV\b|\bV?I{1,3}\b', re.IGNORECASE)
 # Finds all single letter abbreviations. Returns following word for context.
 over_abbr_re = re.compile(r'(\b\w\.\s*)+\w+')
-
-# List of expected street names in the dataset.
-expected = ["borgo",
-            "calata",
-            "circumvallazione",
-            "contrada",
-            "corso",
-            "cupa",
-            "discesa",
-            "domenico",
-            "galleria",
-            "gradoni",
-            "largo",
-            "molo",
-            "parco",
-            "pendio",
-            "piazza", "piazzale", "piazzetta",
-            "rampa", "rampe",
-            "riviera",
-            "salita",
-            "san",
-            "scale",
-            "strada", "stradone",
-            "supportico",
-            "traversa",
-            "via", "viale",
-            "vico", "vicolo", "vicoletto"]
-
-# Mapping of street names to be corrected
-st_name_mapping = {
-    'Prima': 'I',
-    'Seconda': 'II',
-    'viia': 'Via',
-    'Viia': 'Via'
-}
-
-# Mapping of abbreviations to full names
-abbreviations = {
-    "A. De": "Antonio De",
-    "A. S. Novaro": "Angelo Silvio Novaro",
-    "B. V. Romano": "Beato Vincenzo Romano",
-    "G. Di": "Gaspare Di",
-    "G. Marotta": "Giuseppe Marotta",
-    "G. Melisurgo": "Guglielmo Melisurgo",
-    "S. Angelo": "Sant'Angelo",
-    "S.Agnese": "Sant'Agnese",
-    "S.Ignazio": "Sant'Ignazio"
-}
-
-# Mapping of cuisine type corrections
-cuisine_types = {
-    "italian_pizza": "pizza",
-    "regional,_italian": "regional"
-}
+# Single pass street name tokenizer: the first alternative captures the optional Roman numeral
+# prefix and the street type at the start of the string, the second finds any other Roman numerals
+street_token_re = re.compile(r'^(?P<prefix>(?:IV\s+|V?I{0,3}\s+)?)(?P<type>\w+)|\bIV\b|\bV?I{1,3}\b',
+                             re.IGNORECASE)
+# Matches a word that is entirely a Roman numeral
+roman_word_re = re.compile(r'(?:IV|V?I{1,3})$', re.IGNORECASE)
+
+# Maximum number of distinct street names remembered by the normalizer
+STREET_CACHE_SIZE = 16384
+# Maximum number of phone numbers remembered by the parser. Numbers are mostly unique, so this
+# only needs to cover the audit and shaping of the same element in a single pass.
+PHONE_CACHE_SIZE = 1024
+
+# Ruleset used unless another one is loaded with use_ruleset
+RULESET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rulesets')
+DEFAULT_RULESET = os.path.join(RULESET_DIR, 'napoli.json')
+
+# The street types, name mappings, abbreviations and cuisine corrections below are those of the
+# active ruleset, bound by use_ruleset at the end of the module:
+#   expected: list of expected street types in the dataset
+#   st_name_mapping: mapping of street names to be corrected
+#   abbreviations: mapping of abbreviations to full names
+#   cuisine_types: mapping of cuisine type corrections
+ruleset = expected = st_name_mapping = abbreviations = cuisine_types = abbreviation_expander = None
 
 
 def audit_street_type(street_types, street_name):
@@ -135,28 +115,25 @@ def audit_phone_numbers(formats, number):
     :param number: phone number to validate
     :return: No return value, dictionary is modified in outer scope
     """
+    parsed = parse_number(number)
 
     # check formatting
-    if re.match(r'^\+39', number):  # starts with +39
+    if parsed.has_country_code:
         formats['has_country_code'] += 1
     else:
         formats['no_country_code'] += 1
-    if re.match(r'^(?:\+?39)?81', number):
+    if parsed.missing_prefix:
         formats['missing_prefix'] += 1
-    if re.search('-', number):  # has a dash
+    if parsed.has_dashes:
         formats['has_dashes'] += 1
-    if re.search(r'\s', number):  # contains any whitespace character
+    if parsed.has_spaces:
         formats['has_spaces'] += 1
 
-    # Strip number to count digits
-    digits_only = re.sub(r'[^\d]', '', number)
-    # remove country code to count remaining digits
-    digits_only = re.sub(r'^39', '', digits_only)
-    if not 6 <= len(digits_only) <= 11:
+    if parsed.normalized is None:
         formats['incorrect_length'].append(number)
 
     # catch all numbers with unexpected characters
-    if re.search(r'[^\+\d\s-]', number):
+    if parsed.bad_chars:
         formats['bad_chars'].append(number)
 
 
@@ -175,71 +152,215 @@ def is_phone(elem):
     return elem.attrib['k'] == 'phone'
 
 
-def audit(osmfile):
+def new_audit(examples=auditreport.EXAMPLES):
+    """Creates the empty report populated by audit_tag
+
+    :param examples: number of example values kept per accumulator
+    :return: empty AuditReport
     """
-    Audits
-    :param osmfile:
-    :return:
+    return AuditReport(examples)
+
+
+def audit_element(report, element):
+    """Audits the second level tags of a top level element
+
+    :param report: AuditReport created by new_audit
+    :param element: top level element
+    :return: No return value, the report is modified in outer scope
     """
-    street_types = defaultdict(set)
-    over_abbreviated = defaultdict(set)
-    cuisines = defaultdict(int)
-    phone_numbers = {'has_country_code': 0,
-                     'no_country_code': 0,
-                     'missing_prefix': 0,
-                     'has_dashes': 0,
-                     'has_spaces': 0,
-                     'incorrect_length': [],
-                     'bad_chars': [],
-                     }
+    for tag in element.iter('tag'):
+        audit_tag(report, tag)
 
-    tags = iterosm(osmfile)
-    for tag in tags:
-        if is_street_name(tag):
-            audit_street_type(street_types, tag.attrib['v'])
-            audit_abbr(over_abbreviated, tag.attrib['v'])
-        elif is_cuisine(tag):
-            audit_cuisines(cuisines, tag.attrib['v'])
-        elif is_phone(tag):
-            audit_phone_numbers(phone_numbers, tag.attrib['v'])
 
-    tags.close()
-    return street_types, over_abbreviated, cuisines, phone_numbers
+def audit_tag(report, tag):
+    """Dispatches a single second level tag to the rules of its key
+
+    :param report: AuditReport created by new_audit
+    :param tag: second level tag element to audit
+    :return: No return value, the report is modified in outer scope
+    """
+    key_rules = ruleset.audit_dispatch.get(tag.attrib['k'])
+    if key_rules is not None:
+        value = tag.attrib['v']
+        for rule in key_rules:
+            rule.audit(report, value)
+
 
+def fix_value(key, value):
+    """Applies the fixers of the rules of a tag key to a value
+
+    :param key: tag key, such as addr:street
+    :param value: raw tag value
+    :return: fixed value, None if the tag should be dropped
+    """
+    key_rules = ruleset.fix_dispatch.get(key)
+    if key_rules is not None:
+        for rule in key_rules:
+            value = rule.fix(value)
+            if value is None:
+                break
+    return value
+
+
+def audit(osmfile, backend=osmparse.DEFAULT_BACKEND, workers=1, cache_dir=None,
+          chunk_size=osmparse.CHUNK_SIZE, stats=None):
+    """
+    Audits the tags of an OSM file with the rules of the active ruleset
+    :param osmfile: name of the OpenStreetMap file to audit
+    :param backend: name of the osmparse parser backend
+    :param workers: number of worker processes, None for all cores
+    :param cache_dir: directory of saved reports, a saved report of an
+        unchanged file is returned without parsing it again
+    :param chunk_size: approximate size in bytes of the parallel chunks
+    :param stats: optional instrument.RunStats to collect the parse and audit
+        timings and throughput in, it is started and stopped by this function
+    :return: AuditReport
+    """
+    cache = ReportCache(cache_dir) if cache_dir else None
+    if cache is not None:
+        # reports made with other rules are not reused
+        variant = auditreport.file_digest(ruleset.filename)[:12] if ruleset.filename else None
+        report = cache.get(osmfile, variant)
+        if report is not None:
+            return report
+
+    if stats is not None:
+        stats.start()
+    if workers == 1:
+        report = new_audit()
+        source = osmfile if stats is None else instrument.CountingReader(osmfile, stats)
+        elements = iterelements(source, backend=backend)
+        audit_one = audit_element
+        if stats is not None:
+            elements = stats.timed_iter('parse', elements)
+            audit_one = stats.timed('audit', audit_element)
+        for element in elements:
+            audit_one(report, element)
+        if stats is not None:
+            source.close()
+    else:
+        report = audit_parallel(osmfile, workers, backend, chunk_size)
+        if stats is not None:
+            # only the totals are known for the workers
+            stats.bytes = stats.total_bytes = os.path.getsize(osmfile)
+            stats.extra['workers'] = workers
+    if stats is not None:
+        stats.stop()
+        stats.extra['rules'] = ruleset.stats()
+        stats.extra['phone_cache'] = phone_parser.cache_info()
+
+    if cache is not None:
+        cache.put(osmfile, report, variant)
+    return report
+
+
+def _audit_chunk(args):
+    """Worker entry point: audits one byte range of an OSM file
+
+    :param args: tuple of osmfile, start, end, backend and ruleset file
+    :return: AuditReport of the range
+    """
+    osmfile, start, end, backend, ruleset_file = args
+    use_ruleset_file(ruleset_file)
+    report = new_audit()
+    chunk = osmparse.ChunkFile(osmfile, start, end)
+    try:
+        for element in iterelements(chunk, backend=backend):
+            audit_element(report, element)
+    finally:
+        chunk.close()
+    return report
+
+
+def audit_parallel(osmfile, workers=None, backend=osmparse.DEFAULT_BACKEND,
+                   chunk_size=osmparse.CHUNK_SIZE):
+    """Audits the chunks of an OSM file in a pool of worker processes
+
+    :param osmfile: name of the OpenStreetMap file to audit
+    :param workers: number of worker processes, defaults to the CPU count
+    :param backend: name of the osmparse parser backend
+    :param chunk_size: approximate size in bytes of each chunk
+    :return: AuditReport merged from the reports of all chunks
+    """
+    jobs = [(osmfile, start, end, backend, ruleset.filename)
+            for start, end in osmparse.chunk_offsets(osmfile, chunk_size)]
+    report = new_audit()
+    pool = multiprocessing.Pool(workers)
+    try:
+        for chunk_report in pool.imap_unordered(_audit_chunk, jobs):
+            report.merge(chunk_report)
+    finally:
+        pool.close()
+        pool.join()
+    return report
+
+
+def iterelements(osmfile, tag_types=osmparse.TOP_LEVEL, backend=osmparse.DEFAULT_BACKEND):
+    """Creates a generator to yield complete top level elements
+
+    Memory is bounded by the size of a single element instead of growing
+    with the file, see osmparse.iterelements.
+    :param osmfile: name or file object of the OpenStreetMap file to iterate
+    :param tag_types: type of top level elements to yield
+    :param backend: name of the osmparse parser backend
+    :return: yields a top level element
+    """
+    return osmparse.iterelements(osmfile, tag_types, backend)
 
-def iterosm(osmfile, tag_types=('node', 'way')):
+
+def iterosm(osmfile, tag_types=osmparse.TOP_LEVEL, backend=osmparse.DEFAULT_BACKEND):
     """Creates a generator to yield tag values
 
     :param osmfile: name of the OpenStreetMap file to iterate
     :param tag_types: type of element tags to iterate
+    :param backend: name of the osmparse parser backend
     :return: yields a tag value
     """
-    with open(osmfile, 'r') as osm_file:
-        for event, elem in ET.iterparse(osm_file, events=('start',)):
-            if elem.tag in tag_types:
-                for tag in elem.iter('tag'):
-                    yield tag
+    for elem in iterelements(osmfile, tag_types, backend):
+        for tag in elem.iter('tag'):
+            yield tag
 
 
-def update_street_name(name):
-    # Convert lowercase street names to title case
-    if name.islower():
-        name = name.title()
+def _upper(match):
+    return match.group().upper()
 
-    # Find Roman Numerals and make sure they are capitalized
-    name = roman_numeral_re.sub(lambda x: str.upper(x.group()), name)
 
-    # retrieve the street type
-    m = street_type_re.search(name)
-    street_type = m.group(2)
+def _fix_street_token(match):
+    """Replacement function for street_token_re
+
+    Capitalizes Roman numerals and corrects the street type in the same pass
+    """
+    street_type = match.group('type')
+    if street_type is None:
+        # A Roman numeral later in the name
+        return match.group().upper()
+
+    prefix = match.group('prefix')
+    if prefix:
+        prefix = roman_numeral_re.sub(_upper, prefix)
+
+    if roman_word_re.match(street_type):
+        street_type = street_type.upper()
     if street_type in st_name_mapping:
-        replacement = r'\1' + st_name_mapping[street_type]
-        name = street_type_re.sub(replacement, name)
+        street_type = st_name_mapping[street_type]
     elif street_type.islower():
-        replacement = r'\1' + street_type.capitalize()
-        name = street_type_re.sub(replacement, name)
+        street_type = street_type.capitalize()
 
-    return name
+    return prefix + street_type
+
+
+def update_street_name(name):
+    """Fixes the capitalization and street type of a street name
+
+    :param name: street name to fix
+    :return: corrected street name
+    """
+    # Convert lowercase street names to title case
+    if name.islower():
+        name = name.title()
+
+    # Capitalize Roman Numerals and map the street type in a single scan
+    return street_token_re.sub(_fix_street_token, name)
 
 
 def update_short_name(name):
@@ -251,13 +372,213 @@ def update_short_name(name):
     # First verify that the common errors have been fixed
     name = update_street_name(name)
 
-    # Find the abbreviation to replace
-    m = over_abbr_re.search(name)
-    if m:
-        if m.group() in abbreviations:
-            name = over_abbr_re.sub(abbreviations[m.group()], name)
+    # Replace every known abbreviation in a single scan
+    return abbreviation_expander.expand(name)
 
-    return name
+
+def load_ruleset(filename):
+    """Reads and compiles a ruleset file
+
+    :param filename: name of a JSON or YAML ruleset, see rules.py
+    :return: compiled rules.Ruleset
+    """
+    return rules.Ruleset.from_file(filename).compile()
+
+
+def use_ruleset(new_ruleset):
+    """Makes a compiled ruleset the one used to audit and fix tags
+
+    :param new_ruleset: rules.Ruleset returned by load_ruleset
+    :return: No return value, the module level tables are rebound
+    """
+    global ruleset, expected, st_name_mapping, abbreviations, cuisine_types, abbreviation_expander
+    ruleset = new_ruleset
+    expected = new_ruleset.street_types
+    st_name_mapping = new_ruleset.street_name_mapping
+    abbreviations = new_ruleset.abbreviations
+    cuisine_types = new_ruleset.cuisine_types
+    abbreviation_expander = AbbreviationExpander(abbreviations)
+    phone_parser.country_code = new_ruleset.country_code
+    phone_parser.area_code = new_ruleset.area_code
+    # cached results were computed with the previous tables
+    street_normalizer.cache.clear()
+    phone_parser.cache.clear()
+
+
+def use_ruleset_file(filename):
+    """Loads a ruleset file unless it is already the active ruleset"""
+    if filename is not None and (ruleset is None or ruleset.filename != filename):
+        use_ruleset(load_ruleset(filename))
+
+
+def load_abbreviations(filename):
+    """Adds the abbreviations from a JSON or tab separated file to the table
+
+    :param filename: name of the file to load, see AbbreviationExpander.read_table
+    :return: No return value, the module level expander is updated
+    """
+    abbreviations.update(AbbreviationExpander.read_table(filename))
+    abbreviation_expander.update(abbreviations)
+    # cached names may expand differently with the new table
+    street_normalizer.cache.clear()
+
+
+class LRUCache(object):
+    """Bounded least recently used cache that keeps hit and miss statistics"""
+
+    _missing = object()
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        value = self._data.pop(key, self._missing)
+        if value is self._missing:
+            self.misses += 1
+            return default
+        # re-insert to mark as most recently used
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = self.misses = 0
+
+    def info(self):
+        """Returns the cache statistics as a dictionary"""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'maxsize': self.maxsize}
+
+
+class StreetNameNormalizer(object):
+    """Memoizes street name corrections per distinct raw name
+
+    A city has only a few thousand distinct street names repeated across
+    many addresses, so caching the result makes the cleanup cost scale with
+    the number of distinct names instead of the number of tags.
+    """
+
+    def __init__(self, maxsize=STREET_CACHE_SIZE):
+        self.cache = LRUCache(maxsize)
+
+    def normalize(self, name):
+        """Expands abbreviations and fixes the street type of a street name
+
+        :param name: raw addr:street value
+        :return: corrected street name
+        """
+        result = self.cache.get(name, LRUCache._missing)
+        if result is LRUCache._missing:
+            result = update_short_name(name)
+            self.cache.put(name, result)
+        return result
+
+    def cache_info(self):
+        return self.cache.info()
+
+
+street_normalizer = StreetNameNormalizer()
+normalize_street_name = street_normalizer.normalize
+
+
+# Result of parsing a phone number: the audit flags and the normalized number,
+# which is None when the number has an incorrect length
+PhoneNumber = namedtuple('PhoneNumber', ['has_country_code', 'missing_prefix', 'has_dashes',
+                                         'has_spaces', 'bad_chars', 'normalized'])
+
+DIGITS = frozenset('0123456789')
+
+
+class PhoneNumberParser(object):
+    """Audits and normalizes phone numbers in a single pass over the characters
+
+    Results are cached so a number that is audited and then shaped in the
+    same pass is only parsed once.
+    """
+
+    def __init__(self, country_code='39', area_code='81', maxsize=PHONE_CACHE_SIZE):
+        self.country_code = country_code
+        self.area_code = area_code
+        self.cache = LRUCache(maxsize)
+
+    def parse(self, number):
+        """Parses a raw phone number
+
+        :param number: phone number to parse
+        :return: PhoneNumber with the audit flags and normalized number
+        """
+        parsed = self.cache.get(number)
+        if parsed is None:
+            parsed = self._parse(number)
+            self.cache.put(number, parsed)
+        return parsed
+
+    def parse_many(self, numbers):
+        """Parses an iterable of raw phone numbers
+
+        :param numbers: iterable of phone numbers
+        :return: list of PhoneNumber results in the same order
+        """
+        return [self.parse(number) for number in numbers]
+
+    def cache_info(self):
+        return self.cache.info()
+
+    def _parse(self, number):
+        country_code = self.country_code
+        digits = []
+        has_dashes = has_spaces = bad_chars = False
+        for char in number:
+            if char in DIGITS:
+                digits.append(char)
+            elif char == '-':
+                has_dashes = True
+            elif char.isspace():
+                has_spaces = True
+            elif char != '+':
+                bad_chars = True
+        digits = ''.join(digits)
+
+        # check for the country code and the local area code behind it
+        has_country_code = number.startswith('+' + country_code)
+        if has_country_code:
+            local = number[len(country_code) + 1:]
+        elif number.startswith(country_code):
+            local = number[len(country_code):]
+        else:
+            local = number
+        missing_prefix = local.startswith(self.area_code)
+
+        # remove country code for length checking
+        if digits.startswith(country_code):
+            digits = digits[len(country_code):]
+
+        normalized = None
+        if 6 <= len(digits) <= 11:
+            # Verify landlines include a 0 prefix.
+            # A land line is any number not starting with a 3.
+            if digits[0] not in '03':
+                digits = '0' + digits
+            normalized = '+' + country_code + digits
+
+        return PhoneNumber(has_country_code, missing_prefix, has_dashes,
+                           has_spaces, bad_chars, normalized)
+
+
+phone_parser = PhoneNumberParser()
+parse_number = phone_parser.parse
+parse_numbers = phone_parser.parse_many
 
 
 def update_cuisine(cuisine_type):
@@ -266,61 +587,84 @@ def update_cuisine(cuisine_type):
     :param cuisine_type: type to fix
     :return: corrected cuisine type
     """
-    if cuisine_type in cuisine_types.iterkeys():
-        return cuisine_types[cuisine_type]
-    else:
-        return cuisine_type
+    return cuisine_types.get(cuisine_type, cuisine_type)
 
 
 def update_number(number):
     """
     Corrects number formatting
     :param number: phone number to reformat
-    :return: phone number in +<country code><number> format
+    :return: phone number in +<country code><number> format, None if the
+        number has an incorrect length
     """
-    # remove non-numeric characters
-    number = re.sub(r'[^\d]', '', number)
+    return parse_number(number).normalized
+
+
+@rules.auditor('street_type')
+def _street_type_auditor(options, ruleset):
+    return lambda report, value: audit_street_type(report.street_types, value)
+
+
+@rules.auditor('abbreviation')
+def _abbreviation_auditor(options, ruleset):
+    return lambda report, value: audit_abbr(report.over_abbreviated, value)
+
+
+@rules.auditor('cuisine')
+def _cuisine_auditor(options, ruleset):
+    return lambda report, value: audit_cuisines(report.cuisines, value)
 
-    # remove country code for length checking
-    number = re.sub(r'^39', '', number)
 
-    # Return None if the number is in the incorrect format
-    if not 6 <= len(number) <= 11:
-        return None
+@rules.auditor('phone')
+def _phone_auditor(options, ruleset):
+    return lambda report, value: audit_phone_numbers(report.phone_numbers, value)
 
-    # Verify landlines include a 0 prefix.
-    # A land line is any number not starting with a 3.
-    number = re.sub(r'^([^03]\d+)', r'0\1', number)
 
-    # Insert country code
-    number = "+39" + number
+@rules.fixer('street_name')
+def _street_name_fixer(options, ruleset):
+    return lambda value: normalize_street_name(value)
 
-    return number
 
+@rules.fixer('cuisine')
+def _cuisine_fixer(options, ruleset):
+    """Splits the semicolon separated cuisine types into a corrected list"""
+    return lambda value: [update_cuisine(cuisine_type) for cuisine_type in value.split(';')]
 
-def test():
-    st_types, over_abbr, cuisines, phone_formats = audit(OSMFILE)
+
+@rules.fixer('phone')
+def _phone_fixer(options, ruleset):
+    return lambda value: update_number(value)
+
+
+use_ruleset(load_ruleset(DEFAULT_RULESET))
+
+
+def test(osmfile=OSMFILE, workers=1, cache_dir=None, ruleset_file=None, stats=None):
+    use_ruleset_file(ruleset_file)
+    report = audit(osmfile, workers=workers, cache_dir=cache_dir, stats=stats)
+    st_types, over_abbr, cuisines, phone_formats = report.as_tuple()
     pprint.pprint(dict(st_types))
     pprint.pprint(dict(over_abbr))
     pprint.pprint(dict(cuisines))
     pprint.pprint(phone_formats)
+    pprint.pprint(report.summary())
 
-    for ways in st_types.itervalues():
+    for ways in st_types.values():
         for name in ways:
             better_name = update_street_name(name)
-            print name, "=>", better_name
-    for abbreviated in over_abbr.itervalues():
+            print(name, "=>", better_name)
+    for abbreviated in over_abbr.values():
         for short_name in abbreviated:
             full_name = update_short_name(short_name)
-            print short_name, "=>", full_name
-    for cuisine_type in cuisines.iterkeys():
+            print(short_name, "=>", full_name)
+    for cuisine_type in cuisines:
         better_cuisine_type = update_cuisine(cuisine_type)
         if cuisine_type != better_cuisine_type:
-            print cuisine_type, "=>", better_cuisine_type
+            print(cuisine_type, "=>", better_cuisine_type)
 
     # create a list of sample updated numbers
     sample_numbers = {}
-    tags = iterosm(OSMFILE)
+    tags = iterosm(osmfile)
     while len(sample_numbers) < 10:
         tag = next(tags)
         if is_phone(tag):
@@ -328,9 +672,26 @@ def test():
             sample_numbers[number] = update_number(number)
     else:
         tags.close()
-    for old, new in sample_numbers.iteritems():
-        print old, "=>", new
+    for old, new in sample_numbers.items():
+        print(old, "=>", new)
+
+    for stats in ruleset.stats():
+        print("{name}: {audited} values audited in {audit_seconds:.3f}s".format(**stats))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Audit an OSM file")
+    parser.add_argument('osmfile', nargs='?', default=OSMFILE)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes, 0 for all cores")
+    parser.add_argument('--cache-dir', help="directory of saved audit reports")
+    parser.add_argument('--rules', default=DEFAULT_RULESET, help="JSON or YAML ruleset file")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    stats = instrument.from_arguments('audit', args)
+    test(args.osmfile, args.workers or None, args.cache_dir, args.rules, stats)
+    instrument.report(stats, args)
 
 
 if __name__ == '__main__':
-    test()
+    main()
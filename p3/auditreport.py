@@ -0,0 +1,285 @@
+"""
+Mergeable audit results
+
+An AuditReport is made of accumulators that can be combined: counters,
+example sets capped to a fixed size and HyperLogLog distinct counts. Reports
+built by parallel workers on parts of a file are merged into one, and a
+report can be saved to disk and loaded again keyed on the hash and
+modification time of the audited file, so auditing an unchanged file a
+second time returns immediately.
+"""
+import base64
+import functools
+import hashlib
+import json
+import math
+import os
+import struct
+from collections import Counter, defaultdict
+
+# Number of example values kept per accumulator
+EXAMPLES = 50
+
+# Counted phone number formats, see audit.audit_phone_numbers
+PHONE_FORMATS = ['has_country_code', 'no_country_code', 'missing_prefix', 'has_dashes', 'has_spaces']
+# Phone number formats kept as examples
+PHONE_EXAMPLES = ['incorrect_length', 'bad_chars']
+
+
+class CappedSet(object):
+    """Set that keeps at most capacity examples but counts every addition
+
+    When merged, the smallest examples are kept so the result does not
+    depend on the order in which reports are combined.
+    """
+    __slots__ = ('capacity', 'items', 'total')
+
+    def __init__(self, capacity=EXAMPLES, items=(), total=0):
+        self.capacity = capacity
+        self.items = set(items)
+        self.total = total
+
+    def add(self, item):
+        self.total += 1
+        if item not in self.items:
+            if len(self.items) < self.capacity:
+                self.items.add(item)
+            elif item < max(self.items):
+                # keep the smallest examples, matching merge()
+                self.items.remove(max(self.items))
+                self.items.add(item)
+
+    # the phone number audit appends to lists
+    append = add
+
+    def merge(self, other):
+        self.total += other.total
+        self.items = set(sorted(self.items | other.items)[:self.capacity])
+        return self
+
+    def __iter__(self):
+        return iter(sorted(self.items))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __repr__(self):
+        return "CappedSet({0!r}, total={1})".format(sorted(self.items), self.total)
+
+    def to_dict(self):
+        return {'items': sorted(self.items), 'total': self.total}
+
+    @classmethod
+    def from_dict(cls, d, capacity=EXAMPLES):
+        return cls(capacity, d['items'], d['total'])
+
+
+class HyperLogLog(object):
+    """HyperLogLog estimate of the number of distinct values
+
+    Uses 2 ** precision one byte registers, so the default precision of 12
+    takes 4 KB and has a standard error of about 1.6%.
+    """
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(2 ** precision)
+
+    def add(self, value):
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        x, = struct.unpack('<Q', hashlib.md5(value).digest()[:8])
+        index = x & ((1 << self.precision) - 1)
+        w = x >> self.precision
+        # position of the leftmost 1 bit in the remaining 64 - precision bits
+        rank = 64 - self.precision - w.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLogs of different precision")
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # small range correction
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def to_dict(self):
+        return {'precision': self.precision,
+                'registers': base64.b64encode(bytes(self.registers)).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['precision'], base64.b64decode(d['registers']))
+
+
+class AuditReport(object):
+    """Results of auditing an OSM file
+
+    Attributes:
+        street_types: unexpected street type -> CappedSet of street names
+        over_abbreviated: abbreviation -> CappedSet of street names
+        cuisines: Counter of cuisine types
+        phone_numbers: counts of each format in PHONE_FORMATS and a
+            CappedSet of examples for each format in PHONE_EXAMPLES
+        distinct: HyperLogLog distinct counts of the raw street names,
+            phone numbers and cuisine values
+        findings: rule name -> CappedSet of the values flagged by the
+            generic auditors of a ruleset, see rules.py
+    """
+
+    def __init__(self, examples=EXAMPLES):
+        self.examples = examples
+        factory = functools.partial(CappedSet, examples)
+        self.street_types = defaultdict(factory)
+        self.over_abbreviated = defaultdict(factory)
+        self.cuisines = Counter()
+        self.phone_numbers = dict.fromkeys(PHONE_FORMATS, 0)
+        self.phone_numbers.update((name, CappedSet(examples)) for name in PHONE_EXAMPLES)
+        self.distinct = {'street': HyperLogLog(), 'phone': HyperLogLog(), 'cuisine': HyperLogLog()}
+        self.findings = defaultdict(factory)
+
+    def merge(self, other):
+        """Adds the results of another report to this one
+
+        :param other: AuditReport to merge
+        :return: this report
+        """
+        for mine, theirs in ((self.street_types, other.street_types),
+                             (self.over_abbreviated, other.over_abbreviated),
+                             (self.findings, other.findings)):
+            for key, examples in theirs.items():
+                mine[key].merge(examples)
+        self.cuisines.update(other.cuisines)
+        for name in PHONE_FORMATS:
+            self.phone_numbers[name] += other.phone_numbers[name]
+        for name in PHONE_EXAMPLES:
+            self.phone_numbers[name].merge(other.phone_numbers[name])
+        for name, hll in other.distinct.items():
+            self.distinct.setdefault(name, HyperLogLog(hll.precision)).merge(hll)
+        return self
+
+    def as_tuple(self):
+        """Returns the street_types, over_abbreviated, cuisines and
+        phone_numbers accumulators in the order audit() used to return them"""
+        return self.street_types, self.over_abbreviated, self.cuisines, self.phone_numbers
+
+    def summary(self):
+        """Returns the headline numbers of the report"""
+        return {'unexpected_street_types': len(self.street_types),
+                'abbreviations': len(self.over_abbreviated),
+                'cuisine_types': len(self.cuisines),
+                'phone_numbers': dict((name, self.phone_numbers[name]) for name in PHONE_FORMATS),
+                'incorrect_length': self.phone_numbers['incorrect_length'].total,
+                'bad_chars': self.phone_numbers['bad_chars'].total,
+                'distinct': dict((name, hll.count()) for name, hll in self.distinct.items()),
+                'findings': dict((name, examples.total) for name, examples in self.findings.items())}
+
+    def to_dict(self):
+        phone_numbers = dict((name, self.phone_numbers[name]) for name in PHONE_FORMATS)
+        phone_numbers.update((name, self.phone_numbers[name].to_dict()) for name in PHONE_EXAMPLES)
+        return {'examples': self.examples,
+                'street_types': dict((k, v.to_dict()) for k, v in self.street_types.items()),
+                'over_abbreviated': dict((k, v.to_dict()) for k, v in self.over_abbreviated.items()),
+                'cuisines': dict(self.cuisines),
+                'phone_numbers': phone_numbers,
+                'distinct': dict((k, v.to_dict()) for k, v in self.distinct.items()),
+                'findings': dict((k, v.to_dict()) for k, v in self.findings.items())}
+
+    @classmethod
+    def from_dict(cls, d):
+        report = cls(d['examples'])
+        for name in ('street_types', 'over_abbreviated', 'findings'):
+            accumulator = getattr(report, name)
+            # reports saved before rulesets had no findings
+            for key, examples in d.get(name, {}).items():
+                accumulator[key] = CappedSet.from_dict(examples, report.examples)
+        report.cuisines.update(d['cuisines'])
+        for name in PHONE_FORMATS:
+            report.phone_numbers[name] = d['phone_numbers'][name]
+        for name in PHONE_EXAMPLES:
+            report.phone_numbers[name] = CappedSet.from_dict(d['phone_numbers'][name], report.examples)
+        report.distinct = dict((k, HyperLogLog.from_dict(v)) for k, v in d['distinct'].items())
+        return report
+
+    def save(self, filename):
+        with open(filename, 'w') as fo:
+            json.dump(self.to_dict(), fo)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'r') as fi:
+            return cls.from_dict(json.load(fi))
+
+
+def file_digest(filename, block_size=1024 * 1024):
+    """Returns the SHA-1 hex digest of a file"""
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fi:
+        for block in iter(lambda: fi.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class ReportCache(object):
+    """Directory of saved AuditReports keyed on file hash and mtime
+
+    Hashing a large file still takes a full read, so the digest of each path
+    is remembered together with its size and mtime and reused while those
+    are unchanged.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._index_file = os.path.join(directory, 'index.json')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _read_index(self):
+        if os.path.exists(self._index_file):
+            with open(self._index_file, 'r') as fi:
+                return json.load(fi)
+        return {}
+
+    def key(self, filename, variant=None):
+        """Returns the cache key of a file, hashing it only if it changed
+
+        :param filename: name of the audited file
+        :param variant: optional string identifying the audit settings, such
+            as the digest of the ruleset, reports of other variants are not
+            returned
+        """
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        index = self._read_index()
+        entry = index.get(path)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': file_digest(path)}
+            index[path] = entry
+            with open(self._index_file, 'w') as fo:
+                json.dump(index, fo)
+        key = "{0}-{1}".format(entry['sha1'], int(entry['mtime']))
+        return key + '-' + variant if variant else key
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, filename, variant=None):
+        """Returns the cached report of a file, or None"""
+        path = self._path(self.key(filename, variant))
+        return AuditReport.load(path) if os.path.exists(path) else None
+
+    def put(self, filename, report, variant=None):
+        report.save(self._path(self.key(filename, variant)))
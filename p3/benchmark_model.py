@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the memory and speed of the shaped element model
+
+The elements of a generated OSM file are parsed once and then shaped in
+four ways: into the compact model elements that flow through process_map,
+into the same elements turned into documents by to_dict() as a batching
+sink does, into the documents data.shape_document builds directly, and
+into the nested dictionaries data.shape_element built before the model
+existed (shape_legacy below). The shaped elements are held in memory, as a
+ParquetSink row group or a MongoSink batch holds them, and tracemalloc
+measures the bytes and allocated blocks per element. The shaping time is
+measured without tracing.
+
+The model row is what the batched Parquet and MongoDB sinks hold. The
+to_dict row builds both the element and its document, which is why the
+JSON lines path uses shape_document instead: the document row, which
+should be on par with the legacy dictionaries.
+
+Usage:
+    python benchmark_model.py --nodes 200000 --ways 20000 --relations 2000
+"""
+import argparse
+import gc
+import os
+import tempfile
+import time
+
+import audit
+import data
+import osmgen
+import osmparse
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def shape_legacy(element):
+    """The dictionary shaping of data.shape_element before the model"""
+    node = {'type': element.tag}
+    node.update(element.attrib)
+    node['created'] = dict((k, node.pop(k)) for k in data.CREATED)
+    if 'lat' in node and 'lon' in node:
+        node['pos'] = [float(node.pop('lon')), float(node.pop('lat'))]
+    fixers = audit.ruleset.fix_dispatch
+    for tag in element.findall('tag'):
+        k, v = tag.attrib['k'], tag.attrib['v']
+        if k in fixers:
+            v = audit.fix_value(k, v)
+            if v is None:
+                continue
+        if k in node:
+            k = 'tag_' + k
+        if data.problemchars.search(k):
+            continue
+        if "addr:" in k:
+            if 'address' not in node:
+                node['address'] = {}
+            _, k = k.split(':', 1)
+            node['address'][k.replace(':', '_')] = v
+        else:
+            node[k.replace(':', '_')] = v
+    if element.tag == "way":
+        node['node_refs'] = [nd.attrib['ref'] for nd in element.findall('nd')]
+    if element.tag == "relation":
+        node['members'] = [{'type': member.attrib['type'], 'ref': member.attrib['ref'],
+                            'role': member.attrib.get('role', '')}
+                           for member in element.findall('member')]
+    return node
+
+
+def shape_model(elements):
+    return [data.shape_element(element) for element in elements]
+
+
+def shape_documents(elements):
+    return [data.shape_element(element).to_dict() for element in elements]
+
+
+def shape_direct(elements):
+    return [data.shape_document(element) for element in elements]
+
+
+def shape_dicts(elements):
+    return [shape_legacy(element) for element in elements]
+
+
+MODES = [('model', shape_model), ('to_dict', shape_documents), ('document', shape_direct),
+         ('legacy', shape_dicts)]
+
+
+def measure(shape, elements):
+    """Shapes the elements and holds the results
+
+    :return: dictionary of the bytes and blocks allocated per element and
+        the shaping time per element in microseconds
+    """
+    gc.collect()
+    start = time.time()
+    shaped = shape(elements)
+    seconds = time.time() - start
+    del shaped
+    gc.collect()
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    shaped = shape(elements)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    size = sum(stat.size_diff for stat in stats)
+    blocks = sum(stat.count_diff for stat in stats)
+    count = len(shaped)
+    return {'elements': count,
+            'bytes_per_element': size / float(count),
+            'blocks_per_element': blocks / float(count),
+            'usec_per_element': seconds * 1e6 / count}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the shaped element model")
+    parser.add_argument('--nodes', type=int, default=100000)
+    parser.add_argument('--ways', type=int, default=10000)
+    parser.add_argument('--relations', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0, help="seed of the generated file")
+    parser.add_argument('--osmfile', help="benchmark an existing file instead of generating one")
+    args = parser.parse_args()
+    if tracemalloc is None:
+        parser.error("measuring allocations requires Python 3")
+
+    filename = args.osmfile
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix='.osm')
+        os.close(fd)
+        osmgen.write_osm(filename, args.nodes, args.ways, seed=args.seed,
+                         relations=args.relations)
+    try:
+        elements = list(osmparse.iterelements(filename, backend='expat'))
+    finally:
+        if args.osmfile is None:
+            os.remove(filename)
+
+    print("{0} elements".format(len(elements)))
+    print("{0:<8}{1:>16}{2:>16}{3:>16}".format('shape', 'bytes/element', 'blocks/element',
+                                               'usec/element'))
+    results = {}
+    for name, shape in MODES:
+        results[name] = result = measure(shape, elements)
+        print("{0:<8}{bytes_per_element:>16.0f}{blocks_per_element:>16.1f}"
+              "{usec_per_element:>16.2f}".format(name, **result))
+    print("model uses {0:.0%} of the memory and {1:.0%} of the blocks of the legacy "
+          "dictionaries".format(
+              results['model']['bytes_per_element'] / results['legacy']['bytes_per_element'],
+              results['model']['blocks_per_element'] / results['legacy']['blocks_per_element']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the osmparse backends on a generated OSM file
+
+The input is written by osmgen unless an existing file is given. Each
+backend runs in its own subprocess so that the peak resident set size
+reported for it is not affected by the other backends. Results are printed as
+a table of elements/sec and peak RSS.
+
+Usage:
+    python benchmark_parsers.py --nodes 500000 --ways 50000
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import osmgen
+import osmparse
+from instrument import peak_rss_mb
+
+
+def run_backend(backend, filename):
+    """Iterates all elements of a file with one backend
+
+    :return: dictionary of the element count, elapsed time and peak RSS
+    """
+    start = time.time()
+    count = 0
+    for element in osmparse.iterelements(filename, ('node', 'way', 'relation'), backend):
+        # touch the tags the way the audit does
+        for tag in element.iter('tag'):
+            tag.attrib['k']
+        count += 1
+    elapsed = time.time() - start
+    return {'backend': backend,
+            'elements': count,
+            'seconds': elapsed,
+            'elements_per_sec': count / elapsed if elapsed else 0.0,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the osmparse backends")
+    parser.add_argument('--nodes', type=int, default=200000)
+    parser.add_argument('--ways', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0, help="seed of the generated file")
+    parser.add_argument('--osmfile', help="benchmark an existing file instead of generating one")
+    parser.add_argument('--backends', nargs='+', default=sorted(osmparse.BACKENDS))
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        # Child process: benchmark a single backend and report as JSON
+        print(json.dumps(run_backend(args.run, args.osmfile)))
+        return
+
+    filename = args.osmfile
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix='.osm')
+        os.close(fd)
+        osmgen.write_osm(filename, args.nodes, args.ways, seed=args.seed)
+    try:
+        size_mb = os.path.getsize(filename) / 2.0 ** 20
+        print("{0}: {1:.1f} MB".format(filename, size_mb))
+        print("{0:<8}{1:>12}{2:>10}{3:>14}{4:>14}".format(
+            'backend', 'elements', 'seconds', 'elements/sec', 'peak RSS MB'))
+        for backend in args.backends:
+            proc = subprocess.Popen([sys.executable, __file__, '--run', backend, '--osmfile', filename],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = proc.communicate()
+            if proc.returncode:
+                print("{0:<8} failed: {1}".format(backend, err.decode('utf-8').strip().splitlines()[-1]))
+                continue
+            result = json.loads(out.decode('utf-8'))
+            print("{backend:<8}{elements:>12d}{seconds:>10.2f}{elements_per_sec:>14.0f}"
+                  "{peak_rss_mb:>14.1f}".format(**result))
+    finally:
+        if args.osmfile is None:
+            os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks spatialindex queries against a linear scan of the documents
+
+Random shaped documents around Naples are written to a JSON lines file and
+indexed. The same bbox, radius and nearest neighbour queries are then run
+with the index and by scanning every document held in memory, and the mean
+latency of each is printed.
+
+Usage:
+    python benchmark_spatial.py --documents 200000 --queries 200
+"""
+import argparse
+import heapq
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import spatialindex
+from spatialindex import haversine
+
+AMENITIES = ["restaurant", "cafe", "bar", "pharmacy", "school", None, None, None]
+CUISINES = [["pizza"], ["regional", "pizza"], ["seafood"], ["italian"]]
+# Area the documents and queries are spread over
+EXTENT = (14.1, 40.75, 14.4, 40.95)
+
+
+def write_documents(filename, count, seed=0):
+    """Writes count random node documents to a JSON lines file"""
+    rng = random.Random(seed)
+    min_lon, min_lat, max_lon, max_lat = EXTENT
+    with open(filename, 'w') as fo:
+        for i in range(count):
+            doc = {'id': str(i + 1), 'type': 'node',
+                   'pos': [rng.uniform(min_lon, max_lon), rng.uniform(min_lat, max_lat)]}
+            amenity = rng.choice(AMENITIES)
+            if amenity is not None:
+                doc['amenity'] = amenity
+                if amenity == 'restaurant':
+                    doc['cuisine'] = rng.choice(CUISINES)
+            fo.write(json.dumps(doc) + "\n")
+
+
+def _matches(doc, filters):
+    for key, wanted in filters.items():
+        value = doc.get(key)
+        if value != wanted and not (isinstance(value, list) and wanted in value):
+            return False
+    return True
+
+
+def scan_bbox(docs, min_lon, min_lat, max_lon, max_lat, **filters):
+    return [doc for doc in docs
+            if min_lon <= doc['pos'][0] <= max_lon and min_lat <= doc['pos'][1] <= max_lat
+            and _matches(doc, filters)]
+
+
+def scan_radius(docs, lon, lat, meters, **filters):
+    found = []
+    for doc in docs:
+        if _matches(doc, filters):
+            distance = haversine(lon, lat, doc['pos'][0], doc['pos'][1])
+            if distance <= meters:
+                found.append((distance, doc))
+    return sorted(found, key=lambda hit: hit[0])
+
+
+def scan_nearest(docs, lon, lat, k, **filters):
+    return heapq.nsmallest(k, ((haversine(lon, lat, doc['pos'][0], doc['pos'][1]), doc)
+                               for doc in docs if _matches(doc, filters)),
+                           key=lambda hit: hit[0])
+
+
+def _timed(function, queries):
+    start = time.time()
+    results = [function(*args, **filters) for args, filters in queries]
+    return (time.time() - start) / len(queries), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the spatial index")
+    parser.add_argument('--documents', type=int, default=200000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--cell-size', type=float, default=spatialindex.CELL_SIZE)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'bench.json')
+        write_documents(filename, args.documents, args.seed)
+        start = time.time()
+        index = spatialindex.build_index(filename, cell_size=args.cell_size)
+        print("indexed {0} documents in {1:.2f}s".format(len(index), time.time() - start))
+        with open(filename) as fi:
+            docs = [json.loads(line) for line in fi]
+
+        rng = random.Random(args.seed + 1)
+        min_lon, min_lat, max_lon, max_lat = EXTENT
+
+        def point():
+            return rng.uniform(min_lon, max_lon), rng.uniform(min_lat, max_lat)
+
+        def filters():
+            return rng.choice([{}, {'amenity': 'restaurant'}, {'cuisine': 'pizza'}])
+
+        bbox_queries, radius_queries, nearest_queries = [], [], []
+        for _ in range(args.queries):
+            lon, lat = point()
+            bbox_queries.append(((lon, lat, lon + 0.01, lat + 0.01), filters()))
+            radius_queries.append((point() + (500,), filters()))
+            nearest_queries.append((point() + (10,), filters()))
+
+        print("{0:<10}{1:>14}{2:>14}{3:>10}".format('query', 'index (ms)', 'scan (ms)', 'speedup'))
+        with index:
+            for name, indexed, scan, queries in (
+                    ('bbox', index.bbox, scan_bbox, bbox_queries),
+                    ('radius', index.radius, scan_radius, radius_queries),
+                    ('nearest', index.nearest, scan_nearest, nearest_queries)):
+                index_time, index_results = _timed(indexed, queries)
+                scan_time, scan_results = _timed(lambda *a, **f: scan(docs, *a, **f), queries)
+                # both must find the same documents
+                for mine, theirs in zip(index_results, scan_results):
+                    if name == 'bbox':
+                        assert sorted(d['id'] for d in mine) == sorted(d['id'] for d in theirs)
+                    else:
+                        assert [d['id'] for _, d in mine] == [d['id'] for _, d in theirs]
+                print("{0:<10}{1:>14.3f}{2:>14.3f}{3:>9.0f}x".format(
+                    name, index_time * 1000, scan_time * 1000, scan_time / index_time))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
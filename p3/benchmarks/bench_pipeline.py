@@ -0,0 +1,154 @@
+"""
+pytest-benchmark suite for the audit and shaping code
+
+Micro-benchmarks time the street name, phone number and cuisine functions,
+audit_tag, shape_element, shape_document and to_dict on values and elements
+taken from a small synthetic file. End-to-end benchmarks run audit() and process_map() on
+synthetic files of each size in OSM_BENCH_SIZES (default 10MB, the full set
+is 10MB,100MB,1GB) through an instrument.RunStats and record MB/s,
+elements/s, peak RSS and the share of each stage in the extra info.
+
+All inputs are written by osmgen with a fixed seed, so results are
+comparable between machines and runs. Generated files are kept in
+OSM_BENCH_DIR if set, otherwise in a temporary directory.
+
+The file is named bench_* so a plain pytest run does not collect it. Run
+from the p3 directory:
+    python -m pytest benchmarks/bench_pipeline.py --benchmark-only
+    OSM_BENCH_SIZES=10MB,100MB,1GB python -m pytest benchmarks/bench_pipeline.py \\
+        -k end_to_end --benchmark-json=bench.json
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import audit  # noqa: E402
+import data  # noqa: E402
+import instrument  # noqa: E402
+import osmgen  # noqa: E402
+import osmparse  # noqa: E402
+import sinks  # noqa: E402
+
+SEED = 42
+SIZES = [size.strip() for size in os.environ.get('OSM_BENCH_SIZES', '10MB').split(',')]
+
+
+@pytest.fixture(scope='session')
+def bench_dir(tmp_path_factory):
+    directory = os.environ.get('OSM_BENCH_DIR')
+    if directory:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return directory
+    return str(tmp_path_factory.mktemp('osm'))
+
+
+def synthetic_file(directory, size):
+    """Returns a generated file of the given size, reusing an existing one"""
+    filename = os.path.join(directory, 'synthetic_{0}_seed{1}.osm'.format(size, SEED))
+    if not os.path.exists(filename):
+        osmgen.write_osm(filename, size=osmgen.parse_size(size), seed=SEED)
+    return filename
+
+
+@pytest.fixture(scope='session')
+def elements(bench_dir):
+    """Tagged elements of a small file, parsed once and kept in memory"""
+    filename = synthetic_file(bench_dir, '2MB')
+    return [element for element in osmparse.iterelements(filename, backend='expat')
+            if element.findall('tag')]
+
+
+@pytest.fixture(scope='session')
+def tag_values(elements):
+    values = {'addr:street': [], 'phone': [], 'cuisine': []}
+    for element in elements:
+        for tag in element.iter('tag'):
+            if tag.attrib['k'] in values:
+                values[tag.attrib['k']].append(tag.attrib['v'])
+    return values
+
+
+def test_update_street_name(benchmark, tag_values):
+    names = tag_values['addr:street']
+    benchmark(lambda: [audit.update_street_name(name) for name in names])
+
+
+def test_update_short_name(benchmark, tag_values):
+    names = tag_values['addr:street']
+    benchmark(lambda: [audit.update_short_name(name) for name in names])
+
+
+def test_normalize_street_name_cached(benchmark, tag_values):
+    names = tag_values['addr:street']
+    benchmark(lambda: [audit.normalize_street_name(name) for name in names])
+
+
+def test_parse_phone_number(benchmark, tag_values):
+    numbers = tag_values['phone']
+    # bypass the cache to time the parser itself
+    benchmark(lambda: [audit.phone_parser._parse(number) for number in numbers])
+
+
+def test_update_cuisine(benchmark, tag_values):
+    values = tag_values['cuisine']
+    benchmark(lambda: [[audit.update_cuisine(c) for c in value.split(';')] for value in values])
+
+
+def test_audit_tag(benchmark, elements):
+    tags = [tag for element in elements for tag in element.iter('tag')]
+
+    def run():
+        report = audit.new_audit()
+        for tag in tags:
+            audit.audit_tag(report, tag)
+    benchmark(run)
+
+
+def test_shape_element(benchmark, elements):
+    benchmark(lambda: [data.shape_element(element) for element in elements])
+
+
+def test_shape_document(benchmark, elements):
+    benchmark(lambda: [data.shape_document(element) for element in elements])
+
+
+def test_element_to_dict(benchmark, elements):
+    shaped = [data.shape_element(element) for element in elements]
+    benchmark(lambda: [el.to_dict() for el in shaped])
+
+
+def _run_instrumented(benchmark, function, filename, **kwargs):
+    """Runs an end-to-end function once with a RunStats and records its
+    throughput and stage shares in the extra info"""
+    stats = instrument.RunStats(function.__name__, progress=None)
+    benchmark.pedantic(function, args=(filename,), kwargs=dict(kwargs, stats=stats),
+                       rounds=1, iterations=1)
+    summary = stats.summary()
+    benchmark.extra_info['mb_per_sec'] = summary['bytes_per_sec'] / 2.0 ** 20
+    benchmark.extra_info['elements_per_sec'] = summary['elements_per_sec']
+    benchmark.extra_info['peak_rss_mb'] = summary['peak_rss_mb']
+    benchmark.extra_info['stages'] = dict((name, stage['share'])
+                                          for name, stage in summary['stages'].items())
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_end_to_end_audit(benchmark, bench_dir, size):
+    _run_instrumented(benchmark, audit.audit, synthetic_file(bench_dir, size))
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_end_to_end_process_map(benchmark, bench_dir, size):
+    filename = synthetic_file(bench_dir, size)
+    file_out = filename + '.json'
+    try:
+        _run_instrumented(benchmark, data.process_map, filename,
+                          sink=sinks.JsonLinesSink(file_out))
+    finally:
+        if os.path.exists(file_out):
+            os.remove(file_out)
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Applies an OpenStreetMap change file (.osc) to previously converted output
+
+Instead of converting the whole extract again, only the elements in the
+create, modify and delete blocks of the change file are shaped (with the
+same audit fixes as process_map) and merged into an existing JSON lines
+file, Parquet file or MongoDB collection. Documents are matched on their
+type and id, and a change is only applied when its version is newer than
+the stored created.version, so applying the same diff twice is harmless.
+
+Output converted with geometry (data.py --geometry) holds the geometry,
+bbox and centroid of the ways and the multipolygon of area relations. The
+changed ways and relations get theirs from the node and way indexes the
+conversion kept (data.py --index), with the nodes and ways of the change
+file taking precedence over the indexes. The indexes themselves are not
+updated, and ways that are not in the change file keep their geometry even
+if their nodes moved. Applying changes with ways or relations to such
+output without the indexes is refused, instead of dropping their geometry.
+
+Usage:
+    python changes.py napoli.osc napoli.osm.json
+    python changes.py napoli.osc napoli.osm.json.gz
+    python changes.py napoli.osc napoli.osm.json --index napoli.osm.nodes
+    python changes.py napoli.osc napoli.osm.parquet
+    python changes.py napoli.osc --mongo mongodb://localhost --db osm --collection napoli
+"""
+import argparse
+import os
+import re
+from contextlib import closing
+
+import audit
+import data
+import model
+import nodeindex
+import serializers
+import sinks
+from osmparse import ET
+
+try:
+    import pymongo
+except ImportError:
+    pymongo = None
+
+ACTIONS = ('create', 'modify', 'delete')
+
+# Extracts the id of a JSON lines document without decoding the whole line
+id_re = re.compile(br'"id":\s*"([^"]*)"')
+
+# Key only documents converted with geometry have, as JSON
+GEOMETRY_KEY = b'"centroid":'
+
+
+class Change(object):
+    """A single change to an element, doc is its shaped model element or
+    None for deletions, resolved tells whether its geometry was looked up
+    in the indexes"""
+    __slots__ = ('action', 'version', 'doc', 'resolved')
+
+    def __init__(self, action, version, doc):
+        self.action = action
+        self.version = version
+        self.doc = doc
+        self.resolved = False
+
+    def applies_to(self, version):
+        """Returns true if the change is newer than a stored version"""
+        return version is None or self.version > version
+
+    def needs_geometry(self):
+        """Returns true for a way or area relation whose geometry was not
+        resolved"""
+        doc = self.doc
+        if doc is None or self.resolved:
+            return False
+        return doc.type == 'way' or (doc.type == 'relation' and
+                                     doc.get('tag_type') in nodeindex.AREA_RELATIONS)
+
+
+def iterchanges(osc_file):
+    """Creates a generator to yield the elements of a change file
+
+    :param osc_file: name or file object of the osmChange file
+    :return: yields (action, element) tuples
+    """
+    context = ET.iterparse(osc_file, events=('start', 'end'))
+    _, root = next(context)
+    depth = 0
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                block = elem
+            continue
+        depth -= 1
+        if depth == 1:
+            # an element inside an action block has been completely parsed,
+            # it is detached once processed so a large block is not kept
+            if block.tag in ACTIONS:
+                yield block.tag, elem
+            block.remove(elem)
+        elif depth == 0:
+            root.clear()
+
+
+def load_changes(osc_file, audit_results=None, index_path=None):
+    """Shapes the elements of a change file
+
+    Only the diff is held in memory. When an element changes more than once
+    the newest version wins.
+    :param osc_file: name of the osmChange file
+    :param audit_results: optional AuditReport from audit.new_audit() to
+        populate with the created and modified elements
+    :param index_path: base name of the node index kept by
+        process_map(geometry=True, index_path=...), to resolve the geometry
+        of the changed ways and relations as the conversion did
+    :return: dictionary of (type, id) to Change
+    """
+    changes = {}
+    for action, element in iterchanges(osc_file):
+        key = (element.tag, element.attrib['id'])
+        version = int(element.attrib.get('version', 0))
+        doc = None
+        if action != 'delete':
+            if audit_results is not None:
+                for tag in element.iter('tag'):
+                    audit.audit_tag(audit_results, tag)
+            doc = data.shape_element(element)
+            if doc is None:
+                continue
+        if key not in changes or version >= changes[key].version:
+            changes[key] = Change(action, version, doc)
+    if index_path is not None:
+        resolve_geometry(changes, index_path)
+    return changes
+
+
+class _Overlay(object):
+    """Looks ids up in the changed elements first, then in an index"""
+
+    def __init__(self, changed, index):
+        self.changed = changed
+        self.index = index
+
+    def get(self, key):
+        value = self.changed.get(key)
+        return self.index.get(key) if value is None else value
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+
+def _stored(lon, lat):
+    """Returns a location at the precision of the indexes"""
+    scale = float(nodeindex.SCALE)
+    return (int(round(lon * scale)) / scale, int(round(lat * scale)) / scale)
+
+
+def resolve_geometry(changes, index_path):
+    """Adds the geometry of the changed ways and relations, as
+    process_map(geometry=True) does
+
+    Ways are resolved from the created and modified nodes of the change and
+    the node index, area relations from the changed ways and the way index.
+    :param changes: dictionary returned by load_changes
+    :param index_path: base name of the node index, the way index has an
+        additional .ways
+    """
+    docs = [change.doc for change in changes.values() if change.doc is not None]
+    nodes = dict((doc.id, _stored(doc.lon, doc.lat)) for doc in docs
+                 if doc.type == 'node' and doc.lon is not None)
+    ways = {}
+    with nodeindex.NodeIndex(index_path) as node_index:
+        located = _Overlay(nodes, node_index)
+        for doc in docs:
+            if doc.type == 'way':
+                doc.geometry = nodeindex.way_geometry(doc.node_refs, located)
+                if doc.geometry is not None:
+                    ways[doc.id] = [tuple(c) for c in doc.geometry['geometry']]
+    with nodeindex.WayIndex(index_path + '.ways') as way_index:
+        located = _Overlay(ways, way_index)
+        for doc in docs:
+            if doc.type == 'relation' and doc.get('tag_type') in nodeindex.AREA_RELATIONS:
+                doc.geometry = nodeindex.multipolygon_geometry(doc.members, located)
+    for change in changes.values():
+        change.resolved = True
+
+
+def _missing_geometry(output):
+    """Returns the error for output with geometry that unresolved changes
+    would be merged into"""
+    return ValueError("{0} holds the geometry of its ways (data.py --geometry) and the change "
+                      "file changes ways or relations: load the changes with the node index "
+                      "of the conversion (index_path, --index) to resolve their geometry"
+                      .format(output))
+
+
+def _version(doc):
+    return int(doc['created']['version'])
+
+
+def _replace(src, dst):
+    """Moves src over dst, atomically where the platform allows it"""
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    # Python 2: rename overwrites on POSIX, only Windows needs the removal
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def apply_to_jsonl(changes, file_in, file_out=None, serializer=serializers.DEFAULT_SERIALIZER):
+    """Applies changes to a JSON lines file written by process_map
+
+    Lines of unchanged documents are copied without being decoded. If
+    anything fails the file is left as it was. The input may be gzip or
+    zstd compressed, and the output is compressed as its extension says,
+    so compressed files are updated in place. Pretty output, which is not
+    one document per line, and output with geometry when the changes have
+    none are rejected with a ValueError.
+    :param changes: dictionary returned by load_changes
+    :param file_in: name of the JSON lines file to update
+    :param file_out: name of the updated file, file_in is replaced if None
+    :param serializer: name of the serializer of the changed documents, the
+        one the file was written with, see serializers.get_serializer
+    :return: dictionary counting the created, modified and deleted documents
+    """
+    counts = dict.fromkeys(ACTIONS, 0)
+    ids = set(element_id.encode('utf-8') for _, element_id in changes)
+    pending = dict(changes)
+    check_geometry = any(change.needs_geometry() for change in changes.values())
+    dumps = serializers.get_serializer(serializer, default=model.default).dumps
+    file_out = file_out or file_in
+    tmp = file_out + '.tmp'
+    try:
+        # the lines are UTF-8 as the sinks write them, they are matched as
+        # bytes and only decoded when a document changes
+        with serializers.open_input(file_in) as fi, \
+                closing(serializers.open_output(tmp, serializers.compression_of(file_out))) as fo:
+            for line in fi:
+                if check_geometry and GEOMETRY_KEY in line:
+                    raise _missing_geometry(file_in)
+                m = id_re.search(line)
+                if m is None:
+                    # every document has an id, check the line is one, as
+                    # the lines of pretty output are not
+                    serializers.loads_line(line, file_in)
+                if m is None or m.group(1) not in ids:
+                    fo.write(line)
+                    continue
+                doc = serializers.loads_line(line, file_in)
+                change = pending.pop((doc['type'], doc['id']), None)
+                if change is None or not change.applies_to(_version(doc)):
+                    fo.write(line)
+                elif change.action == 'delete':
+                    counts['delete'] += 1
+                else:
+                    fo.write(dumps(change.doc) + b"\n")
+                    counts['modify'] += 1
+            # elements that were not in the file yet
+            for change in pending.values():
+                if change.action != 'delete':
+                    fo.write(dumps(change.doc) + b"\n")
+                    counts['create'] += 1
+        _replace(tmp, file_out)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return counts
+
+
+def apply_to_parquet(changes, file_in, file_out=None, row_group_size=sinks.ROW_GROUP_SIZE):
+    """Applies changes to a Parquet file written by sinks.ParquetSink
+
+    Record batches are streamed through, dropping the rows that are
+    replaced or deleted, and the new documents are appended at the end.
+    :param changes: dictionary returned by load_changes
+    :param file_in: name of the Parquet file to update
+    :param file_out: name of the updated file, file_in is replaced if None
+    :param row_group_size: rows per row group of the new file
+    :return: dictionary counting the created, modified and deleted documents
+    """
+    if sinks.pa is None:
+        raise ImportError("Updating Parquet requires the pyarrow package")
+    pa, pq = sinks.pa, sinks.pq
+
+    counts = dict.fromkeys(ACTIONS, 0)
+    pending = dict(changes)
+    replaced = []
+    check_geometry = any(change.needs_geometry() for change in changes.values())
+    tmp = (file_out or file_in) + '.tmp'
+    try:
+        with sinks.ParquetSink(tmp, row_group_size) as sink:
+            for batch in pq.ParquetFile(file_in).iter_batches(batch_size=row_group_size):
+                centroids = batch.column('centroid')
+                if check_geometry and centroids.null_count < len(centroids):
+                    raise _missing_geometry(file_in)
+                ids = batch.column('id').to_pylist()
+                types = batch.column('type').to_pylist()
+                versions = batch.column('created').field('version').to_pylist()
+                keep = []
+                for element_type, element_id, version in zip(types, ids, versions):
+                    change = pending.pop((element_type, str(element_id)), None)
+                    if change is not None and change.applies_to(version):
+                        counts['delete' if change.action == 'delete' else 'modify'] += 1
+                        if change.action != 'delete':
+                            replaced.append(change.doc)
+                        keep.append(False)
+                    else:
+                        keep.append(True)
+                sink.write_batch(batch.filter(pa.array(keep)))
+            for change in pending.values():
+                if change.action != 'delete':
+                    replaced.append(change.doc)
+                    counts['create'] += 1
+            for doc in replaced:
+                sink.write(doc)
+        _replace(tmp, file_out or file_in)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return counts
+
+
+def apply_to_mongo(changes, collection):
+    """Applies changes to a MongoDB collection loaded by sinks.MongoSink
+
+    The stored versions of the changed documents are fetched in one query
+    and the applicable changes are sent as a single unordered bulk write.
+    :param changes: dictionary returned by load_changes
+    :param collection: pymongo (or mongomock) collection
+    :return: dictionary counting the created, modified and deleted documents
+    """
+    if pymongo is None:
+        raise ImportError("Updating MongoDB requires the pymongo package")
+
+    if (any(change.needs_geometry() for change in changes.values()) and
+            collection.find_one({'centroid': {'$exists': True}}, {'_id': 1}) is not None):
+        raise _missing_geometry(collection.name)
+
+    counts = dict.fromkeys(ACTIONS, 0)
+    ids = list(set(element_id for _, element_id in changes))
+    stored = {}
+    for doc in collection.find({'id': {'$in': ids}}, {'id': 1, 'type': 1, 'created.version': 1}):
+        stored[(doc['type'], doc['id'])] = _version(doc)
+
+    requests = []
+    for key, change in changes.items():
+        version = stored.get(key)
+        if not change.applies_to(version):
+            continue
+        selector = {'type': key[0], 'id': key[1]}
+        if change.action == 'delete':
+            if version is not None:
+                requests.append(pymongo.DeleteOne(selector))
+                counts['delete'] += 1
+        else:
+            requests.append(pymongo.ReplaceOne(selector, change.doc.to_dict(), upsert=True))
+            counts['modify' if version is not None else 'create'] += 1
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply an OSM change file to converted output")
+    parser.add_argument('oscfile')
+    parser.add_argument('output', nargs='?',
+                        help="JSON lines file, optionally gzip or zstd compressed, or "
+                             "Parquet file written by data.py")
+    parser.add_argument('--index', metavar='PATH',
+                        help="node index kept by data.py --geometry --index PATH, to resolve "
+                             "the geometry of the changed ways and relations")
+    parser.add_argument('--serializer', default=serializers.DEFAULT_SERIALIZER,
+                        choices=['auto', 'orjson', 'ujson', 'json'],
+                        help="JSON library of the changed lines, the one data.py used")
+    parser.add_argument('--mongo', metavar='URI', help="update a MongoDB collection instead")
+    parser.add_argument('--db', default='osm', help="MongoDB database name")
+    parser.add_argument('--collection', default='napoli', help="MongoDB collection name")
+    args = parser.parse_args()
+
+    changes = load_changes(args.oscfile, index_path=args.index)
+    if args.mongo:
+        counts = apply_to_mongo(changes, sinks.mongo_collection(args.mongo, args.db, args.collection))
+    elif args.output is None:
+        parser.error("an output file or --mongo is required")
+    elif args.output.endswith('.parquet'):
+        counts = apply_to_parquet(changes, args.output)
+    else:
+        counts = apply_to_jsonl(changes, args.output, serializer=args.serializer)
+    print("{0} changes read: {1}".format(len(changes), counts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Batch cuisine normalization and frequency counts
+
+The cuisine tag holds a semicolon separated list of cuisine types. Instead
+of splitting and correcting one tag at a time, normalize() takes a whole
+column of raw values, either a pandas Series or a pyarrow Array, splits and
+explodes it with vectorized string operations and encodes the types as
+categories. The corrections of the active ruleset (audit.cuisine_types) are
+applied to the categories, so the Python work grows with the number of
+distinct cuisine types rather than the number of tags, and the frequency
+table is a bincount of the category codes.
+
+The corrected types match those data.shape_element stores: the values are
+split on ';' and each part is looked up in the mapping.
+
+Usage:
+    python cuisine.py napoli.osm --top 10
+    python cuisine.py napoli.osm.parquet
+"""
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+import audit
+import osmparse
+import sinks
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+# cleaned: the corrected cuisine types, exploded to one categorical value
+#     per type indexed by the input row (pandas) or a list<dictionary> array
+#     with one list per input row (Arrow)
+# counts: number of occurrences of each corrected type, most frequent first,
+#     as a pandas Series or an Arrow table of cuisine and count
+CuisineResult = namedtuple('CuisineResult', ['cleaned', 'counts'])
+
+
+def _translate(uniques, mapping):
+    """Applies the mapping to the distinct raw values
+
+    Several raw values may map to the same type, e.g. italian_pizza and
+    pizza, so the corrected values are factorized again.
+    :return: tuple of the code translation array and the corrected categories
+    """
+    categories = []
+    positions = {}
+    translation = np.empty(len(uniques), dtype=np.int32)
+    for i, value in enumerate(uniques):
+        value = mapping.get(value, value)
+        if value not in positions:
+            positions[value] = len(categories)
+            categories.append(value)
+        translation[i] = positions[value]
+    return translation, categories
+
+
+def normalize(values, mapping=None):
+    """Splits, corrects and counts a column of raw cuisine values
+
+    :param values: pandas Series, pyarrow Array or ChunkedArray, or any
+        sequence of raw cuisine strings, missing values are allowed
+    :param mapping: dictionary of corrections, defaults to the cuisine types
+        of the active ruleset
+    :return: CuisineResult
+    """
+    if mapping is None:
+        mapping = audit.cuisine_types
+    if pa is not None and isinstance(values, (pa.Array, pa.ChunkedArray)):
+        return _normalize_arrow(values, mapping)
+    if pd is not None:
+        return _normalize_pandas(values, mapping)
+    if pa is not None:
+        return _normalize_arrow(pa.array(values, pa.string()), mapping)
+    raise ImportError("Normalizing cuisines requires pandas or pyarrow")
+
+
+def _normalize_pandas(values, mapping):
+    series = values if isinstance(values, pd.Series) else pd.Series(values, dtype=object)
+    exploded = series.str.split(';').explode()
+    codes, uniques = pd.factorize(exploded)
+    translation, categories = _translate(uniques, mapping)
+    # missing values keep the code -1
+    codes = np.where(codes >= 0, translation[np.maximum(codes, 0)], -1)
+    cleaned = pd.Series(pd.Categorical.from_codes(codes, categories=categories),
+                        index=exploded.index, name='cuisine')
+    counts = pd.Series(np.bincount(codes[codes >= 0], minlength=len(categories)),
+                       index=pd.Index(categories, name='cuisine'), name='count')
+    return CuisineResult(cleaned, counts.sort_values(ascending=False, kind='stable'))
+
+
+def _normalize_arrow(values, mapping):
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    lists = pc.split_pattern(values, ';')
+    encoded = pc.list_flatten(lists).dictionary_encode()
+    translation, categories = _translate(encoded.dictionary.to_pylist(), mapping)
+    indices = translation[encoded.indices.to_numpy(zero_copy_only=False)]
+    cleaned = pa.ListArray.from_arrays(
+        lists.offsets,
+        pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()),
+                                       pa.array(categories, pa.string())),
+        mask=lists.is_null())
+    counts = pa.table({'cuisine': pa.array(categories, pa.string()),
+                       'count': np.bincount(indices, minlength=len(categories))})
+    return CuisineResult(cleaned, counts.sort_by([('count', 'descending')]))
+
+
+def raw_cuisines(osmfile, backend=osmparse.DEFAULT_BACKEND):
+    """Returns the raw cuisine tag values of an OSM file"""
+    return [tag.attrib['v']
+            for element in osmparse.iterelements(osmfile, backend=backend)
+            for tag in element.iter('tag') if tag.attrib['k'] == 'cuisine']
+
+
+def parquet_cuisines(file_in):
+    """Returns the cuisine column of a Parquet file written by data.py as
+    raw strings, joining the already corrected lists back together"""
+    column = sinks.read_parquet(file_in, ['cuisine']).column('cuisine')
+    return pc.binary_join(column, ';')
+
+
+def count_items(result):
+    """Returns the frequency table of a CuisineResult as (type, count) pairs"""
+    counts = result.counts
+    if pa is not None and isinstance(counts, pa.Table):
+        return list(zip(counts.column('cuisine').to_pylist(), counts.column('count').to_pylist()))
+    return list(counts.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count the cuisine types of an OSM file")
+    parser.add_argument('source', help="OSM file or Parquet file written by data.py")
+    parser.add_argument('--top', type=int, default=20, help="number of types to print")
+    parser.add_argument('--backend', default=osmparse.DEFAULT_BACKEND,
+                        choices=sorted(osmparse.BACKENDS), help="XML parser backend")
+    args = parser.parse_args()
+
+    if args.source.endswith('.parquet'):
+        result = normalize(parquet_cuisines(args.source))
+    else:
+        result = normalize(raw_cuisines(args.source, args.backend))
+    for cuisine_type, count in count_items(result)[:args.top]:
+        print("{0:>8}  {1}".format(count, cuisine_type))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,12 +5,21 @@ Converts an OSM XML file into JSON files to be imported into MongoDB
 
 Adapted from the data.py module found in the case study quizzes.
 """
-import xml.etree.cElementTree as ET
+import argparse
+import multiprocessing
+import os
 import pprint
 import re
-import codecs
 import json
+import shutil
 import audit
+import instrument
+import model
+import nodeindex
+import osmparse
+import serializers
+import sinks
+from osmparse import CHUNK_SIZE, ChunkFile, chunk_offsets
 
 """
 Your task is to wrangle the data and transform the shape of the data
@@ -97,110 +106,382 @@ lower = re.compile(r'^([a-z]|_)*$')
 lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
 problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
-CREATED = ["version", "changeset", "timestamp", "user", "uid"]
+CREATED = list(model.CREATED)
+
+# Keys every document has before its tags are added, tags with these keys
+# are stored as tag_<key>
+BASE_KEYS = frozenset(['type', 'id', 'created'])
+
+# Attributes with a field of their own in the model elements
+SHAPED_ATTRIBUTES = frozenset(['id'] + CREATED)
+LOCATED_ATTRIBUTES = SHAPED_ATTRIBUTES | frozenset(['lat', 'lon'])
 
 
 def shape_element(element):
     """
-    Convert an XML element into a multi-level dictionary
+    Convert an XML element into a compact element of the model module
     :param element: XML element to parse
-    :return: Multi-level dictionary suitable for JSON output
+    :return: model.Node, model.Way or model.Relation, whose to_dict() returns
+        the multi-level dictionary suitable for JSON output, or None for
+        other elements
     """
-    node = {}
-    if element.tag == "node" or element.tag == "way":
-        # add the tag type to the node dictionary
-        node['type'] = element.tag
-
-        # Dump all the attributes from the element into the dictionary
-        node.update(element.attrib)
-
-        # Pop CREATED items into the 'created' sub-dictionary
-        node['created'] = {k:node.pop(k) for k in CREATED}
-
-        # Capture the latitude and longitude if present
-        if 'lat' in node and 'lon' in node:
-            node['pos'] = [float(node.pop('lon')), float(node.pop('lat'))]
-
-        # Get the second level tags
-        for tag in element.findall('tag'):
-            # grab the k and v attributes
-            k, v = tag.attrib['k'], tag.attrib['v']
-
-            # Rename keys already in node to ensure they aren't overwritten
-            if k in node:
-                k = 'tag_' + k
-
-            # skip tag if key contains problem characters
-            if problemchars.search(k): continue
-
-            # Break addresses down into a sub-dictionary
-            if "addr:" in k:
-                if 'address' not in node:
-                    node['address'] = {}
-
-                # Parse second portion of name for sub-tdictionary key
-                _, k = k.split(':', 1)
-
-                # Replace the remaining colons with underscores
-                k = k.replace(':', '_')
-
-                # Special handling for street addresses, using the audit functions
-                if k == "street":
-                    if audit.over_abbr_re.search(v):
-                        v = audit.update_short_name(v)
-                    else:
-                        v = audit.update_street_name(v)
-                node['address'][k] = v
-            # deal with remaining tags
-            else:
-                # Replace any colons with underscores
-                k = k.replace(':', '_')
-
-                # Update format of cuisine and phone tag types
-                if k == "cuisine":
-                    # Python magic: split v to a list and apply update_cuisine to each item
-                    v = map(audit.update_cuisine, v.split(';'))
-                elif k == "phone":
-                    v = audit.update_number(v)
-                    if not v:  # When phone number was invalid
-                        continue
-
-                # Save the tag
-                node[k] = v
-
-        # store nd ref tags for ways
-        if element.tag == "way":
-            node['node_refs'] = [nd.attrib['ref'] for nd in element.findall('nd')]
-
-        return node
-    else:
+    cls = model.ELEMENT_TYPES.get(element.tag)
+    if cls is None:
         return None
+    attrib = element.attrib
+
+    # Capture the latitude and longitude if present
+    located = cls is model.Node and 'lat' in attrib and 'lon' in attrib
+
+    # Keep the attributes that are neither the id, CREATED nor the location
+    shaped = LOCATED_ATTRIBUTES if located else SHAPED_ATTRIBUTES
+    other = [(k, v) for k, v in attrib.items() if k not in shaped]
+
+    # Put the CREATED items into the 'created' tuple
+    el = cls(int(attrib['id']), model.make_created(attrib), tuple(other) if other else None)
+    if located:
+        el.lon, el.lat = float(attrib['lon']), float(attrib['lat'])
+
+    # Get the second level tags
+    tag_elements = element.findall('tag')
+    if tag_elements:
+        # Keys of the document so far, to ensure tags don't overwrite them
+        taken = set(BASE_KEYS)
+        taken.update(k for k, _ in other)
+        if located:
+            taken.add('pos')
+        address, tags = _shape_tags(tag_elements, taken)
+        if address:
+            el.address = model.Address()
+            for k, v in address:
+                el.address.set(k, v)
+        if tags:
+            el.tags = tags
+
+    # store nd ref tags for ways
+    if cls is model.Way:
+        el.node_refs.extend([int(nd.attrib['ref']) for nd in element.findall('nd')])
+
+    # store the typed members of relations in document order
+    elif cls is model.Relation:
+        el.members = [model.Member(member.attrib['type'], int(member.attrib['ref']),
+                                   member.attrib.get('role', ''))
+                      for member in element.findall('member')]
+
+    return el
+
+
+def shape_document(element):
+    """
+    Convert an XML element straight into its multi-level dictionary
+
+    The dictionary is the one shape_element(element).to_dict() returns, with
+    the ids and version numbers as written in the file. Building it without
+    the model element is cheaper when the document is written out at once,
+    as the JSON lines sink does.
+    :param element: XML element to parse
+    :return: Multi-level dictionary suitable for JSON output, or None for
+        other elements
+    """
+    tag = element.tag
+    if tag not in model.ELEMENT_TYPES:
+        return None
+    attrib = element.attrib
+
+    # Capture the latitude and longitude if present
+    located = tag == 'node' and 'lat' in attrib and 'lon' in attrib
+
+    # Dump the other attributes into the dictionary, in the order of to_dict
+    shaped = LOCATED_ATTRIBUTES if located else SHAPED_ATTRIBUTES
+    doc = {'type': tag, 'id': attrib['id']}
+    for k, v in attrib.items():
+        if k not in shaped:
+            doc[k] = v
+    doc['created'] = {'version': attrib['version'], 'changeset': attrib['changeset'],
+                      'timestamp': attrib['timestamp'], 'user': attrib['user'],
+                      'uid': attrib['uid']}
+    if located:
+        doc['pos'] = [float(attrib['lon']), float(attrib['lat'])]
+
+    # Get the second level tags
+    tag_elements = element.findall('tag')
+    if tag_elements:
+        address, tags = _shape_tags(tag_elements, set(doc))
+        if address:
+            doc['address'] = model.address_dict(address)
+        doc.update(tags)
+
+    # store nd ref tags for ways
+    if tag == 'way':
+        doc['node_refs'] = [nd.attrib['ref'] for nd in element.findall('nd')]
+
+    # store the typed members of relations in document order
+    elif tag == 'relation':
+        doc['members'] = [{'type': member.attrib['type'],
+                           'ref': member.attrib['ref'],
+                           'role': member.attrib.get('role', '')}
+                          for member in element.findall('member')]
+
+    return doc
+
+
+def _shape_tags(tag_elements, taken):
+    """Cleans and renames the tags of an element
+
+    :param tag_elements: tag elements of the element
+    :param taken: set of the keys of the document so far, tags with one of
+        these keys are stored as tag_<key>
+    :return: tuple of the lists of the (key, value) pairs of the address
+        parts of the addr:* tags and of the other tags
+    """
+    # Fixers of the active ruleset by tag key
+    fixers = audit.ruleset.fix_dispatch
+    fix_value, search = audit.fix_value, problemchars.search
+
+    address = []
+    tags = []
+    for tag in tag_elements:
+        # grab the k and v attributes
+        k, v = tag.attrib['k'], tag.attrib['v']
+
+        # Clean the value with the rules of its key, such as the street
+        # name, cuisine and phone number fixes
+        if k in fixers:
+            v = fix_value(k, v)
+            if v is None:  # e.g. when a phone number was invalid
+                continue
+
+        # Rename keys already in the document to ensure they aren't overwritten
+        if k in taken:
+            k = 'tag_' + k
+
+        # skip tag if key contains problem characters
+        if search(k): continue
+
+        # Break addresses down into the address parts
+        if "addr:" in k:
+            if not address:
+                taken.add('address')
+
+            # Parse second portion of name for the address key, replacing
+            # the remaining colons with underscores
+            _, k = k.split(':', 1)
+            address.append((k.replace(':', '_'), v))
+        # deal with remaining tags
+        else:
+            # Replace any colons with underscores
+            k = k.replace(':', '_')
+
+            # Save the tag
+            taken.add(k)
+            tags.append((k, v))
+
+    return address, tags
+
+
+def process_map(file_in, pretty=False, audit_results=None, backend=osmparse.DEFAULT_BACKEND,
+                sink=None, geometry=False, index_path=None, stats=None):
+    """
+    Converts an OSM file to JSON in a single streaming pass
+
+    Each top level element is parsed once, optionally fed to the audit
+    accumulators, shaped and written straight to the sink. Elements are
+    cleared after use and shaped documents are not kept, so memory stays
+    flat regardless of the size of the input file.
+    :param file_in: name of the OpenStreetMap file to convert
+    :param pretty: indent the JSON output over several lines per document,
+        which iterjson and the change loader cannot read back
+    :param audit_results: optional AuditReport from audit.new_audit() to
+        populate during the same pass
+    :param backend: name of the osmparse parser backend
+    :param sink: sinks.Sink receiving the documents, defaults to a JSON lines
+        file named after the input file. The sink is closed when done.
+    :param geometry: add the resolved geometry, bbox and centroid of each way
+        using an on-disk node index built during the node pass, and the
+        multipolygon, bbox and centroid of each multipolygon and boundary
+        relation using an on-disk way index built during the way pass. This
+        relies on the nodes preceding the ways and the ways preceding the
+        relations, as they do in OSM files.
+    :param index_path: base name of the node index files, the way index files
+        get an additional .ways. A temporary index next to the input file is
+        used and removed if None
+    :param stats: optional instrument.RunStats to collect the timings of the
+        parse, audit, shape, geometry and write stages and the throughput in,
+        it is started and stopped by this function
+    :return: number of documents written
+    """
+    if sink is None:
+        sink = sinks.JsonLinesSink("{0}.json".format(file_in), pretty)
+    source = file_in
+    # a streaming sink would turn every model element into its dictionary
+    # at once, so it gets the dictionary, unless the geometry needs the
+    # elements
+    shape = shape_document if sink.streaming and not geometry else shape_element
+    audit_element, locate, locate_area, write = (
+        audit.audit_element, nodeindex.way_geometry,
+        nodeindex.multipolygon_geometry, sink.write)
+    if stats is not None:
+        # wrap every stage in a timer, the plain functions are used otherwise
+        stats.start()
+        source = instrument.CountingReader(file_in, stats)
+        audit_element = stats.timed('audit', audit_element)
+        shape = stats.timed('shape', shape)
+        locate = stats.timed('geometry', locate)
+        locate_area = stats.timed('geometry', locate_area)
+        write = stats.timed('write', write)
+        sink.instrument(stats)
+    elements = osmparse.iterelements(source, backend=backend)
+    if stats is not None:
+        elements = stats.timed_iter('parse', elements)
+    writer = index = way_writer = way_index = None
+    if geometry:
+        base = index_path or "{0}.nodes".format(file_in)
+        writer = nodeindex.NodeIndexWriter(base)
+        way_writer = nodeindex.WayIndexWriter(base + '.ways')
+    try:
+        with sink:
+            for element in elements:
+                if audit_results is not None:
+                    audit_element(audit_results, element)
+                el = shape(element)
+                if not el:
+                    continue
+                if writer is not None:
+                    if el.type == 'node':
+                        if el.lon is not None:
+                            writer.add(el.id, el.lon, el.lat)
+                    elif el.type == 'way':
+                        if index is None:
+                            # the node pass is over, switch to lookups
+                            index = writer.close()
+                        el.geometry = locate(el.node_refs, index)
+                        if el.geometry is not None:
+                            way_writer.add(el.id, el.geometry['geometry'])
+                    elif el.type == 'relation':
+                        if way_index is None:
+                            # the way pass is over as well
+                            way_index = way_writer.close()
+                        # the type tag was renamed, type holds the element type
+                        if el.get('tag_type') in nodeindex.AREA_RELATIONS:
+                            el.geometry = locate_area(el.members, way_index)
+                write(el)
+    finally:
+        for index_writer, finished in ((writer, index), (way_writer, way_index)):
+            if index_writer is None:
+                continue
+            if finished is None:
+                finished = index_writer.close()
+            if index_path is None:
+                finished.remove()
+            else:
+                finished.close()
+        if stats is not None:
+            source.close()
+            stats.stop()
+            stats.extra['documents'] = sink.count
+            stats.extra['rules'] = audit.ruleset.stats()
+            stats.extra['street_cache'] = audit.street_normalizer.cache_info()
+    return sink.count
+
+
+def iterjson(file_in):
+    """Creates a generator to yield the documents of a JSON lines file
+
+    :param file_in: name of the JSON file written by process_map, which may
+        be gzip or zstd compressed. Pretty output holds a document over
+        several lines and is rejected with a ValueError.
+    :return: yields a document dictionary
+    """
+    with serializers.open_input(file_in) as fi:
+        for line in fi:
+            yield serializers.loads_line(line, file_in)
 
 
-def process_map(file_in, pretty=False):
-    # You do not need to change this file
-    file_out = "{0}.json".format(file_in)
-    data = []
-    with codecs.open(file_out, "w") as fo:
-        for _, element in ET.iterparse(file_in):
-            el = shape_element(element)
-            if el:
-                data.append(el)
-                if pretty:
-                    fo.write(json.dumps(el, indent=2) + "\n")
-                else:
-                    fo.write(json.dumps(el) + "\n")
-    return data
+def _process_chunk(args):
+    """Worker entry point: shapes one byte range into a JSON lines shard
+
+    :param args: tuple of file_in, start, end, shard name, pretty flag, backend,
+        ruleset file, serializer and compression
+    :return: number of documents written to the shard
+    """
+    file_in, start, end, shard, pretty, backend, ruleset_file, serializer, compression = args
+    audit.use_ruleset_file(ruleset_file)
+    chunk = ChunkFile(file_in, start, end)
+    try:
+        # the workers already use every core, so each compresses in one thread
+        with sinks.JsonLinesSink(shard, pretty, serializer, compression, threads=1) as sink:
+            for element in osmparse.iterelements(chunk, backend=backend):
+                el = shape_document(element)
+                if el:
+                    sink.write(el)
+    finally:
+        chunk.close()
+    return sink.count
+
+
+def process_map_parallel(file_in, workers=None, pretty=False, merge=True,
+                         chunk_size=CHUNK_SIZE, backend=osmparse.DEFAULT_BACKEND, stats=None,
+                         serializer=serializers.DEFAULT_SERIALIZER, compression=None):
+    """
+    Converts an OSM file to JSON using a pool of worker processes
+
+    The file is split into byte ranges on top level element boundaries, each
+    range is shaped by a worker into its own shard, and the shards are
+    optionally concatenated in file order into the same output file that
+    process_map writes. Compressed shards are concatenated as they are,
+    gzip members and zstd frames in sequence form a valid compressed file.
+    :param file_in: name of the OpenStreetMap file to convert
+    :param workers: number of worker processes, defaults to the CPU count
+    :param pretty: indent the JSON output
+    :param merge: concatenate the shards into a single output file
+    :param chunk_size: approximate size of each range in bytes
+    :param backend: name of the osmparse parser backend
+    :param stats: optional instrument.RunStats, only the totals of the run
+        are recorded as the stages run in the workers
+    :param serializer: name of the JSON serializer, see serializers.get_serializer
+    :param compression: None, 'gzip' or 'zstd'
+    :return: tuple of the document count and the list of output files
+    """
+    file_out = "{0}.json{1}".format(file_in, serializers.COMPRESSIONS[compression])
+    ranges = chunk_offsets(file_in, chunk_size)
+    shards = ["{0}.part{1:05d}".format(file_out, i) for i in range(len(ranges))]
+    jobs = [(file_in, start, end, shard, pretty, backend, audit.ruleset.filename,
+             serializer, compression)
+            for (start, end), shard in zip(ranges, shards)]
+
+    if stats is not None:
+        stats.start()
+    pool = multiprocessing.Pool(workers)
+    try:
+        count = sum(pool.imap(_process_chunk, jobs))
+    finally:
+        pool.close()
+        pool.join()
+    if stats is not None:
+        stats.stop()
+        stats.elements = count
+        stats.bytes = stats.total_bytes = os.path.getsize(file_in)
+        stats.extra['workers'] = workers
+
+    if not merge:
+        return count, shards
+
+    with open(file_out, 'wb') as fo:
+        for shard in shards:
+            with open(shard, 'rb') as fi:
+                shutil.copyfileobj(fi, fo)
+            os.remove(shard)
+    return count, [file_out]
 
 
 def test():
     # NOTE: if you are running this code on your computer, with a larger dataset,
     # call the process_map procedure with pretty=False. The pretty=True option adds
     # additional spaces to the output, making it significantly larger.
-    data = process_map('napoli.osm', False)
+    process_map('napoli.osm', False)
 
     addresses_found = 0
-    for tag in data:
+    for tag in iterjson('napoli.osm.json'):
         if "phone" in tag:
             pprint.pprint(tag)
             addresses_found += 1
@@ -210,5 +491,95 @@ def test():
     return
 
 
+def main():
+    parser = argparse.ArgumentParser(description="Convert an OSM file to JSON")
+    parser.add_argument('osmfile', nargs='?', default='napoli.osm')
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes, 0 for all cores")
+    parser.add_argument('--pretty', action='store_true',
+                        help="indent the JSON, for reading only: the change loader and "
+                             "the spatial index cannot read it back")
+    parser.add_argument('--no-merge', action='store_true',
+                        help="keep the per-chunk JSON lines shards")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE // 2 ** 20,
+                        help="size of the parallel chunks in MB")
+    parser.add_argument('--backend', default=osmparse.DEFAULT_BACKEND,
+                        choices=sorted(osmparse.BACKENDS), help="XML parser backend")
+    parser.add_argument('--format', choices=['json', 'parquet'], default='json',
+                        help="output file format")
+    parser.add_argument('--serializer', default=serializers.DEFAULT_SERIALIZER,
+                        choices=['auto', 'orjson', 'ujson', 'json'],
+                        help="JSON library, auto picks the fastest installed")
+    parser.add_argument('--compress', choices=['gzip', 'zstd'],
+                        help="compress the JSON lines output")
+    parser.add_argument('--threads', type=int,
+                        help="compression threads, defaults to the CPU count")
+    parser.add_argument('--row-group-size', type=int, default=sinks.ROW_GROUP_SIZE,
+                        help="rows per Parquet row group")
+    parser.add_argument('--geometry', action='store_true',
+                        help="resolve way and multipolygon relation geometries, "
+                             "bounding boxes and centroids")
+    parser.add_argument('--index', metavar='PATH',
+                        help="keep the node and way indexes of --geometry under this base "
+                             "name, for changes.py --index")
+    parser.add_argument('--mongo', metavar='URI',
+                        help="load the documents into MongoDB instead of writing JSON")
+    parser.add_argument('--db', default='osm', help="MongoDB database name")
+    parser.add_argument('--collection', default='napoli', help="MongoDB collection name")
+    parser.add_argument('--batch-size', type=int, default=sinks.MONGO_BATCH_SIZE,
+                        help="documents per MongoDB bulk insert")
+    parser.add_argument('--rules', default=audit.DEFAULT_RULESET,
+                        help="JSON or YAML ruleset file")
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    audit.use_ruleset_file(args.rules)
+    stats = instrument.from_arguments('data', args)
+    if args.index and not args.geometry:
+        parser.error("--index keeps the indexes of --geometry, add --geometry")
+
+    if args.mongo:
+        if args.workers != 1:
+            parser.error("--mongo loads from a single process, use --workers 1")
+        sink = sinks.MongoSink(sinks.mongo_collection(args.mongo, args.db, args.collection),
+                               args.batch_size)
+        process_map(args.osmfile, backend=args.backend, sink=sink, geometry=args.geometry,
+                    index_path=args.index, stats=stats)
+        print("loaded into {0}.{1}: {2}".format(args.db, args.collection, sink.stats()))
+        instrument.report(stats, args)
+        return
+
+    if args.format == 'parquet':
+        if args.workers != 1:
+            parser.error("--format parquet writes from a single process, use --workers 1")
+        file_out = "{0}.parquet".format(args.osmfile)
+        count = process_map(args.osmfile, backend=args.backend,
+                            sink=sinks.ParquetSink(file_out, args.row_group_size),
+                            geometry=args.geometry, index_path=args.index, stats=stats)
+        print("{0} documents written to {1}".format(count, file_out))
+        instrument.report(stats, args)
+        return
+
+    if args.geometry and args.workers != 1:
+        parser.error("--geometry resolves ways from a single process, use --workers 1")
+    if args.workers == 1:
+        file_out = "{0}.json{1}".format(args.osmfile, serializers.COMPRESSIONS[args.compress])
+        sink = sinks.JsonLinesSink(file_out, args.pretty, args.serializer, args.compress,
+                                   threads=args.threads)
+        count = process_map(args.osmfile, backend=args.backend, sink=sink,
+                            geometry=args.geometry, index_path=args.index, stats=stats)
+        outputs = [file_out]
+    else:
+        count, outputs = process_map_parallel(args.osmfile, args.workers or None,
+                                              args.pretty, not args.no_merge,
+                                              args.chunk_size * 2 ** 20, args.backend, stats,
+                                              args.serializer, args.compress)
+    print("{0} documents written to {1}".format(count, ', '.join(outputs)))
+    if args.workers == 1:
+        print("street name cache: {0}".format(audit.street_normalizer.cache_info()))
+        for rule in audit.ruleset.stats():
+            print("{name}: {fixed} values fixed in {fix_seconds:.3f}s".format(**rule))
+    instrument.report(stats, args)
+
+
 if __name__ == "__main__":
-    test()
+    main()
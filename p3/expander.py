@@ -0,0 +1,166 @@
+"""
+Expands known abbreviations in street names
+
+The abbreviation table is compiled into an Aho-Corasick automaton, so every
+known abbreviation in a name is found in one linear scan no matter how many
+entries the table holds. This lets the table grow to a national list without
+slowing down the normalization of each name.
+"""
+import codecs
+import json
+import re
+
+# Characters that make up a word, used to only expand whole-word matches
+word_re = re.compile(r'\w', re.UNICODE)
+
+
+class AbbreviationExpander(object):
+    """Aho-Corasick automaton mapping abbreviations to their expansions
+
+    Matches are case sensitive and must start and end on word boundaries.
+    When matches overlap the leftmost, then longest, abbreviation wins.
+    """
+
+    def __init__(self, table=None):
+        self._table = {}
+        self._goto = None
+        if table:
+            self.update(table)
+
+    def __len__(self):
+        return len(self._table)
+
+    def __contains__(self, abbreviation):
+        return abbreviation in self._table
+
+    def add(self, abbreviation, expansion):
+        """Adds a single abbreviation to the table"""
+        self._table[abbreviation] = expansion
+        self._goto = None
+
+    def update(self, table):
+        """Adds all abbreviations from a dictionary to the table"""
+        self._table.update(table)
+        self._goto = None
+
+    @staticmethod
+    def read_table(filename):
+        """Reads an abbreviation table from a file
+
+        JSON files must contain a single object mapping abbreviations to
+        expansions. Any other file is read as tab separated lines of
+        abbreviation and expansion, ignoring blank lines and # comments.
+        :param filename: name of the file to read
+        :return: dictionary of abbreviations to expansions
+        """
+        with codecs.open(filename, 'r', encoding='utf-8') as fi:
+            if filename.endswith('.json'):
+                return json.load(fi)
+            table = {}
+            for line in fi:
+                line = line.rstrip('\r\n')
+                if not line.strip() or line.startswith('#'):
+                    continue
+                abbreviation, expansion = line.split('\t', 1)
+                table[abbreviation] = expansion
+            return table
+
+    @classmethod
+    def from_file(cls, filename):
+        """Creates an expander from a table file, see read_table"""
+        return cls(cls.read_table(filename))
+
+    def _build(self):
+        """Compiles the table into goto, failure and output functions"""
+        goto = [{}]
+        output = [None]
+        for abbreviation in self._table:
+            state = 0
+            for char in abbreviation:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][char] = next_state
+                    goto.append({})
+                    output.append(None)
+                state = next_state
+            output[state] = abbreviation
+
+        # Breadth first construction of the failure links. dict_link points
+        # to the nearest state on the failure chain that ends an abbreviation.
+        fail = [0] * len(goto)
+        dict_link = [None] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                f = fail[state]
+                while f and char not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(char, 0)
+                fail[next_state] = f if f != next_state else 0
+                dict_link[next_state] = (fail[next_state] if output[fail[next_state]]
+                                         else dict_link[fail[next_state]])
+
+        self._goto, self._fail, self._output, self._dict_link = goto, fail, output, dict_link
+
+    def find(self, text):
+        """Finds the known abbreviations in a string
+
+        :param text: string to scan
+        :return: list of non-overlapping (start, end, abbreviation) tuples
+        """
+        if self._goto is None:
+            self._build()
+        goto, fail, output, dict_link = self._goto, self._fail, self._output, self._dict_link
+
+        matches = []
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            match = state if output[state] else dict_link[state]
+            while match:
+                abbreviation = output[match]
+                start = end - len(abbreviation)
+                if self._on_boundary(text, start, end):
+                    matches.append((start, end, abbreviation))
+                match = dict_link[match]
+
+        # Keep the leftmost, then longest, of any overlapping matches
+        matches.sort(key=lambda m: (m[0], m[0] - m[1]))
+        selected = []
+        last_end = 0
+        for start, end, abbreviation in matches:
+            if start >= last_end:
+                selected.append((start, end, abbreviation))
+                last_end = end
+        return selected
+
+    @staticmethod
+    def _on_boundary(text, start, end):
+        """Returns true if text[start:end] is not part of a longer word"""
+        if start > 0 and word_re.match(text[start]) and word_re.match(text[start - 1]):
+            return False
+        if end < len(text) and word_re.match(text[end - 1]) and word_re.match(text[end]):
+            return False
+        return True
+
+    def expand(self, text):
+        """Replaces every known abbreviation in a string with its expansion
+
+        :param text: string to expand
+        :return: expanded string
+        """
+        matches = self.find(text)
+        if not matches:
+            return text
+        pieces = []
+        position = 0
+        for start, end, abbreviation in matches:
+            pieces.append(text[position:start])
+            pieces.append(self._table[abbreviation])
+            position = end
+        pieces.append(text[position:])
+        return ''.join(pieces)
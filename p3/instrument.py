@@ -0,0 +1,256 @@
+"""
+Throughput and profiling instrumentation for the OSM pipeline
+
+A RunStats object collects, for one run of audit() or process_map():
+
+- the time spent and number of calls in each stage (parse, audit, shape,
+  geometry, write, serialize, disk), by wrapping the stage functions with
+  timed() and the element iterator with timed_iter(). Stages may nest, the
+  write stage of a JSON lines sink includes its serialize and disk stages.
+- elements/sec and, when the input is read through a CountingReader,
+  bytes/sec
+- the peak resident set size, sampled with every progress check
+- optionally a cProfile dump of the whole run, which can be browsed with
+  pstats or snakeviz, or turned into a flamegraph with flameprof
+
+Progress lines are printed to stderr at a fixed interval, and summary()
+returns everything as a dictionary that write_json() saves for comparing
+runs across data refreshes. Nothing is timed when no RunStats is passed, so
+the uninstrumented pipeline keeps its speed.
+"""
+from __future__ import print_function
+
+import cProfile
+import json
+import os
+import sys
+import time
+from timeit import default_timer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Seconds between progress lines
+PROGRESS_INTERVAL = 10.0
+
+
+def current_rss_mb():
+    """Returns the resident set size of this process in MB, or None when it
+    cannot be read"""
+    try:
+        with open('/proc/self/statm') as fi:
+            pages = int(fi.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2.0 ** 20
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB"""
+    if resource is None:
+        return current_rss_mb()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2.0 ** 20 if sys.platform == 'darwin' else peak / 1024.0
+
+
+class Stage(object):
+    """Accumulated time and call count of one stage"""
+    __slots__ = ('seconds', 'calls')
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+
+
+class RunStats(object):
+    """Collects stage timings and throughput of a pipeline run
+
+    :param name: name of the run, printed in progress lines
+    :param progress: seconds between progress lines, None to stay quiet
+    :param profile: file name of a cProfile dump of the run, or None
+    :param stream: file object the progress lines are written to
+    """
+
+    def __init__(self, name, progress=PROGRESS_INTERVAL, profile=None, stream=None):
+        self.name = name
+        self.progress = progress
+        self.profile_file = profile
+        self.stream = stream or sys.stderr
+        self.stages = {}
+        self.elements = 0
+        self.bytes = 0
+        self.total_bytes = None
+        self.peak_rss = 0.0
+        self.extra = {}
+        self._profiler = None
+        self._start = self._end = None
+        self._next_check = None
+
+    def start(self):
+        self._start = default_timer()
+        self._next_check = self._start + (self.progress or PROGRESS_INTERVAL)
+        self.sample_rss()
+        if self.profile_file:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def stop(self):
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_file)
+            self._profiler = None
+        self._end = default_timer()
+        self.sample_rss()
+        self.peak_rss = max(self.peak_rss, peak_rss_mb() or 0.0)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def seconds(self):
+        if self._start is None:
+            return 0.0
+        return (self._end or default_timer()) - self._start
+
+    def stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage()
+        return stage
+
+    def timed(self, name, function):
+        """Wraps a function so its calls are timed as a stage"""
+        stage = self.stage(name)
+
+        def timed_function(*args, **kwargs):
+            start = default_timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stage.seconds += default_timer() - start
+                stage.calls += 1
+        return timed_function
+
+    def timed_iter(self, name, iterable):
+        """Wraps an iterable so the time to produce each item is timed as a
+        stage, every item is counted as an element and progress is reported"""
+        stage = self.stage(name)
+        iterator = iter(iterable)
+        while True:
+            start = default_timer()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                stage.seconds += default_timer() - start
+                return
+            now = default_timer()
+            stage.seconds += now - start
+            stage.calls += 1
+            self.elements += 1
+            if now >= self._next_check:
+                self.check(now)
+            yield item
+
+    def check(self, now=None):
+        """Samples the RSS and prints a progress line if one is due"""
+        now = now or default_timer()
+        self.sample_rss()
+        if self.progress:
+            print(self.progress_line(), file=self.stream)
+        self._next_check = now + (self.progress or PROGRESS_INTERVAL)
+
+    def sample_rss(self):
+        rss = current_rss_mb()
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss, rss)
+
+    def progress_line(self):
+        seconds = self.seconds or 1e-9
+        line = "[{0}] {1:,} elements {2:,.0f}/s".format(
+            self.name, self.elements, self.elements / seconds)
+        if self.bytes:
+            line += " {0:.1f} MB {1:.1f} MB/s".format(self.bytes / 2.0 ** 20,
+                                                       self.bytes / 2.0 ** 20 / seconds)
+            if self.total_bytes:
+                line += " ({0:.0%})".format(float(self.bytes) / self.total_bytes)
+        return line + " rss {0:.0f} MB".format(self.peak_rss)
+
+    def summary(self):
+        """Returns the results of the run as a JSON serializable dictionary"""
+        seconds = self.seconds
+        return {
+            'name': self.name,
+            'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'seconds': seconds,
+            'elements': self.elements,
+            'bytes': self.bytes,
+            'elements_per_sec': self.elements / seconds if seconds else 0.0,
+            'bytes_per_sec': self.bytes / seconds if seconds else 0.0,
+            'peak_rss_mb': self.peak_rss,
+            'stages': dict((name, {'seconds': stage.seconds,
+                                   'calls': stage.calls,
+                                   'share': stage.seconds / seconds if seconds else 0.0})
+                           for name, stage in self.stages.items() if stage.calls),
+            'profile': self.profile_file,
+            'extra': self.extra,
+        }
+
+    def write_json(self, filename):
+        with open(filename, 'w') as fo:
+            json.dump(self.summary(), fo, indent=2, sort_keys=True)
+
+
+class CountingReader(object):
+    """Binary file object that adds the number of bytes read to a RunStats
+
+    :param source: name or binary file object to read
+    :param stats: RunStats to update
+    """
+
+    def __init__(self, source, stats):
+        self._opened = not hasattr(source, 'read')
+        self._file = open(source, 'rb') if self._opened else source
+        self._stats = stats
+        if self._opened:
+            stats.total_bytes = os.path.getsize(source)
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._stats.bytes += len(data)
+        return data
+
+    def close(self):
+        if self._opened:
+            self._file.close()
+
+
+def add_arguments(parser):
+    """Adds the instrumentation options to an argparse parser"""
+    group = parser.add_argument_group('instrumentation')
+    group.add_argument('--stats', metavar='FILE', help="write a JSON summary of the run")
+    group.add_argument('--progress', type=float, metavar='SECONDS',
+                       help="print a progress line every SECONDS")
+    group.add_argument('--profile', metavar='FILE', help="write a cProfile dump of the run")
+
+
+def from_arguments(name, args):
+    """Returns a RunStats for the parsed options, None if none were given"""
+    if not (args.stats or args.progress or args.profile):
+        return None
+    return RunStats(name, args.progress, args.profile)
+
+
+def report(stats, args):
+    """Prints the final progress line and writes the JSON summary"""
+    if stats is None:
+        return
+    print(stats.progress_line(), file=stats.stream)
+    if args.stats:
+        stats.write_json(args.stats)
@@ -0,0 +1,229 @@
+"""
+Compact in-memory model of the shaped OSM elements
+
+data.shape_element turns every parsed element into a Node, Way or Relation
+instead of a nested dictionary. The classes use __slots__, so an element
+has no per-instance dictionary. Ids and version numbers are ints rather
+than strings, user names are interned, node references are packed in an
+int64 array, the created attributes are a tuple, and the free-form tags
+are a list of (key, value) pairs. Geometry, sinks and the change loader
+work on these objects, and the documents are only built at the output
+boundary by to_dict(), which returns exactly the dictionary shape_element
+used to return.
+
+The savings are on elements that are held: a ParquetSink row group or a
+MongoSink batch keeps about 60% of the bytes of the same dictionaries (see
+benchmark_model.py). The JSON lines sink holds one element at a time, and
+an element it would turn into a dictionary right away costs more than the
+dictionary alone, so on that path process_map shapes the dictionaries
+directly with data.shape_document. The document looks like:
+
+{"type": "node", "id": "2406124091",
+ "created": {"version": "2", ...},
+ "pos": [-87.6921867, 41.9757030],
+ "address": {"street": "...", "housenumber": "5157"},
+ "amenity": "restaurant", ...}
+"""
+import sys
+from array import array
+from collections import namedtuple
+
+if sys.version_info[0] < 3:
+    from __builtin__ import intern
+else:
+    intern = sys.intern
+
+CREATED = ('version', 'changeset', 'timestamp', 'user', 'uid')
+
+# Address parts with a slot of their own, others are kept as pairs
+ADDRESS_FIELDS = ('street', 'housenumber', 'postcode', 'city', 'country', 'place')
+
+# version, changeset and uid are ints
+Created = namedtuple('Created', CREATED)
+
+
+def make_created(attrib, _new=tuple.__new__):
+    """Returns the Created tuple of the attributes of an element"""
+    # tuple.__new__ skips the argument handling of the namedtuple constructor
+    return _new(Created, (int(attrib['version']), int(attrib['changeset']),
+                          attrib['timestamp'], intern(attrib['user']), int(attrib['uid'])))
+
+
+# ref is the id of the member as an int
+Member = namedtuple('Member', ['type', 'ref', 'role'])
+
+
+class Address(object):
+    """Address parts of an element, from its addr:* tags"""
+    __slots__ = ADDRESS_FIELDS + ('other',)
+
+    def __init__(self):
+        for field in ADDRESS_FIELDS:
+            setattr(self, field, None)
+        self.other = None
+
+    def set(self, key, value):
+        """Sets an address part, later parts replace earlier ones"""
+        if key in ADDRESS_FIELDS:
+            setattr(self, key, value)
+            return
+        if self.other is None:
+            self.other = []
+        else:
+            self.other = [(k, v) for k, v in self.other if k != key]
+        self.other.append((key, value))
+
+    def get(self, key, default=None):
+        if key in ADDRESS_FIELDS:
+            value = getattr(self, key)
+            return default if value is None else value
+        for k, v in self.other or ():
+            if k == key:
+                return v
+        return default
+
+    def to_dict(self):
+        doc = dict((field, getattr(self, field)) for field in ADDRESS_FIELDS
+                   if getattr(self, field) is not None)
+        if self.other:
+            doc.update(self.other)
+        return doc
+
+
+def address_dict(parts):
+    """Returns the dictionary of an Address whose parts are set in order,
+    without building the Address
+
+    :param parts: list of the (key, value) address parts
+    """
+    values = dict(parts)
+    doc = {field: values[field] for field in ADDRESS_FIELDS if field in values}
+    if len(doc) < len(values):
+        # the other parts follow in the order of their last setting
+        other = []
+        seen = set(doc)
+        for key, _ in reversed(parts):
+            if key not in seen:
+                seen.add(key)
+                other.append(key)
+        for key in reversed(other):
+            doc[key] = values[key]
+    return doc
+
+
+class Element(object):
+    """Fields shared by all shaped elements
+
+    :ivar id: element id
+    :ivar created: Created tuple
+    :ivar attrib: tuple of the (key, value) pairs of any other attributes,
+        such as visible, or None
+    :ivar address: Address or None
+    :ivar tags: list of (key, value) pairs of the other tags, keys already
+        in their output form, an empty tuple for untagged elements
+    :ivar geometry: dictionary of the resolved geometry fields, or None
+    """
+    __slots__ = ('id', 'created', 'attrib', 'address', 'tags', 'geometry')
+
+    type = None
+
+    def __init__(self, id, created, attrib=None):
+        self.id = id
+        self.created = created
+        self.attrib = attrib
+        self.address = None
+        self.tags = ()
+        self.geometry = None
+
+    def get(self, key, default=None):
+        """Returns the value of a tag by its output key"""
+        for k, v in self.tags:
+            if k == key:
+                return v
+        return default
+
+    def to_dict(self):
+        """Returns the document of the element"""
+        doc = {'type': self.type, 'id': str(self.id)}
+        if self.attrib:
+            doc.update(self.attrib)
+        version, changeset, timestamp, user, uid = self.created
+        doc['created'] = {'version': str(version), 'changeset': str(changeset),
+                          'timestamp': timestamp, 'user': user, 'uid': str(uid)}
+        self._add_location(doc)
+        if self.address is not None:
+            doc['address'] = self.address.to_dict()
+        doc.update(self.tags)
+        self._add_refs(doc)
+        if self.geometry:
+            doc.update(self.geometry)
+        return doc
+
+    def _add_location(self, doc):
+        pass
+
+    def _add_refs(self, doc):
+        pass
+
+
+class Node(Element):
+    __slots__ = ('lon', 'lat')
+
+    type = 'node'
+
+    def __init__(self, id, created, attrib=None, lon=None, lat=None):
+        super(Node, self).__init__(id, created, attrib)
+        self.lon = lon
+        self.lat = lat
+
+    def _add_location(self, doc):
+        if self.lon is not None:
+            doc['pos'] = [self.lon, self.lat]
+
+
+class Way(Element):
+    """:ivar node_refs: int64 array of the ids of the nodes of the way"""
+    __slots__ = ('node_refs',)
+
+    type = 'way'
+
+    def __init__(self, id, created, attrib=None, node_refs=None):
+        super(Way, self).__init__(id, created, attrib)
+        self.node_refs = array('q', node_refs or ())
+
+    def _add_refs(self, doc):
+        doc['node_refs'] = [str(ref) for ref in self.node_refs]
+
+
+class Relation(Element):
+    """:ivar members: list of the Members of the relation in document order"""
+    __slots__ = ('members',)
+
+    type = 'relation'
+
+    def __init__(self, id, created, attrib=None, members=None):
+        super(Relation, self).__init__(id, created, attrib)
+        self.members = members or []
+
+    def _add_refs(self, doc):
+        doc['members'] = [{'type': m.type, 'ref': str(m.ref), 'role': m.role}
+                          for m in self.members]
+
+
+ELEMENT_TYPES = {'node': Node, 'way': Way, 'relation': Relation}
+
+
+def to_document(doc):
+    """Returns the dictionary of a model element, dictionaries are returned
+    as they are"""
+    if isinstance(doc, Element):
+        return doc.to_dict()
+    return doc
+
+
+def default(obj):
+    """Returns the dictionary of a model element, the default hook of the
+    serializers, which encode dictionaries themselves"""
+    if isinstance(obj, Element):
+        return obj.to_dict()
+    raise TypeError("Object of type {0} is not JSON serializable".format(type(obj).__name__))
@@ -0,0 +1,656 @@
+"""
+On-disk node location index for resolving way geometries
+
+Node ids and coordinates are appended to two flat binary files while the
+nodes are streamed: an array of int64 ids and an array of int32 pairs
+holding lon/lat in units of 1e-7 degrees, the precision of OSM itself. That
+is 16 bytes per node instead of the hundreds a Python dict entry takes. The
+files are then memory mapped and ids are found by binary search, so tens of
+millions of nodes can be indexed without holding them in the Python heap.
+
+OSM files list nodes in ascending id order. Should a file not be sorted,
+the index is sorted once when the writer is closed, with an external merge
+sort whose memory is bounded by the size of its runs.
+
+Ways are indexed the same way once their geometry is resolved, an array of
+int64 way ids, an array of int64 end offsets and the int32 coordinates of
+all ways back to back, so multipolygon relations, which follow the ways,
+can assemble their rings from the member ways without keeping them in
+memory.
+"""
+import bisect
+import heapq
+import mmap
+import os
+import struct
+from array import array
+
+# Fixed point scale of the stored coordinates
+SCALE = 10 ** 7
+
+# Number of nodes buffered before they are appended to the files
+BUFFER_NODES = 64 * 1024
+
+# Number of nodes sorted in memory at a time when sorting an unsorted index,
+# and number of nodes read from each sorted run at a time while merging
+RUN_NODES = 512 * 1024
+MERGE_CHUNK_NODES = 4096
+
+
+class NodeIndexWriter(object):
+    """Appends node locations to the index files
+
+    :param path: base name of the index, the files path.ids and path.coords
+        are created
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.sorted = True
+        self._last_id = None
+        self._ids_file = open(path + '.ids', 'wb')
+        self._coords_file = open(path + '.coords', 'wb')
+        self._ids = array('q')
+        self._coords = array('i')
+
+    def add(self, node_id, lon, lat):
+        node_id = int(node_id)
+        if self._last_id is not None and node_id <= self._last_id:
+            self.sorted = False
+        self._last_id = node_id
+        self._ids.append(node_id)
+        self._coords.append(int(round(float(lon) * SCALE)))
+        self._coords.append(int(round(float(lat) * SCALE)))
+        self.count += 1
+        if len(self._ids) >= BUFFER_NODES:
+            self._flush()
+
+    def _flush(self):
+        self._ids.tofile(self._ids_file)
+        self._coords.tofile(self._coords_file)
+        self._ids = array('q')
+        self._coords = array('i')
+
+    def close(self):
+        """Writes the remaining nodes and sorts the index if needed
+
+        :return: NodeIndex opened on the finished files
+        """
+        if not self._ids_file.closed:
+            self._flush()
+            self._ids_file.close()
+            self._coords_file.close()
+            if not self.sorted:
+                _sort_index(self.path, self.count)
+                self.sorted = True
+        return NodeIndex(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _write_run(filename, ids, coords):
+    """Sorts a run of nodes by id and writes its ids followed by its coords"""
+    order = sorted(range(len(ids)), key=ids.__getitem__)
+    sorted_coords = array('i')
+    for i in order:
+        sorted_coords.append(coords[2 * i])
+        sorted_coords.append(coords[2 * i + 1])
+    with open(filename, 'wb') as fo:
+        array('q', (ids[i] for i in order)).tofile(fo)
+        sorted_coords.tofile(fo)
+
+
+def _iter_run(filename, count, run_no):
+    """Yields the (id, run number, lon, lat) of the nodes of a sorted run,
+    reading them in chunks"""
+    ids_size = array('q').itemsize
+    coords_size = 2 * array('i').itemsize
+    with open(filename, 'rb') as fi:
+        for start in range(0, count, MERGE_CHUNK_NODES):
+            n = min(MERGE_CHUNK_NODES, count - start)
+            ids = array('q')
+            fi.seek(start * ids_size)
+            ids.fromfile(fi, n)
+            coords = array('i')
+            fi.seek(count * ids_size + start * coords_size)
+            coords.fromfile(fi, 2 * n)
+            for i in range(n):
+                yield ids[i], run_no, coords[2 * i], coords[2 * i + 1]
+
+
+def _sort_index(path, count, run_nodes=RUN_NODES):
+    """Sorts the index files of an unsorted input
+
+    Runs of run_nodes nodes are sorted in memory and written to temporary
+    files, which are then merged into the index files. Equal ids keep their
+    input order, as the run number breaks ties.
+    """
+    runs = []
+    try:
+        with open(path + '.ids', 'rb') as ids_in, open(path + '.coords', 'rb') as coords_in:
+            for start in range(0, count, run_nodes):
+                n = min(run_nodes, count - start)
+                ids = array('q')
+                ids.fromfile(ids_in, n)
+                coords = array('i')
+                coords.fromfile(coords_in, 2 * n)
+                filename = '{0}.run{1}'.format(path, len(runs))
+                runs.append((filename, n))
+                _write_run(filename, ids, coords)
+                del ids, coords
+        merged = heapq.merge(*[_iter_run(filename, n, run_no)
+                               for run_no, (filename, n) in enumerate(runs)])
+        with open(path + '.ids', 'wb') as ids_out, open(path + '.coords', 'wb') as coords_out:
+            ids = array('q')
+            coords = array('i')
+            for node_id, _, lon, lat in merged:
+                ids.append(node_id)
+                coords.append(lon)
+                coords.append(lat)
+                if len(ids) >= BUFFER_NODES:
+                    ids.tofile(ids_out)
+                    coords.tofile(coords_out)
+                    ids = array('q')
+                    coords = array('i')
+            ids.tofile(ids_out)
+            coords.tofile(coords_out)
+    finally:
+        for filename, _ in runs:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+class _PackedArray(object):
+    """Read-only sequence of packed values in a buffer
+
+    Used where memoryview.cast is not available (Python 2) so that bisect can
+    still search the memory mapped ids.
+    """
+
+    def __init__(self, buf, fmt):
+        self._buf = buf
+        self._struct = struct.Struct(fmt)
+        self._len = len(buf) // self._struct.size
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        return self._struct.unpack_from(self._buf, i * self._struct.size)[0]
+
+
+def _view(buf, typecode):
+    try:
+        return memoryview(buf).cast(typecode)
+    except (AttributeError, TypeError):
+        return _PackedArray(buf, typecode)
+
+
+class _MappedIndex(object):
+    """Base of the memory mapped indexes, keeps the files and maps open until
+    the index is closed
+
+    :param path: base name of the index files
+    """
+
+    # suffixes of the index files
+    SUFFIXES = ()
+
+    def __init__(self, path):
+        self.path = path
+        self._files = []
+        self._maps = []
+        self._views = []
+
+    def _map(self, filename, typecode):
+        if os.path.getsize(filename) == 0:
+            return []
+        fi = open(filename, 'rb')
+        mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        self._files.append(fi)
+        self._maps.append(mm)
+        view = _view(mm, typecode)
+        self._views.append(view)
+        return view
+
+    def _find(self, ids, key):
+        """Returns the position of an id in the sorted ids, or None"""
+        key = int(key)
+        i = bisect.bisect_left(ids, key)
+        if i < len(ids) and ids[i] == key:
+            return i
+        return None
+
+    def close(self):
+        # release the views before the maps they point into
+        for view in self._views:
+            if isinstance(view, memoryview):
+                view.release()
+        self._views = []
+        self._clear()
+        for mm in self._maps:
+            mm.close()
+        for fi in self._files:
+            fi.close()
+        self._maps, self._files = [], []
+
+    def _clear(self):
+        """Drops the references to the released views"""
+
+    def remove(self):
+        """Closes the index and deletes its files"""
+        self.close()
+        for suffix in self.SUFFIXES:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class NodeIndex(_MappedIndex):
+    """Memory mapped lookup of node locations by id
+
+    :param path: base name of the index written by NodeIndexWriter
+    """
+
+    SUFFIXES = ('.ids', '.coords')
+
+    def __init__(self, path):
+        super(NodeIndex, self).__init__(path)
+        self._ids = self._map(path + '.ids', 'q')
+        self._coords = self._map(path + '.coords', 'i')
+
+    def _clear(self):
+        self._ids = self._coords = []
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get(self, node_id):
+        """Returns the (lon, lat) of a node, or None if it is not indexed"""
+        i = self._find(self._ids, node_id)
+        if i is None:
+            return None
+        return (self._coords[2 * i] / float(SCALE), self._coords[2 * i + 1] / float(SCALE))
+
+    def get_many(self, node_ids):
+        """Returns the locations of several nodes, None for missing nodes"""
+        return [self.get(node_id) for node_id in node_ids]
+
+
+class WayIndexWriter(object):
+    """Appends the resolved coordinates of ways to the index files
+
+    :param path: base name of the index, the files path.ids, path.offsets
+        and path.coords are created
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.sorted = True
+        self._last_id = None
+        self._end = 0
+        self._ids_file = open(path + '.ids', 'wb')
+        self._offsets_file = open(path + '.offsets', 'wb')
+        self._coords_file = open(path + '.coords', 'wb')
+        self._ids = array('q')
+        self._offsets = array('q')
+        self._coords = array('i')
+
+    def add(self, way_id, coords):
+        """Adds a way
+
+        :param way_id: id of the way
+        :param coords: list of the (lon, lat) of its nodes, as returned by
+            way_geometry
+        """
+        way_id = int(way_id)
+        if self._last_id is not None and way_id <= self._last_id:
+            self.sorted = False
+        self._last_id = way_id
+        self._ids.append(way_id)
+        for lon, lat in coords:
+            self._coords.append(int(round(lon * SCALE)))
+            self._coords.append(int(round(lat * SCALE)))
+        self._end += len(coords)
+        self._offsets.append(self._end)
+        self.count += 1
+        if len(self._ids) >= BUFFER_NODES:
+            self._flush()
+
+    def _flush(self):
+        self._ids.tofile(self._ids_file)
+        self._offsets.tofile(self._offsets_file)
+        self._coords.tofile(self._coords_file)
+        self._ids = array('q')
+        self._offsets = array('q')
+        self._coords = array('i')
+
+    def close(self):
+        """Writes the remaining ways and sorts the index if needed
+
+        :return: WayIndex opened on the finished files
+        """
+        if not self._ids_file.closed:
+            self._flush()
+            self._ids_file.close()
+            self._offsets_file.close()
+            self._coords_file.close()
+            if not self.sorted:
+                _sort_ways(self.path, self.count)
+                self.sorted = True
+        return WayIndex(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _write_way_run(filename, ids, ends, coords):
+    """Sorts a run of ways by id and writes its ids, end offsets and coords"""
+    order = sorted(range(len(ids)), key=ids.__getitem__)
+    sorted_ends = array('q')
+    sorted_coords = array('i')
+    for i in order:
+        start = ends[i - 1] if i else 0
+        sorted_coords.extend(coords[2 * start:2 * ends[i]])
+        sorted_ends.append(len(sorted_coords) // 2)
+    with open(filename, 'wb') as fo:
+        array('q', (ids[i] for i in order)).tofile(fo)
+        sorted_ends.tofile(fo)
+        sorted_coords.tofile(fo)
+
+
+def _iter_way_run(filename, count, run_no):
+    """Yields the (id, run number, coords) of the ways of a sorted run,
+    reading them in chunks"""
+    size = array('q').itemsize
+    pair_size = 2 * array('i').itemsize
+    with open(filename, 'rb') as fi:
+        first = 0
+        for start in range(0, count, MERGE_CHUNK_NODES):
+            n = min(MERGE_CHUNK_NODES, count - start)
+            ids = array('q')
+            fi.seek(start * size)
+            ids.fromfile(fi, n)
+            ends = array('q')
+            fi.seek((count + start) * size)
+            ends.fromfile(fi, n)
+            coords = array('i')
+            fi.seek(2 * count * size + first * pair_size)
+            coords.fromfile(fi, 2 * (ends[-1] - first))
+            previous = first
+            for i in range(n):
+                yield ids[i], run_no, coords[2 * (previous - first):2 * (ends[i] - first)]
+                previous = ends[i]
+            first = ends[-1]
+
+
+def _sort_ways(path, count, run_pairs=RUN_NODES):
+    """Sorts the way index files of an unsorted input
+
+    The external merge sort of _sort_index, with runs holding run_pairs
+    coordinate pairs or RUN_NODES ways, whichever comes first, so a run
+    holds at least one way however long it is.
+    """
+    runs = []
+    try:
+        with open(path + '.ids', 'rb') as ids_in, open(path + '.offsets', 'rb') as ends_in, \
+                open(path + '.coords', 'rb') as coords_in:
+            ids, ends, coords = array('q'), array('q'), array('i')
+            # end offset of the ways read so far and of the ways of the
+            # previous runs, the offsets in a run start from its first pair
+            end = run_first = 0
+            for start in range(0, count, MERGE_CHUNK_NODES):
+                n = min(MERGE_CHUNK_NODES, count - start)
+                ids.fromfile(ids_in, n)
+                chunk_ends = array('q')
+                chunk_ends.fromfile(ends_in, n)
+                coords.fromfile(coords_in, 2 * (chunk_ends[-1] - end))
+                ends.extend(chunk_end - run_first for chunk_end in chunk_ends)
+                end = chunk_ends[-1]
+                if len(ids) >= RUN_NODES or len(coords) >= 2 * run_pairs or start + n == count:
+                    filename = '{0}.run{1}'.format(path, len(runs))
+                    runs.append((filename, len(ids)))
+                    _write_way_run(filename, ids, ends, coords)
+                    ids, ends, coords = array('q'), array('q'), array('i')
+                    run_first = end
+        merged = heapq.merge(*[_iter_way_run(filename, n, run_no)
+                               for run_no, (filename, n) in enumerate(runs)])
+        with open(path + '.ids', 'wb') as ids_out, open(path + '.offsets', 'wb') as ends_out, \
+                open(path + '.coords', 'wb') as coords_out:
+            ids, ends, coords = array('q'), array('q'), array('i')
+            end = 0
+            for way_id, _, way_coords in merged:
+                ids.append(way_id)
+                coords.extend(way_coords)
+                end += len(way_coords) // 2
+                ends.append(end)
+                if len(ids) >= BUFFER_NODES or len(coords) >= 2 * BUFFER_NODES:
+                    ids.tofile(ids_out)
+                    ends.tofile(ends_out)
+                    coords.tofile(coords_out)
+                    ids, ends, coords = array('q'), array('q'), array('i')
+            ids.tofile(ids_out)
+            ends.tofile(ends_out)
+            coords.tofile(coords_out)
+    finally:
+        for filename, _ in runs:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+class WayIndex(_MappedIndex):
+    """Memory mapped lookup of way coordinates by id
+
+    :param path: base name of the index written by WayIndexWriter
+    """
+
+    SUFFIXES = ('.ids', '.offsets', '.coords')
+
+    def __init__(self, path):
+        super(WayIndex, self).__init__(path)
+        self._ids = self._map(path + '.ids', 'q')
+        self._offsets = self._map(path + '.offsets', 'q')
+        self._coords = self._map(path + '.coords', 'i')
+
+    def _clear(self):
+        self._ids = self._offsets = self._coords = []
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get(self, way_id):
+        """Returns the list of (lon, lat) of a way, or None if it is not indexed"""
+        i = self._find(self._ids, way_id)
+        if i is None:
+            return None
+        start = self._offsets[i - 1] if i else 0
+        coords = self._coords
+        return [(coords[2 * j] / float(SCALE), coords[2 * j + 1] / float(SCALE))
+                for j in range(start, self._offsets[i])]
+
+
+def way_geometry(node_refs, index):
+    """Resolves the geometry of a way from its node references
+
+    The centroid of a closed way is the centroid of the enclosed area, for
+    open ways (or degenerate areas) it is the mean of the vertices.
+    :param node_refs: list of node ids of the way
+    :param index: NodeIndex to look the nodes up in
+    :return: dictionary with the geometry, bbox and centroid of the way, or
+        None if none of its nodes are indexed
+    """
+    coords = [c for c in index.get_many(node_refs) if c is not None]
+    if not coords:
+        return None
+    lons = [c[0] for c in coords]
+    lats = [c[1] for c in coords]
+    bbox = [min(lons), min(lats), max(lons), max(lats)]
+    centroid = None
+    if len(coords) > 3 and coords[0] == coords[-1]:
+        centroid = _area_centroid(coords)
+    if centroid is None:
+        vertices = coords[:-1] if len(coords) > 1 and coords[0] == coords[-1] else coords
+        centroid = [sum(c[0] for c in vertices) / len(vertices),
+                    sum(c[1] for c in vertices) / len(vertices)]
+    return {'geometry': [list(c) for c in coords], 'bbox': bbox, 'centroid': centroid}
+
+
+def _area_centroid(ring):
+    """Centroid of a closed ring by the shoelace formula, None if its area is 0"""
+    area, cx, cy = _shoelace(ring)
+    if area == 0:
+        return None
+    x0, y0 = ring[0]
+    return [x0 + cx / (3.0 * area), y0 + cy / (3.0 * area)]
+
+
+def _shoelace(ring):
+    """Twice the signed area of a closed ring and the sums of the centroid
+    formula, relative to its first vertex"""
+    area = cx = cy = 0.0
+    x0, y0 = ring[0]
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+        # offset by the first vertex to reduce rounding errors
+        x1, y1, x2, y2 = x1 - x0, y1 - y0, x2 - x0, y2 - y0
+        cross = x1 * y2 - x2 * y1
+        area += cross
+        cx += (x1 + x2) * cross
+        cy += (y1 + y2) * cross
+    return area, cx, cy
+
+
+def _ring_moments(ring):
+    """Signed area of a closed ring and its area weighted centroid
+
+    :return: tuple of the area and the x and y of the centroid multiplied
+        by the area
+    """
+    area, cx, cy = _shoelace(ring)
+    x0, y0 = ring[0]
+    return area / 2.0, area / 2.0 * x0 + cx / 6.0, area / 2.0 * y0 + cy / 6.0
+
+
+# Values of the type tag of the relations whose members form areas
+AREA_RELATIONS = ('multipolygon', 'boundary')
+
+
+def assemble_rings(segments):
+    """Joins way segments end to end into closed rings
+
+    Members of large areas are split into several ways that share their end
+    nodes, in any order and direction.
+    :param segments: list of coordinate lists
+    :return: tuple of the list of closed rings and the number of segments
+        that could not be closed
+    """
+    rings = []
+    pending = []
+    for segment in segments:
+        if len(segment) >= 4 and segment[0] == segment[-1]:
+            rings.append(list(segment))
+        elif len(segment) >= 2:
+            pending.append(segment)
+    unclosed = 0
+    while pending:
+        ring = list(pending.pop())
+        joined = 1
+        while ring[0] != ring[-1]:
+            for i, segment in enumerate(pending):
+                if segment[0] == ring[-1]:
+                    ring.extend(segment[1:])
+                    break
+                if segment[-1] == ring[-1]:
+                    ring.extend(segment[-2::-1])
+                    break
+            else:
+                break
+            del pending[i]
+            joined += 1
+        if len(ring) >= 4 and ring[0] == ring[-1]:
+            rings.append(ring)
+        else:
+            unclosed += joined
+    return rings, unclosed
+
+
+def _contains(ring, point):
+    """Tests whether a point lies inside a closed ring by ray casting"""
+    x, y = point
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+
+def multipolygon_geometry(members, index):
+    """Resolves the rings of a multipolygon or boundary relation
+
+    The outer and inner member ways are looked up in the way index and
+    joined into closed rings, every inner ring is assigned to the outer ring
+    that contains it. Members with an empty role count as outer, as they do
+    in old multipolygons. The centroid is that of the area enclosed by the
+    outer rings minus the inner rings.
+    :param members: list of model.Members of the relation
+    :param index: WayIndex to look the ways up in
+    :return: dictionary with the multipolygon, a list of polygons each made
+        of an outer ring followed by its inner rings, its bbox, centroid and
+        the number of member ways that could not be resolved or closed, or
+        None if no ring could be closed
+    """
+    outer, inner = [], []
+    missing = 0
+    for member in members:
+        if member.type != 'way' or member.role not in ('outer', 'inner', ''):
+            continue
+        coords = index.get(member.ref)
+        if not coords:
+            missing += 1
+            continue
+        (inner if member.role == 'inner' else outer).append(coords)
+    outer, unclosed = assemble_rings(outer)
+    if not outer:
+        return None
+    inner, inner_unclosed = assemble_rings(inner)
+    polygons = [[ring] for ring in outer]
+    for ring in inner:
+        for polygon in polygons:
+            if _contains(polygon[0], ring[0]):
+                polygon.append(ring)
+                break
+        else:
+            inner_unclosed += 1
+
+    area = cx = cy = 0.0
+    for polygon in polygons:
+        for i, ring in enumerate(polygon):
+            ring_area, ring_cx, ring_cy = _ring_moments(ring)
+            # rings may wind either way, the inner ones are holes
+            sign = (1 if ring_area > 0 else -1) * (-1 if i else 1)
+            area += sign * ring_area
+            cx += sign * ring_cx
+            cy += sign * ring_cy
+    lons = [c[0] for polygon in polygons for c in polygon[0]]
+    lats = [c[1] for polygon in polygons for c in polygon[0]]
+    if area:
+        centroid = [cx / area, cy / area]
+    else:
+        centroid = [sum(lons) / len(lons), sum(lats) / len(lats)]
+    return {'multipolygon': [[[list(c) for c in ring] for ring in polygon] for polygon in polygons],
+            'bbox': [min(lons), min(lats), max(lons), max(lats)],
+            'centroid': centroid,
+            'unresolved_members': missing + unclosed + inner_unclosed}
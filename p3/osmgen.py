@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Deterministic synthetic OpenStreetMap file generator
+
+Writes OSM XML in the one-element-per-line layout of the real exports, with
+nodes spread over Naples followed by ways referencing them and optionally
+multipolygon and boundary relations whose outer rings are split over
+several ways. A fraction of
+the elements carry address, cuisine, phone and amenity tags, and a fraction
+of those values are dirty in the ways audit.py finds and fixes: lowercase
+and misspelled street types, spelled out Roman numerals, abbreviated names,
+phone numbers without country code or with dashes, spaces and stray
+characters, and compound cuisine values. The same seed and options always
+produce the same bytes, so benchmark inputs can be regenerated anywhere.
+
+Usage:
+    python osmgen.py napoli_100mb.osm --size 100MB
+    python osmgen.py small.osm --nodes 10000 --ways 1000 --tag-density 0.5
+    python osmgen.py areas.osm --nodes 10000 --relations 500
+"""
+import argparse
+import os
+import random
+import re
+
+# Area the nodes are spread over
+EXTENT = (14.1, 40.75, 14.4, 40.95)
+
+CREATED = 'version="{0}" changeset="{1}" timestamp="2017-{2:02d}-{3:02d}T{4:02d}:00:00Z" user="{5}" uid="{6}"'
+USERS = ["linuxUser16", "napoli_mapper", "bench", "osm_it", "Vesuvio"]
+
+STREET_TYPES = ["Via", "Vico", "Piazza", "Corso", "Largo", "Salita", "Traversa", "Vicoletto", "Calata"]
+STREET_NAMES = ["Toledo", "Roma", "Chiaia", "dei Tribunali", "Cappuccini", "Santa Lucia",
+                "San Gregorio Armeno", "Duomo", "Foria", "Umberto I", "Garibaldi", "Mergellina"]
+# Dirty street names as found in the Naples extract, fixed by update_street_name
+# and update_short_name
+DIRTY_STREETS = [
+    lambda rng: "{0} {1}".format(rng.choice(STREET_TYPES), rng.choice(STREET_NAMES)).lower(),
+    lambda rng: "Viia {0}".format(rng.choice(STREET_NAMES)),
+    lambda rng: "Prima Traversa {0}".format(rng.choice(STREET_NAMES)),
+    lambda rng: "Seconda Traversa {0}".format(rng.choice(STREET_NAMES)),
+    lambda rng: "ii traversa {0}".format(rng.choice(STREET_NAMES).lower()),
+    lambda rng: "Via S. Angelo",
+    lambda rng: "Via A. De Gasperi",
+    lambda rng: "Piazza G. Di Vittorio",
+    lambda rng: "Vico S.Agnese",
+    lambda rng: "Via B. V. Romano",
+    lambda rng: "Parco {0}".format(rng.choice(STREET_NAMES)),
+]
+
+CUISINES = ["pizza", "italian", "regional", "seafood", "coffee_shop", "sushi", "burger"]
+DIRTY_CUISINES = ["italian_pizza", "regional,_italian", "regional,_italian;pizza",
+                  "pizza;italian_pizza", "seafood;regional,_italian"]
+AMENITIES = ["restaurant", "cafe", "bar", "pharmacy", "school", "bank", "fast_food"]
+HIGHWAYS = ["residential", "primary", "secondary", "footway", "service", "pedestrian"]
+LANDUSES = ["residential", "commercial", "grass", "industrial", "retail"]
+QUARTIERI = ["Chiaia", "San Ferdinando", "Posillipo", "Vomero", "Arenella", "Stella",
+             "San Lorenzo", "Fuorigrotta", "Bagnoli", "Pianura"]
+
+
+def _phone(rng, dirty):
+    """Returns a clean +39 number or one of the malformed variants"""
+    local = "{0:07d}".format(rng.randint(0, 9999999))
+    if not dirty:
+        return "+39 081 " + local
+    return rng.choice([
+        "081 " + local,
+        "81" + local,
+        "081-{0}-{1}".format(local[:3], local[3:]),
+        "+39 081 {0} {1}".format(local[:3], local[3:]),
+        "+39{0}".format(rng.randint(3000000000, 3999999999)),
+        "(081) " + local,
+        "081 {0}".format(local[:3]),
+        "+39 081 {0};+39 081 {1}".format(local, local[::-1]),
+    ])
+
+
+def _street(rng, dirty):
+    if dirty:
+        return rng.choice(DIRTY_STREETS)(rng)
+    return "{0} {1}".format(rng.choice(STREET_TYPES), rng.choice(STREET_NAMES))
+
+
+def _escape(value):
+    return (value.replace('&', '&amp;').replace('"', '&quot;')
+            .replace('<', '&lt;').replace('>', '&gt;'))
+
+
+class OsmGenerator(object):
+    """Writes synthetic OSM files
+
+    :param seed: random seed, the output only depends on it and the options
+    :param tag_density: fraction of nodes and ways that carry tags
+    :param dirty: fraction of tag values written in a malformed variant
+    """
+
+    def __init__(self, seed=0, tag_density=0.2, dirty=0.3):
+        self.seed = seed
+        self.tag_density = tag_density
+        self.dirty = dirty
+
+    def _created(self, rng):
+        return CREATED.format(rng.randint(1, 9), rng.randint(1, 50000000), rng.randint(1, 12),
+                              rng.randint(1, 28), rng.randint(0, 23), rng.choice(USERS),
+                              rng.randint(1, 3000000))
+
+    def _tag(self, k, v):
+        return '  <tag k="{0}" v="{1}"/>\n'.format(k, _escape(v))
+
+    def _node_tags(self, rng):
+        dirty = self.dirty
+        tags = [self._tag('addr:street', _street(rng, rng.random() < dirty)),
+                self._tag('addr:housenumber', str(rng.randint(1, 300)))]
+        if rng.random() < 0.3:
+            tags.append(self._tag('addr:postcode', "801{0:02d}".format(rng.randint(0, 47))))
+        if rng.random() < 0.5:
+            amenity = rng.choice(AMENITIES)
+            tags.append(self._tag('amenity', amenity))
+            tags.append(self._tag('name', "{0} {1}".format(amenity.title(), rng.choice(STREET_NAMES))))
+            if amenity in ('restaurant', 'fast_food'):
+                cuisine = (rng.choice(DIRTY_CUISINES) if rng.random() < dirty
+                           else rng.choice(CUISINES))
+                tags.append(self._tag('cuisine', cuisine))
+            tags.append(self._tag('phone', _phone(rng, rng.random() < dirty)))
+        return tags
+
+    def _way_tags(self, rng):
+        tags = [self._tag('highway', rng.choice(HIGHWAYS))]
+        tags.append(self._tag('name', _street(rng, rng.random() < self.dirty)))
+        return tags
+
+    def _area_parts(self, rng, nodes):
+        """Returns the member ways of an area relation as (role, refs) pairs,
+        the outer ring split in two ways listed in either direction and an
+        optional closed inner ring"""
+        refs = [rng.randint(1, max(nodes, 1)) for _ in range(rng.randint(4, 10))]
+        cut = rng.randint(1, len(refs) - 2)
+        parts = [refs[:cut + 1], refs[cut:] + refs[:1]]
+        parts = [('outer', part[::-1] if rng.random() < 0.5 else part) for part in parts]
+        if rng.random() < 0.3:
+            inner = [rng.randint(1, max(nodes, 1)) for _ in range(3)]
+            parts.append(('inner', inner + inner[:1]))
+        return parts
+
+    def _relation_tags(self, rng, index, boundary):
+        if boundary:
+            return [self._tag('type', 'boundary'), self._tag('boundary', 'administrative'),
+                    self._tag('admin_level', '10'),
+                    self._tag('name', QUARTIERI[index % len(QUARTIERI)])]
+        return [self._tag('type', 'multipolygon'), self._tag('landuse', rng.choice(LANDUSES))]
+
+    def write(self, fo, nodes, ways, relations=0):
+        """Writes an OSM document to a text file object
+
+        :param fo: file object to write to
+        :param nodes: number of nodes
+        :param ways: number of ways
+        :param relations: number of multipolygon and boundary relations, each
+            adds two or three member ways after the other ways
+        :return: No return value
+        """
+        rng = random.Random(self.seed)
+        min_lon, min_lat, max_lon, max_lat = EXTENT
+        fo.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        fo.write('<osm version="0.6" generator="osmgen">\n')
+        fo.write(' <bounds minlat="{1}" minlon="{0}" maxlat="{3}" maxlon="{2}"/>\n'.format(*EXTENT))
+        for i in range(1, nodes + 1):
+            attrs = 'id="{0}" lat="{1:.7f}" lon="{2:.7f}" {3}'.format(
+                i, rng.uniform(min_lat, max_lat), rng.uniform(min_lon, max_lon), self._created(rng))
+            if rng.random() < self.tag_density:
+                fo.write(' <node {0}>\n'.format(attrs))
+                fo.writelines(self._node_tags(rng))
+                fo.write(' </node>\n')
+            else:
+                fo.write(' <node {0}/>\n'.format(attrs))
+        for i in range(1, ways + 1):
+            fo.write(' <way id="{0}" {1}>\n'.format(i, self._created(rng)))
+            refs = [rng.randint(1, max(nodes, 1)) for _ in range(rng.randint(2, 12))]
+            if rng.random() < 0.3:
+                # closed way, e.g. a building outline
+                refs.append(refs[0])
+            fo.writelines('  <nd ref="{0}"/>\n'.format(ref) for ref in refs)
+            if rng.random() < self.tag_density:
+                fo.writelines(self._way_tags(rng))
+            fo.write(' </way>\n')
+        members = []
+        way_id = ways
+        for i in range(relations):
+            members.append([])
+            for role, refs in self._area_parts(rng, nodes):
+                way_id += 1
+                fo.write(' <way id="{0}" {1}>\n'.format(way_id, self._created(rng)))
+                fo.writelines('  <nd ref="{0}"/>\n'.format(ref) for ref in refs)
+                fo.write(' </way>\n')
+                members[-1].append(('way', way_id, role))
+        for i in range(1, relations + 1):
+            fo.write(' <relation id="{0}" {1}>\n'.format(i, self._created(rng)))
+            relation_members = members[i - 1]
+            boundary = rng.random() < 0.2
+            if boundary:
+                relation_members = relation_members + [
+                    ('node', rng.randint(1, max(nodes, 1)), 'admin_centre')]
+            fo.writelines('  <member type="{0}" ref="{1}" role="{2}"/>\n'.format(*member)
+                          for member in relation_members)
+            fo.writelines(self._relation_tags(rng, i, boundary))
+            fo.write(' </relation>\n')
+        fo.write('</osm>\n')
+
+    def counts_for_size(self, size, ways_per_node=0.1):
+        """Estimates the node and way counts that produce a file of about
+        size bytes by measuring a small sample"""
+        sample_nodes = 2000
+        sample_ways = int(sample_nodes * ways_per_node)
+
+        class _Counter(object):
+            length = 0
+
+            def write(self, data):
+                self.length += len(data)
+
+            def writelines(self, lines):
+                for line in lines:
+                    self.length += len(line)
+
+        counter = _Counter()
+        self.write(counter, sample_nodes, sample_ways)
+        per_node = counter.length / float(sample_nodes)
+        nodes = max(1, int(size / per_node))
+        return nodes, int(nodes * ways_per_node)
+
+    def generate(self, filename, nodes=None, ways=None, size=None, relations=0):
+        """Writes a synthetic OSM file
+
+        :param filename: name of the file to write
+        :param nodes: number of nodes
+        :param ways: number of ways, a tenth of the nodes if None
+        :param size: approximate file size in bytes, overrides nodes and ways
+        :param relations: number of area relations
+        :return: tuple of the node and way counts written
+        """
+        if size is not None:
+            nodes, ways = self.counts_for_size(size)
+        if ways is None:
+            ways = nodes // 10
+        with open(filename, 'w') as fo:
+            self.write(fo, nodes, ways, relations)
+        return nodes, ways
+
+
+def write_osm(filename, nodes=None, ways=None, size=None, seed=0, tag_density=0.2, dirty=0.3,
+              relations=0):
+    """Writes a synthetic OSM file, see OsmGenerator"""
+    generator = OsmGenerator(seed, tag_density, dirty)
+    return generator.generate(filename, nodes, ways, size, relations)
+
+
+def parse_size(value):
+    """Parses a size such as 10MB, 1GB or 500000 into a number of bytes"""
+    m = re.match(r'^\s*([\d.]+)\s*([kmg]?)b?\s*$', value, re.IGNORECASE)
+    if m is None:
+        raise ValueError("Invalid size {0!r}".format(value))
+    return int(float(m.group(1)) * 1024 ** ' kmg'.index(m.group(2).lower() or ' '))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic OSM file")
+    parser.add_argument('osmfile')
+    parser.add_argument('--size', type=parse_size, help="approximate file size, e.g. 100MB")
+    parser.add_argument('--nodes', type=int, default=100000)
+    parser.add_argument('--ways', type=int, help="defaults to a tenth of the nodes")
+    parser.add_argument('--tag-density', type=float, default=0.2,
+                        help="fraction of elements with tags")
+    parser.add_argument('--dirty', type=float, default=0.3,
+                        help="fraction of tag values that need cleaning")
+    parser.add_argument('--relations', type=int, default=0,
+                        help="number of multipolygon and boundary relations")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    nodes, ways = write_osm(args.osmfile, args.nodes, args.ways, args.size, args.seed,
+                            args.tag_density, args.dirty, args.relations)
+    print("{0}: {1} nodes, {2} ways, {3} relations, {4:.1f} MB".format(
+        args.osmfile, nodes, ways, args.relations, os.path.getsize(args.osmfile) / 2.0 ** 20))
+
+
+if __name__ == '__main__':
+    main()
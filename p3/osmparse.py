@@ -0,0 +1,272 @@
+"""
+Pluggable parser backends for streaming OSM files
+
+Every backend yields complete top level elements one at a time and releases
+them once the consumer moves on, so memory stays bounded by the size of a
+single element. The yielded objects all provide the small part of the
+ElementTree API used by the audit and shaping code: tag, attrib, iter() and
+findall().
+
+Backends:
+    etree: the standard library (c)ElementTree iterparse
+    lxml:  lxml.etree.iterparse filtered on the top level tags
+    expat: a raw expat handler that builds lightweight OsmElement objects
+           without creating an Element tree at all
+
+The module also splits files into byte ranges on top level element
+boundaries (chunk_offsets, ChunkFile) so they can be parsed in parallel.
+"""
+import os
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+from xml.parsers import expat
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+DEFAULT_BACKEND = 'etree'
+
+# Number of bytes fed to the expat parser at a time
+READ_SIZE = 64 * 1024
+
+# Top level element types of an OSM file
+TOP_LEVEL = ('node', 'way', 'relation')
+
+# Top level elements a chunk boundary may be placed in front of
+TOP_LEVEL_STARTS = (b'<node', b'<way', b'<relation', b'</osm')
+
+# Default size of the byte ranges handed to each worker
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def iterelements(source, tag_types=TOP_LEVEL, backend=DEFAULT_BACKEND):
+    """Creates a generator to yield complete top level elements
+
+    :param source: name or binary file object of the OpenStreetMap file
+    :param tag_types: type of top level elements to yield
+    :param backend: name of the parser backend, one of BACKENDS
+    :return: yields a top level element
+    """
+    try:
+        parse = BACKENDS[backend]
+    except KeyError:
+        raise ValueError("Unknown parser backend '{0}', expected one of {1}".format(
+            backend, ', '.join(sorted(BACKENDS))))
+    return parse(source, tag_types)
+
+
+def iter_etree(source, tag_types):
+    """ElementTree backend
+
+    Elements are yielded on their 'end' event so that all of their children
+    have been parsed, and the root is cleared after every top level element.
+    """
+    context = ET.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+    depth = 0
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 0:
+            # A direct child of the root has been completely parsed
+            if elem.tag in tag_types:
+                yield elem
+            root.clear()
+
+
+def iter_lxml(source, tag_types):
+    """lxml backend
+
+    lxml filters the events on the requested tags in C, so only the wanted
+    top level elements reach Python. Processed elements and their preceding
+    siblings are deleted to keep the tree empty.
+    """
+    if lxml_etree is None:
+        raise ImportError("The lxml backend requires the lxml package")
+    for _, elem in lxml_etree.iterparse(source, events=('end',), tag=list(tag_types)):
+        if elem.getparent() is None:
+            # the root itself matched one of the requested tags
+            continue
+        yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+class OsmElement(object):
+    """Minimal element built by the expat backend
+
+    Provides the tag, attrib, iter and findall members that the audit and
+    shaping code use on ElementTree elements.
+    """
+    __slots__ = ('tag', 'attrib', 'children')
+
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = []
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def findall(self, tag):
+        return [child for child in self.children if child.tag == tag]
+
+    def iter(self, tag=None):
+        if tag is None or self.tag == tag:
+            yield self
+        for child in self.children:
+            if tag is None or child.tag == tag:
+                yield child
+
+    def __repr__(self):
+        return "<OsmElement {0} {1}>".format(self.tag, self.attrib.get('id', ''))
+
+
+class _ExpatHandler(object):
+    """Collects top level OsmElements from expat callbacks"""
+
+    def __init__(self, tag_types):
+        self.tag_types = tag_types
+        self.depth = 0
+        self.current = None
+        self.ready = []
+
+    def start(self, name, attrib):
+        self.depth += 1
+        if self.depth == 2:
+            if name in self.tag_types:
+                self.current = OsmElement(name, attrib)
+        elif self.depth == 3 and self.current is not None:
+            self.current.children.append(OsmElement(name, attrib))
+
+    def end(self, name):
+        if self.depth == 2 and self.current is not None:
+            self.ready.append(self.current)
+            self.current = None
+        self.depth -= 1
+
+
+def iter_expat(source, tag_types):
+    """expat backend
+
+    Feeds the file to expat in fixed size blocks and yields the elements
+    completed by each block, so only one block of elements is held at a time.
+    """
+    handler = _ExpatHandler(tag_types)
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    parser.buffer_text = True
+
+    opened = not hasattr(source, 'read')
+    fi = open(source, 'rb') if opened else source
+    try:
+        while True:
+            data = fi.read(READ_SIZE)
+            parser.Parse(data, not data)
+            for elem in handler.ready:
+                yield elem
+            del handler.ready[:]
+            if not data:
+                break
+    finally:
+        if opened:
+            fi.close()
+
+
+def chunk_offsets(file_in, chunk_size=CHUNK_SIZE):
+    """Splits an OSM file into byte ranges on top level element boundaries
+
+    Seeks to every multiple of chunk_size and moves forward to the start of
+    the next line that opens a node, way or relation, so every range contains
+    only whole top level elements. The final range ends at the closing </osm>
+    tag. This relies on the one-element-per-line layout used by OSM exports.
+    :param file_in: name of the OpenStreetMap file to split
+    :param chunk_size: approximate size of each range in bytes
+    :return: list of (start, end) byte offsets
+    """
+    size = os.path.getsize(file_in)
+    starts = []
+    end = None
+    with open(file_in, 'rb') as fi:
+        for offset in range(0, size, chunk_size):
+            fi.seek(offset)
+            if offset:
+                # skip the remainder of the line the offset landed in
+                fi.readline()
+            pos, line = _next_top_level(fi)
+            if not line or line.lstrip().startswith(b'</osm'):
+                end = pos
+                break
+            if not starts or pos > starts[-1]:
+                starts.append(pos)
+        if end is None and starts:
+            # scan forward from the last chunk for the closing root tag
+            fi.seek(starts[-1])
+            fi.readline()
+            end, line = _next_top_level(fi)
+            while line and not line.lstrip().startswith(b'</osm'):
+                end, line = _next_top_level(fi)
+    return list(zip(starts, starts[1:] + [end]))
+
+
+def _next_top_level(fi):
+    """Advances a file to the next line starting a top level element
+
+    :param fi: binary file object positioned at the start of a line
+    :return: tuple of the line offset and the line, which is empty at EOF
+    """
+    while True:
+        pos = fi.tell()
+        line = fi.readline()
+        if not line or line.lstrip().startswith(TOP_LEVEL_STARTS):
+            return pos, line
+
+
+class ChunkFile(object):
+    """File-like object exposing a byte range of an OSM file as a document
+
+    The range is wrapped in its own <osm> root element so it can be handed to
+    iterparse, and is read lazily so a worker never holds more than a read
+    buffer of its chunk in memory.
+    """
+
+    def __init__(self, file_in, start, end):
+        self._file = open(file_in, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+        self._prefix = b'<osm>\n'
+        self._suffix = b'</osm>\n'
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._remaining + len(self._prefix) + len(self._suffix)
+        data = b''
+        if self._prefix:
+            data, self._prefix = self._prefix[:size], self._prefix[size:]
+        if len(data) < size and self._remaining:
+            block = self._file.read(min(size - len(data), self._remaining))
+            self._remaining -= len(block)
+            data += block
+        if len(data) < size and not self._remaining and self._suffix:
+            tail = size - len(data)
+            data, self._suffix = data + self._suffix[:tail], self._suffix[tail:]
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+BACKENDS = {
+    'etree': iter_etree,
+    'lxml': iter_lxml,
+    'expat': iter_expat,
+}
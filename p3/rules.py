@@ -0,0 +1,240 @@
+"""
+Data driven audit and cleaning rules
+
+A ruleset file, JSON or YAML if PyYAML is installed, holds everything that
+is specific to one city: the expected street types, street type and
+abbreviation corrections, cuisine corrections, the phone number country and
+area codes, and a list of rules. Each rule names a tag key, the auditors run
+on its values while auditing and the fixers applied to them when elements
+are shaped:
+
+    {"key": "addr:postcode", "name": "postcode",
+     "audit": [{"type": "pattern", "pattern": "^80[0-9]{3}$"}],
+     "fix": [{"type": "replace", "pattern": "\\\\s+", "repl": ""}]}
+
+Rules are compiled once into dispatch tables keyed on the tag key, so a tag
+without rules costs a single dictionary lookup. Every rule counts the values
+it audited and fixed and the time spent on them.
+
+Auditors and fixers are looked up by type in AUDITORS and FIXERS. The
+generic ones are defined here, audit.py registers the ones backed by the
+street name, cuisine and phone number functions.
+"""
+import codecs
+import json
+import re
+from timeit import default_timer
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from auditreport import HyperLogLog
+
+# Factories of auditors and fixers by type. A factory is called with the
+# options of the rule entry and the Ruleset, an auditor returned by it is
+# called with an AuditReport and a tag value, a fixer with a tag value and
+# returns the fixed value, or None to drop the tag.
+AUDITORS = {}
+FIXERS = {}
+
+
+def auditor(name):
+    """Decorator registering an auditor factory"""
+    def register(factory):
+        AUDITORS[name] = factory
+        return factory
+    return register
+
+
+def fixer(name):
+    """Decorator registering a fixer factory"""
+    def register(factory):
+        FIXERS[name] = factory
+        return factory
+    return register
+
+
+@auditor('distinct')
+def _distinct(options, ruleset):
+    """Estimates the number of distinct values in report.distinct[name]"""
+    name = options['name']
+
+    def audit_distinct(report, value):
+        if name not in report.distinct:
+            report.distinct[name] = HyperLogLog()
+        report.distinct[name].add(value)
+    return audit_distinct
+
+
+@auditor('pattern')
+def _pattern(options, ruleset):
+    """Records the values that do not match a regular expression"""
+    pattern = re.compile(options['pattern'])
+    name = options['name']
+
+    def audit_pattern(report, value):
+        if not pattern.search(value):
+            report.findings[name].add(value)
+    return audit_pattern
+
+
+@auditor('allowed')
+def _allowed(options, ruleset):
+    """Records the values that are not in a list of allowed values"""
+    values = frozenset(options['values'])
+    name = options['name']
+
+    def audit_allowed(report, value):
+        if value not in values:
+            report.findings[name].add(value)
+    return audit_allowed
+
+
+@fixer('mapping')
+def _mapping(options, ruleset):
+    """Replaces whole values found in a mapping"""
+    mapping = options['map']
+    return lambda value: mapping.get(value, value)
+
+
+@fixer('replace')
+def _replace(options, ruleset):
+    """Substitutes the matches of a regular expression"""
+    pattern = re.compile(options['pattern'])
+    repl = options.get('repl', '')
+    return lambda value: pattern.sub(repl, value)
+
+
+@fixer('strip')
+def _strip(options, ruleset):
+    """Removes leading and trailing whitespace, dropping empty values"""
+    return lambda value: value.strip() or None
+
+
+class Rule(object):
+    """Auditors and fixers of one tag key with their statistics"""
+    __slots__ = ('key', 'name', 'auditors', 'fixers',
+                 'audited', 'fixed', 'audit_time', 'fix_time')
+
+    def __init__(self, key, name, auditors, fixers):
+        self.key = key
+        self.name = name
+        self.auditors = auditors
+        self.fixers = fixers
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.audited = self.fixed = 0
+        self.audit_time = self.fix_time = 0.0
+
+    def audit(self, report, value):
+        start = default_timer()
+        for audit_value in self.auditors:
+            audit_value(report, value)
+        self.audit_time += default_timer() - start
+        self.audited += 1
+
+    def fix(self, value):
+        start = default_timer()
+        for fix_value in self.fixers:
+            value = fix_value(value)
+            if value is None:
+                break
+        self.fix_time += default_timer() - start
+        self.fixed += 1
+        return value
+
+    def stats(self):
+        return {'key': self.key, 'name': self.name,
+                'audited': self.audited, 'audit_seconds': self.audit_time,
+                'fixed': self.fixed, 'fix_seconds': self.fix_time}
+
+
+def _entries(spec):
+    """Normalizes the auditors or fixers of a rule to a list of dictionaries,
+    a plain string is shorthand for an entry without options"""
+    if spec is None:
+        return []
+    if not isinstance(spec, list):
+        spec = [spec]
+    return [{'type': entry} if not isinstance(entry, dict) else entry for entry in spec]
+
+
+class Ruleset(object):
+    """Audit and cleaning rules of one city
+
+    :param config: dictionary in the format of a ruleset file
+    :param filename: name of the file the ruleset was read from
+    """
+
+    def __init__(self, config, filename=None):
+        self.config = config
+        self.filename = filename
+        self.name = config.get('name', filename)
+        self.street_types = list(config.get('street_types', []))
+        self.street_name_mapping = dict(config.get('street_name_mapping', {}))
+        self.abbreviations = dict(config.get('abbreviations', {}))
+        self.cuisine_types = dict(config.get('cuisine_types', {}))
+        self.country_code = str(config.get('country_code', '39'))
+        self.area_code = str(config.get('area_code', '81'))
+        self.rules = []
+        self.audit_dispatch = {}
+        self.fix_dispatch = {}
+
+    @classmethod
+    def from_file(cls, filename):
+        """Reads a ruleset from a .json, .yaml or .yml file"""
+        with codecs.open(filename, 'r', encoding='utf-8') as fi:
+            if filename.endswith(('.yaml', '.yml')):
+                if yaml is None:
+                    raise ImportError("Reading YAML rulesets requires the PyYAML package")
+                config = yaml.safe_load(fi)
+            else:
+                config = json.load(fi)
+        return cls(config, filename)
+
+    def compile(self):
+        """Builds the rules and the dispatch tables keyed on tag key
+
+        :return: this ruleset
+        """
+        self.rules = []
+        audit_dispatch = {}
+        fix_dispatch = {}
+        for spec in self.config.get('rules', []):
+            key = spec['key']
+            name = spec.get('name', key)
+            auditors = []
+            for entry in _entries(spec.get('audit')):
+                entry.setdefault('name', name)
+                auditors.append(self._factory(AUDITORS, 'auditor', entry)(entry, self))
+            fixers = [self._factory(FIXERS, 'fixer', entry)(entry, self)
+                      for entry in _entries(spec.get('fix'))]
+            rule = Rule(key, name, auditors, fixers)
+            self.rules.append(rule)
+            if auditors:
+                audit_dispatch.setdefault(key, []).append(rule)
+            if fixers:
+                fix_dispatch.setdefault(key, []).append(rule)
+        # tuples are a little faster to iterate in the hot loop
+        self.audit_dispatch = dict((k, tuple(v)) for k, v in audit_dispatch.items())
+        self.fix_dispatch = dict((k, tuple(v)) for k, v in fix_dispatch.items())
+        return self
+
+    @staticmethod
+    def _factory(registry, kind, entry):
+        try:
+            return registry[entry['type']]
+        except KeyError:
+            raise ValueError("Unknown {0} type {1!r}, expected one of {2}".format(
+                kind, entry.get('type'), ', '.join(sorted(registry))))
+
+    def stats(self):
+        """Returns the hit counts and timings of every rule"""
+        return [rule.stats() for rule in self.rules]
+
+    def reset_stats(self):
+        for rule in self.rules:
+            rule.reset_stats()
@@ -2,38 +2,315 @@
 # -*- coding: utf-8 -*-
 """Python script for generating a sample.osm file
 
-Script provided by Udacity in the project details
+Script provided by Udacity in the project details, extended with more
+sampling modes:
+    every:     take every k-th top level element (the original behaviour)
+    reservoir: single pass reservoir sample of a target number of elements
+    grid:      reservoir samples per cell of a bounding box grid, so sparse
+               areas of the map are as well represented as the dense center
+
+With --closed the sample is made referentially closed: every node referenced
+by a sampled way or relation, and every way referenced by a sampled relation,
+is written as well, so the sample is a valid OSM file for the audit rules.
+
+Usage:
+    python samplegenerator.py napoli.osm sample.osm --mode reservoir --size 20000 --closed
 """
+import argparse
+import random
 
-import xml.etree.ElementTree as ET  # Use cElementTree or lxml if too slow
+from osmparse import ET, iter_etree
 
 OSM_FILE = "napoli.osm"  # Replace this with your osm file
 SAMPLE_FILE = "sample.osm"
 
-k = 10 # Parameter: take every k-th top level element
+k = 10  # Parameter: take every k-th top level element
+
+# Output buffer size for the sample file
+BUFFER_SIZE = 1024 * 1024
+
+TOP_LEVEL = ('node', 'way', 'relation')
 
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
+def get_element(osm_file, tags=TOP_LEVEL):
     """Yield element if it is the right type of tag
 
     Reference:
     http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
     """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    return iter_etree(osm_file, tags)
+
+
+def element_refs(element):
+    """Returns the references an element needs to be referentially closed
+
+    :param element: top level element
+    :return: tuple of the referenced node ids and way ids
+    """
+    if element.tag == 'way':
+        return [nd.attrib['ref'] for nd in element.findall('nd')], []
+    if element.tag == 'relation':
+        nodes, ways = [], []
+        for member in element.findall('member'):
+            if member.attrib['type'] == 'node':
+                nodes.append(member.attrib['ref'])
+            elif member.attrib['type'] == 'way':
+                ways.append(member.attrib['ref'])
+        return nodes, ways
+    return [], []
+
+
+class Reservoir(object):
+    """Uniform sample of a fixed size from a stream of unknown length"""
+
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.seen = 0
+        self.items = []
+
+    def offer(self, index, element, keep):
+        """Offers an element to the sample
+
+        keep is only called for elements that enter the reservoir, so
+        elements that are skipped are never serialized.
+        """
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append((index, keep(element)))
+        else:
+            j = self.rng.randrange(self.seen)
+            if j < self.size:
+                self.items[j] = (index, keep(element))
+
+
+def sample_every(elements, keep, k=k):
+    """Keeps every k-th element
+
+    :param elements: iterable of (index, element)
+    :param keep: function converting an element to the payload to store
+    :param k: sampling interval
+    :return: dictionary of element index to payload
+    """
+    return dict((i, keep(element)) for i, element in elements if i % k == 0)
+
+
+def sample_reservoir(elements, keep, size, rng):
+    """Keeps a uniform random sample of size elements in a single pass
+
+    :param elements: iterable of (index, element)
+    :param keep: function converting an element to the payload to store
+    :param size: number of elements to sample
+    :param rng: random.Random instance
+    :return: dictionary of element index to payload
+    """
+    reservoir = Reservoir(size, rng)
+    for i, element in elements:
+        reservoir.offer(i, element, keep)
+    return dict(reservoir.items)
+
+
+def sample_grid(elements, keep, size, bbox, grid, rng):
+    """Keeps a sample stratified over a bounding box grid
+
+    Nodes are assigned to the grid cell containing them, ways and relations
+    each form one more stratum. The target size is split evenly over the
+    strata and each stratum is sampled with its own reservoir.
+    :param elements: iterable of (index, element)
+    :param keep: function converting an element to the payload to store
+    :param size: approximate total number of elements to sample
+    :param bbox: (min_lon, min_lat, max_lon, max_lat) of the grid
+    :param grid: (columns, rows) of the grid
+    :param rng: random.Random instance
+    :return: dictionary of element index to payload
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    columns, rows = grid
+    capacity = max(1, size // (columns * rows + 2))
+    cell_width = (max_lon - min_lon) / columns or 1.0
+    cell_height = (max_lat - min_lat) / rows or 1.0
+
+    strata = {}
+    for i, element in elements:
+        if element.tag == 'node':
+            lon, lat = float(element.attrib['lon']), float(element.attrib['lat'])
+            column = min(columns - 1, max(0, int((lon - min_lon) / cell_width)))
+            row = min(rows - 1, max(0, int((lat - min_lat) / cell_height)))
+            stratum = (column, row)
+        else:
+            stratum = element.tag
+        if stratum not in strata:
+            strata[stratum] = Reservoir(capacity, rng)
+        strata[stratum].offer(i, element, keep)
+
+    selected = {}
+    for reservoir in strata.values():
+        selected.update(reservoir.items)
+    return selected
+
+
+def read_bbox(osm_file):
+    """Returns the bounding box of an OSM file
+
+    Uses the <bounds> element when the file has one, otherwise scans the
+    nodes for their extent.
+    :return: (min_lon, min_lat, max_lon, max_lat)
+    """
+    for _, elem in ET.iterparse(osm_file, events=('start',)):
+        if elem.tag == 'bounds':
+            a = elem.attrib
+            return (float(a['minlon']), float(a['minlat']), float(a['maxlon']), float(a['maxlat']))
+        if elem.tag in TOP_LEVEL:
+            break
+
+    min_lon = min_lat = float('inf')
+    max_lon = max_lat = float('-inf')
+    for node in get_element(osm_file, ('node',)):
+        lon, lat = float(node.attrib['lon']), float(node.attrib['lat'])
+        min_lon, max_lon = min(min_lon, lon), max(max_lon, lon)
+        min_lat, max_lat = min(min_lat, lat), max(max_lat, lat)
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def close_references(osm_file, selected):
+    """Collects the ids of the elements referenced by a sample
+
+    :param osm_file: name of the OSM file the sample was drawn from
+    :param selected: dictionary of element index to (tag, id, node refs, way refs)
+    :return: tuple of the sets of node ids and way ids to add to the sample
+    """
+    nodes, ways = set(), set()
+    sampled_ways = set()
+    for tag, element_id, node_refs, way_refs in selected.values():
+        nodes.update(node_refs)
+        ways.update(way_refs)
+        if tag == 'way':
+            sampled_ways.add(element_id)
+
+    # Ways referenced by relations need their nodes too, which precede them
+    # in the file, so resolve them in an extra pass over the ways
+    missing = ways - sampled_ways
+    if missing:
+        for way in get_element(osm_file, ('way',)):
+            if way.attrib['id'] in missing:
+                nodes.update(element_refs(way)[0])
+    return nodes, ways
+
+
+def write_sample(osm_file, sample_file, include):
+    """Streams the selected elements of an OSM file into a sample file
+
+    Elements are written in their original order through a large buffer.
+    :param osm_file: name of the OSM file to sample
+    :param sample_file: name of the sample file to write
+    :param include: function of (index, element) returning true to keep it
+    :return: number of elements written
+    """
+    count = 0
+    with open(sample_file, 'wb', BUFFER_SIZE) as output:
+        output.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write(b'<osm>\n  ')
+        for i, element in enumerate(get_element(osm_file)):
+            if include(i, element):
+                output.write(ET.tostring(element, encoding='utf-8'))
+                count += 1
+        output.write(b'</osm>')
+    return count
+
+
+def write_payloads(sample_file, selected):
+    """Writes serialized elements in index order to a sample file
+
+    :param sample_file: name of the sample file to write
+    :param selected: dictionary of element index to serialized element
+    :return: number of elements written
+    """
+    with open(sample_file, 'wb', BUFFER_SIZE) as output:
+        output.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write(b'<osm>\n  ')
+        for i in sorted(selected):
+            output.write(selected[i])
+        output.write(b'</osm>')
+    return len(selected)
+
+
+def generate_sample(osm_file=OSM_FILE, sample_file=SAMPLE_FILE, mode='every', k=k,
+                    size=10000, bbox=None, grid=(10, 10), closed=False, seed=None):
+    """Writes a sample of an OSM file
+
+    :param osm_file: name of the OSM file to sample
+    :param sample_file: name of the sample file to write
+    :param mode: 'every', 'reservoir' or 'grid'
+    :param k: sampling interval for the 'every' mode
+    :param size: target number of elements for the 'reservoir' and 'grid' modes
+    :param bbox: bounding box of the 'grid' mode, read from the file if None
+    :param grid: (columns, rows) of the 'grid' mode
+    :param closed: add the elements referenced by the sampled ways and relations
+    :param seed: random seed
+    :return: number of elements written
+    """
+    rng = random.Random(seed)
+
+    if closed:
+        # Only remember what is needed to resolve references, the
+        # elements are serialized again in the final pass
+        def keep(element):
+            node_refs, way_refs = element_refs(element)
+            return element.tag, element.attrib['id'], node_refs, way_refs
+    else:
+        def keep(element):
+            return ET.tostring(element, encoding='utf-8')
+
+    if mode == 'every' and not closed:
+        return write_sample(osm_file, sample_file, lambda i, element: i % k == 0)
+
+    elements = enumerate(get_element(osm_file))
+    if mode == 'every':
+        selected = sample_every(elements, keep, k)
+    elif mode == 'reservoir':
+        selected = sample_reservoir(elements, keep, size, rng)
+    elif mode == 'grid':
+        selected = sample_grid(elements, keep, size, bbox or read_bbox(osm_file), grid, rng)
+    else:
+        raise ValueError("Unknown sampling mode '{0}'".format(mode))
+
+    if not closed:
+        return write_payloads(sample_file, selected)
+
+    nodes, ways = close_references(osm_file, selected)
+
+    def include(i, element):
+        if i in selected:
+            return True
+        if element.tag == 'node':
+            return element.attrib['id'] in nodes
+        if element.tag == 'way':
+            return element.attrib['id'] in ways
+        return False
+
+    return write_sample(osm_file, sample_file, include)
+
 
+def main():
+    parser = argparse.ArgumentParser(description="Generate a sample of an OSM file")
+    parser.add_argument('osm_file', nargs='?', default=OSM_FILE)
+    parser.add_argument('sample_file', nargs='?', default=SAMPLE_FILE)
+    parser.add_argument('--mode', choices=['every', 'reservoir', 'grid'], default='every')
+    parser.add_argument('-k', type=int, default=k, help="interval of the 'every' mode")
+    parser.add_argument('--size', type=int, default=10000,
+                        help="target number of elements of the 'reservoir' and 'grid' modes")
+    parser.add_argument('--grid', type=int, nargs=2, default=[10, 10], metavar=('COLUMNS', 'ROWS'))
+    parser.add_argument('--bbox', type=float, nargs=4,
+                        metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'))
+    parser.add_argument('--closed', action='store_true',
+                        help="include the nodes and ways referenced by sampled elements")
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
 
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
+    count = generate_sample(args.osm_file, args.sample_file, args.mode, args.k, args.size,
+                            args.bbox, tuple(args.grid), args.closed, args.seed)
+    print("{0} elements written to {1}".format(count, args.sample_file))
 
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
 
-    output.write('</osm>')
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""
+JSON serializers and compressed output streams for the JSON lines sink
+
+Serializers turn a shaped document into UTF-8 encoded JSON bytes:
+
+    orjson: fastest, compact separators, writes non-ASCII characters as is
+    ujson:  fast, compact separators
+    json:   the standard library, output identical to json.dumps
+
+'auto' picks the first one that is installed. All of them produce JSON
+that mongoimport and json.loads read back into the same documents. With
+pretty=True a document is indented over several lines, which is no longer
+JSON lines: loads_line, used by the readers of the output, rejects it.
+
+Output streams are binary file-like objects with write() and close():
+
+    None:  a plain file
+    gzip:  a multi-member gzip file whose blocks are compressed in a thread
+           pool. zlib releases the GIL while it compresses, so the blocks
+           use several cores. Concatenated members are a valid gzip file
+           for gzip, zcat and gzip.open.
+    zstd:  a zstandard stream using the library's own worker threads
+
+open_input() reads plain, gzip or zstd files back, whatever their name.
+"""
+import gzip
+import io
+import json
+import multiprocessing
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Serializer used when none is named
+DEFAULT_SERIALIZER = 'auto'
+
+# Size of the uncompressed blocks handed to the gzip threads
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+
+COMPRESSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+class StdlibSerializer(object):
+    name = 'json'
+
+    def __init__(self, pretty=False, default=None):
+        # reusing one encoder skips the argument handling of json.dumps
+        self._encode = json.JSONEncoder(indent=2 if pretty else None, default=default).encode
+
+    def dumps(self, doc):
+        return self._encode(doc).encode('utf-8')
+
+
+class OrjsonSerializer(object):
+    name = 'orjson'
+
+    def __init__(self, pretty=False, default=None):
+        if orjson is None:
+            raise ImportError("The orjson serializer requires the orjson package")
+        self._option = orjson.OPT_INDENT_2 if pretty else 0
+        self._default = default
+
+    def dumps(self, doc):
+        return orjson.dumps(doc, self._default, self._option)
+
+
+class UjsonSerializer(object):
+    name = 'ujson'
+
+    def __init__(self, pretty=False, default=None):
+        if ujson is None:
+            raise ImportError("The ujson serializer requires the ujson package")
+        self._indent = 2 if pretty else 0
+        self._default = default
+
+    def dumps(self, doc):
+        return ujson.dumps(doc, indent=self._indent, ensure_ascii=False,
+                           escape_forward_slashes=False, default=self._default).encode('utf-8')
+
+
+# Serializers in order of preference for 'auto'
+SERIALIZERS = [('orjson', OrjsonSerializer, orjson),
+               ('ujson', UjsonSerializer, ujson),
+               ('json', StdlibSerializer, json)]
+
+
+def get_serializer(name=DEFAULT_SERIALIZER, pretty=False, default=None):
+    """Returns a serializer by name
+
+    :param name: 'orjson', 'ujson', 'json' or 'auto' for the fastest installed
+    :param pretty: indent the output
+    :param default: function returning an encodable version of the objects
+        the serializer cannot encode itself, or raising TypeError
+    :return: object whose dumps(doc) method returns bytes
+    """
+    for serializer_name, cls, module in SERIALIZERS:
+        if name == serializer_name or (name == 'auto' and module is not None):
+            return cls(pretty, default)
+    raise ValueError("Unknown serializer '{0}', expected one of auto, {1}".format(
+        name, ', '.join(serializer_name for serializer_name, _, _ in SERIALIZERS)))
+
+
+def _gzip_member(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter(object):
+    """Writes a gzip file, compressing independent blocks in threads
+
+    :param file_out: name of the file to write
+    :param level: compression level from 1 to 9
+    :param threads: number of compression threads, defaults to the CPU count
+    :param block_size: size of the uncompressed blocks
+    """
+
+    def __init__(self, file_out, level=6, threads=None, block_size=GZIP_BLOCK_SIZE):
+        self.level = level
+        self.threads = threads or multiprocessing.cpu_count()
+        self.block_size = block_size
+        self._fo = open(file_out, 'wb')
+        self._pool = ThreadPool(self.threads) if self.threads > 1 else None
+        self._pending = deque()
+        self._block = bytearray()
+
+    def write(self, data):
+        self._block += data
+        if len(self._block) >= self.block_size:
+            self._submit()
+
+    def _submit(self):
+        block = bytes(self._block)
+        del self._block[:]
+        if self._pool is None:
+            self._fo.write(_gzip_member(block, self.level))
+            return
+        self._pending.append(self._pool.apply_async(_gzip_member, (block, self.level)))
+        # write finished members in order, and wait once enough blocks are in
+        # flight to keep every thread busy so memory stays bounded
+        while self._pending and (self._pending[0].ready() or len(self._pending) > 2 * self.threads):
+            self._fo.write(self._pending.popleft().get())
+
+    def close(self):
+        if self._fo.closed:
+            return
+        if self._block:
+            self._submit()
+        while self._pending:
+            self._fo.write(self._pending.popleft().get())
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+        self._fo.close()
+
+
+def open_output(file_out, compression=None, threads=None, level=None):
+    """Opens a binary output stream
+
+    :param file_out: name of the file to write
+    :param compression: None, 'gzip' or 'zstd'
+    :param threads: number of compression threads, defaults to the CPU count
+    :param level: compression level, the library default if None
+    :return: file-like object with write() and close()
+    """
+    if compression is None:
+        return open(file_out, 'wb')
+    if compression == 'gzip':
+        return ParallelGzipWriter(file_out, 6 if level is None else level, threads)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstd compression requires the zstandard package")
+        compressor = zstandard.ZstdCompressor(level=3 if level is None else level,
+                                              threads=threads or -1)
+        return compressor.stream_writer(open(file_out, 'wb'))
+    raise ValueError("Unknown compression '{0}', expected one of gzip, zstd".format(compression))
+
+
+def loads_line(line, filename):
+    """Decodes a line of a JSON lines file
+
+    Files written with pretty=True spread every document over several
+    lines, so their lines are not documents on their own.
+    :param line: UTF-8 encoded line
+    :param filename: name of the file, for the error message
+    :return: the document
+    """
+    try:
+        return json.loads(line.decode('utf-8'))
+    except ValueError:
+        raise ValueError("{0} is not a JSON lines file, a line does not hold a whole document. "
+                         "Output written with pretty=True (--pretty) is indented over several "
+                         "lines and cannot be read back".format(filename))
+
+
+def compression_of(filename):
+    """Returns the compression of a file name by its extension, None for
+    uncompressed files"""
+    for compression, extension in COMPRESSIONS.items():
+        if extension and filename.endswith(extension):
+            return compression
+    return None
+
+
+def detect_compression(file_in):
+    """Returns the compression of a file from its first bytes, 'gzip',
+    'zstd' or None for uncompressed files"""
+    with open(file_in, 'rb') as fi:
+        magic = fi.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def open_input(file_in):
+    """Opens a plain, gzip or zstd compressed file for reading binary lines,
+    detecting the compression from the first bytes"""
+    compression = detect_compression(file_in)
+    if compression == 'gzip':
+        return gzip.open(file_in, 'rb')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("Reading zstd files requires the zstandard package")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(file_in, 'rb'),
+                                                            read_across_frames=True,
+                                                            closefd=True)
+        return io.BufferedReader(reader)
+    return open(file_in, 'rb')
@@ -0,0 +1,409 @@
+"""
+Output sinks for the shaped OSM documents
+
+A sink receives shaped documents one at a time through write() and is
+finalized with close(). process_map streams every document into a sink, so
+the output format is independent of the parsing and shaping code.
+Documents are the compact elements of the model module or dictionaries,
+elements are turned into dictionaries by the sink when it writes them out.
+Sinks that hold documents in batches get elements from process_map, the
+streaming JSON lines sink gets dictionaries.
+
+Sinks:
+    JsonLinesSink: one JSON document per line, for mongoimport, optionally
+                   gzip or zstd compressed
+    MongoSink:     batched unordered inserts straight into a MongoDB
+                   collection, skipping the intermediate JSON file
+    ParquetSink:   typed columnar Parquet file written in Arrow record batches
+"""
+import json
+import time
+
+import model
+import serializers
+from model import ADDRESS_FIELDS, to_document
+
+try:
+    import pymongo
+except ImportError:
+    pymongo = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Number of bytes of JSON lines collected before they are written out
+JSON_BUFFER_SIZE = 1024 * 1024
+
+# Number of documents sent to MongoDB per bulk insert
+MONGO_BATCH_SIZE = 1000
+
+# Number of rows per Parquet row group, also the number of documents
+# buffered before they are converted to an Arrow record batch
+ROW_GROUP_SIZE = 128 * 1024
+
+
+class Sink(object):
+    """Base class for sinks, usable as a context manager
+
+    :cvar streaming: whether the sink writes each document out as it
+        arrives rather than holding it, process_map then passes it
+        dictionaries instead of model elements
+    """
+
+    streaming = False
+
+    def __init__(self):
+        self.count = 0
+        self._start = None
+        self._elapsed = 0.0
+
+    def write(self, doc):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def instrument(self, stats):
+        """Times the internal steps of writing a document as stages of an
+        instrument.RunStats, see the subclasses for the stage names"""
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _started(self):
+        if self._start is None:
+            self._start = time.time()
+
+    def _stopped(self):
+        if self._start is not None:
+            self._elapsed = time.time() - self._start
+
+    def stats(self):
+        """Returns the number of documents written and the write rate"""
+        elapsed = self._elapsed or (time.time() - self._start if self._start else 0.0)
+        return {'documents': self.count,
+                'seconds': elapsed,
+                'documents_per_sec': self.count / elapsed if elapsed else 0.0}
+
+
+class JsonLinesSink(Sink):
+    """Writes each document as a line of JSON
+
+    Encoded lines are collected in a reusable buffer that is written out
+    once it holds buffer_size bytes, so there is one write call per buffer
+    instead of one per document.
+
+    Instrumented stages: serialize (encoding) and disk (writes to the file
+    or compressor)
+
+    :param file_out: name of the file to write
+    :param pretty: indent the JSON output
+    :param serializer: name of the serializer, see serializers.get_serializer
+    :param compression: None, 'gzip' or 'zstd', see serializers.open_output
+    :param buffer_size: number of bytes buffered between writes
+    :param threads: number of compression threads, defaults to the CPU count
+    """
+
+    streaming = True
+
+    def __init__(self, file_out, pretty=False, serializer=serializers.DEFAULT_SERIALIZER,
+                 compression=None, buffer_size=JSON_BUFFER_SIZE, threads=None):
+        super(JsonLinesSink, self).__init__()
+        self.file_out = file_out
+        # model elements are encoded through their dictionary by the default hook
+        self.serializer = serializers.get_serializer(serializer, pretty, model.default)
+        self.buffer_size = buffer_size
+        self._dumps = self.serializer.dumps
+        self._buffer = bytearray()
+        self._fo = serializers.open_output(file_out, compression, threads)
+        self._write = self._fo.write
+        self._closed = False
+
+    def encode(self, doc):
+        return self._dumps(doc) + b"\n"
+
+    def write(self, doc):
+        self._started()
+        buf = self._buffer
+        buf += self.encode(doc)
+        if len(buf) >= self.buffer_size:
+            self._write(buf)
+            del buf[:]
+        self.count += 1
+
+    def instrument(self, stats):
+        self.encode = stats.timed('serialize', self.encode)
+        self._write = stats.timed('disk', self._write)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            if self._buffer:
+                self._write(self._buffer)
+                del self._buffer[:]
+            self._fo.close()
+            self._stopped()
+
+
+class MongoSink(Sink):
+    """Inserts documents into a MongoDB collection in unordered batches
+
+    Any object with the insert_many and create_index methods of a pymongo
+    collection can be used, such as a mongomock collection for testing.
+    Once all documents are loaded, close() creates a 2dsphere index on pos
+    and indexes on address.street and amenity.
+
+    Instrumented stages: insert (bulk inserts)
+    """
+
+    INDEXES = [
+        [('pos', '2dsphere')],
+        [('address.street', 1)],
+        [('amenity', 1)],
+    ]
+
+    def __init__(self, collection, batch_size=MONGO_BATCH_SIZE, create_indexes=True):
+        super(MongoSink, self).__init__()
+        self.collection = collection
+        self.batch_size = batch_size
+        self.create_indexes = create_indexes
+        self.batches = 0
+        self._batch = []
+        self._closed = False
+
+    def write(self, doc):
+        self._started()
+        self._batch.append(doc)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def instrument(self, stats):
+        self.flush = stats.timed('insert', self.flush)
+
+    def flush(self):
+        """Sends the buffered documents as one unordered bulk insert"""
+        if self._batch:
+            self.collection.insert_many([to_document(doc) for doc in self._batch],
+                                        ordered=False)
+            self.count += len(self._batch)
+            self.batches += 1
+            self._batch = []
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        self._stopped()
+        # Building the indexes once after the load is faster than
+        # maintaining them during every insert
+        if self.create_indexes:
+            for keys in self.INDEXES:
+                self.collection.create_index(keys)
+
+    def stats(self):
+        stats = super(MongoSink, self).stats()
+        stats['batches'] = self.batches
+        return stats
+
+
+def mongo_collection(uri, database, collection):
+    """Connects to a MongoDB collection
+
+    :param uri: MongoDB connection string
+    :param database: name of the database
+    :param collection: name of the collection
+    :return: pymongo collection
+    """
+    if pymongo is None:
+        raise ImportError("Loading into MongoDB requires the pymongo package")
+    return pymongo.MongoClient(uri)[database][collection]
+
+
+class ParquetSink(Sink):
+    """Writes documents to a Parquet file with typed columns
+
+    Documents are buffered and converted column by column into Arrow record
+    batches, each written as one row group. Ids are int64, pos is a fixed
+    size [lon, lat] list of doubles, type and amenity are dictionary encoded,
+    address is a struct, node_refs a list of int64 and the members of
+    relations a list of type, ref and role structs. The way geometry, the
+    relation multipolygon, bbox and centroid added by
+    process_map(geometry=True) are (nested) lists of doubles. Tags without a
+    column of their own are kept as strings in the tags map.
+
+    Instrumented stages: serialize (conversion to record batches) and disk
+    (Parquet encoding and writes)
+    """
+
+    TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+    ADDRESS_FIELDS = list(ADDRESS_FIELDS)
+    # Keys stored in their own column, everything else goes to tags
+    COLUMNS = frozenset(['id', 'type', 'created', 'pos', 'address', 'amenity', 'cuisine',
+                         'name', 'phone', 'node_refs', 'members', 'geometry', 'multipolygon',
+                         'bbox', 'centroid'])
+
+    def __init__(self, file_out, row_group_size=ROW_GROUP_SIZE, compression='snappy'):
+        super(ParquetSink, self).__init__()
+        if pa is None:
+            raise ImportError("Writing Parquet requires the pyarrow package")
+        self.file_out = file_out
+        self.row_group_size = row_group_size
+        self.schema = self.build_schema()
+        self._writer = pq.ParquetWriter(file_out, self.schema, compression=compression)
+        self._batch = []
+
+    @classmethod
+    def build_schema(cls):
+        """Returns the Arrow schema of the shaped documents"""
+        dictionary = pa.dictionary(pa.int32(), pa.string())
+        return pa.schema([
+            ('id', pa.int64()),
+            ('type', dictionary),
+            ('created', pa.struct([
+                ('version', pa.int64()),
+                ('changeset', pa.int64()),
+                ('timestamp', pa.timestamp('ms')),
+                ('user', pa.string()),
+                ('uid', pa.int64()),
+            ])),
+            ('pos', pa.list_(pa.float64(), 2)),
+            ('address', pa.struct([(field, pa.string()) for field in cls.ADDRESS_FIELDS])),
+            ('amenity', dictionary),
+            ('cuisine', pa.list_(pa.string())),
+            ('name', pa.string()),
+            ('phone', pa.string()),
+            ('node_refs', pa.list_(pa.int64())),
+            ('members', pa.list_(pa.struct([
+                ('type', dictionary),
+                ('ref', pa.int64()),
+                ('role', pa.string()),
+            ]))),
+            ('geometry', pa.list_(pa.list_(pa.float64(), 2))),
+            ('multipolygon', pa.list_(pa.list_(pa.list_(pa.list_(pa.float64(), 2))))),
+            ('bbox', pa.list_(pa.float64(), 4)),
+            ('centroid', pa.list_(pa.float64(), 2)),
+            ('tags', pa.map_(pa.string(), pa.string())),
+        ])
+
+    def write(self, doc):
+        self._started()
+        self._batch.append(doc)
+        if len(self._batch) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """Converts the buffered documents to a record batch and writes it"""
+        if self._batch:
+            batch = self.to_record_batch(self._batch)
+            self._write_table(pa.Table.from_batches([batch], self.schema))
+            self.count += len(self._batch)
+            self._batch = []
+
+    def write_batch(self, batch):
+        """Writes an Arrow record batch with the sink schema, such as one read
+        back from a file written by this sink"""
+        self._started()
+        self.flush()
+        table = pa.Table.from_batches([batch]).cast(self.schema)
+        self._write_table(table)
+        self.count += batch.num_rows
+
+    def _write_table(self, table):
+        self._writer.write_table(table, row_group_size=self.row_group_size)
+
+    def instrument(self, stats):
+        self.to_record_batch = stats.timed('serialize', self.to_record_batch)
+        self._write_table = stats.timed('disk', self._write_table)
+
+    def to_record_batch(self, docs):
+        """Converts a list of shaped documents to an Arrow record batch"""
+        fields = dict((field.name, field.type) for field in self.schema)
+        docs = [to_document(doc) for doc in docs]
+
+        created = [doc['created'] for doc in docs]
+        timestamps = pc.strptime(pa.array([c.get('timestamp') for c in created], pa.string()),
+                                 format=self.TIMESTAMP_FORMAT, unit='ms')
+        created = pa.StructArray.from_arrays(
+            [pa.array([_int(c.get('version')) for c in created], pa.int64()),
+             pa.array([_int(c.get('changeset')) for c in created], pa.int64()),
+             timestamps,
+             pa.array([c.get('user') for c in created], pa.string()),
+             pa.array([_int(c.get('uid')) for c in created], pa.int64())],
+            fields=list(fields['created']))
+
+        def dictionary(key):
+            return pa.array([doc.get(key) for doc in docs], pa.string()).dictionary_encode()
+
+        def cuisine(doc):
+            value = doc.get('cuisine')
+            return [value] if isinstance(value, str) else value
+
+        def node_refs(doc):
+            refs = doc.get('node_refs')
+            return [int(ref) for ref in refs] if refs is not None else None
+
+        def members(doc):
+            members = doc.get('members')
+            if members is None:
+                return None
+            return [{'type': m['type'], 'ref': int(m['ref']), 'role': m['role']} for m in members]
+
+        def tags(doc):
+            pairs = [(k, v if isinstance(v, str) else json.dumps(v))
+                     for k, v in doc.items() if k not in self.COLUMNS]
+            # keep the address parts that have no field in the address struct
+            pairs.extend(('addr:' + k, v) for k, v in doc.get('address', {}).items()
+                         if k not in self.ADDRESS_FIELDS)
+            return pairs
+
+        columns = [
+            pa.array([int(doc['id']) for doc in docs], pa.int64()),
+            dictionary('type'),
+            created,
+            pa.array([doc.get('pos') for doc in docs], fields['pos']),
+            pa.array([doc.get('address') for doc in docs], fields['address']),
+            dictionary('amenity'),
+            pa.array([cuisine(doc) for doc in docs], fields['cuisine']),
+            pa.array([doc.get('name') for doc in docs], pa.string()),
+            pa.array([doc.get('phone') for doc in docs], pa.string()),
+            pa.array([node_refs(doc) for doc in docs], fields['node_refs']),
+            pa.array([members(doc) for doc in docs], fields['members']),
+            pa.array([doc.get('geometry') for doc in docs], fields['geometry']),
+            pa.array([doc.get('multipolygon') for doc in docs], fields['multipolygon']),
+            pa.array([doc.get('bbox') for doc in docs], fields['bbox']),
+            pa.array([doc.get('centroid') for doc in docs], fields['centroid']),
+            pa.array([tags(doc) for doc in docs], fields['tags']),
+        ]
+        return pa.RecordBatch.from_arrays(columns, schema=self.schema)
+
+    def close(self):
+        if self._writer is not None:
+            self.flush()
+            self._writer.close()
+            self._writer = None
+            self._stopped()
+
+
+def _int(value):
+    return int(value) if value is not None else None
+
+
+def read_parquet(file_in, columns=None):
+    """Reads selected columns of a Parquet file written by ParquetSink
+
+    :param file_in: name of the Parquet file
+    :param columns: list of column names to read, all columns if None
+    :return: pyarrow Table
+    """
+    if pa is None:
+        raise ImportError("Reading Parquet requires the pyarrow package")
+    return pq.read_table(file_in, columns=columns)
@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Grid spatial index over the shaped OSM output
+
+Documents from a JSON lines or Parquet file written by data.py are bucketed
+into a regular lon/lat grid. The index is stored next to the source as flat
+binary arrays sorted by cell (cell id, coordinates, byte offset or row of the
+document and one value id per indexed tag) plus a JSON metadata file, and is
+memory mapped for queries. Nodes are indexed at their pos, ways and
+multipolygon relations at the centroid added by process_map(geometry=True).
+
+Queries select the cells overlapping the search area with a binary search,
+filter on the exact coordinates and on the indexed tags (amenity and cuisine
+by default) without touching the source, and only then read the matching
+documents. Filters on other tags are checked on the documents themselves.
+
+JSON lines sources must be uncompressed, as documents are read at their byte
+offsets. The index records the size and modification time of its source, a
+SpatialIndex is not opened on a source that changed since the index was
+built, and the query commands below rebuild such an index first.
+
+Usage:
+    python spatialindex.py build napoli.osm.json
+    python spatialindex.py radius napoli.osm.json 14.25 40.85 500 --tag amenity=restaurant
+    python spatialindex.py nearest napoli.osm.json 14.25 40.85 5 --tag cuisine=pizza
+"""
+import argparse
+import bisect
+import codecs
+import json
+import math
+import mmap
+import os
+from array import array
+from collections import OrderedDict
+
+import serializers
+import sinks
+from nodeindex import _view
+
+# Default size of a grid cell in degrees, about 1.1 km of latitude
+CELL_SIZE = 0.01
+
+# Tags whose values are stored in the index for filtering
+INDEXED_TAGS = ('amenity', 'cuisine')
+
+# Number of decoded Parquet row groups kept for fetching documents
+CACHED_ROW_GROUPS = 4
+
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """Returns the great circle distance between two points in meters"""
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _location(doc):
+    """Returns the point a document is indexed at, or None"""
+    return doc.get('pos') or doc.get('centroid')
+
+
+def _tag_value(doc, key):
+    value = doc.get(key)
+    if isinstance(value, list):
+        value = ';'.join(value)
+    return value
+
+
+class _Source(object):
+    """Reads documents from the file an index was built from"""
+
+    @staticmethod
+    def open(filename, meta=None):
+        """Opens the source of an index
+
+        :param meta: index metadata holding the layout the source recorded
+            with layout() when the index was built, if any
+        """
+        if filename.endswith('.parquet'):
+            return _ParquetSource(filename, (meta or {}).get('row_groups'))
+        return _JsonLinesSource(filename)
+
+    def layout(self):
+        """Returns the metadata to store with the index"""
+        return {}
+
+    def fetch_many(self, refs):
+        """Returns the documents of several refs in the same order"""
+        return [self.fetch(ref) for ref in refs]
+
+
+class _JsonLinesSource(_Source):
+    """Reads documents of a JSON lines file at their byte offsets, which
+    requires an uncompressed file"""
+
+    def __init__(self, filename):
+        compression = serializers.detect_compression(filename)
+        if compression is not None:
+            raise ValueError("{0} is {1} compressed, the spatial index reads documents at "
+                             "byte offsets of an uncompressed JSON lines file, decompress it "
+                             "first".format(filename, compression))
+        self.filename = filename
+        self._fi = None
+
+    def scan(self):
+        """Yields (offset, document) for every document"""
+        with open(self.filename, 'rb') as fi:
+            offset = 0
+            for line in iter(fi.readline, b''):
+                yield offset, serializers.loads_line(line, self.filename)
+                offset += len(line)
+
+    def fetch(self, ref):
+        if self._fi is None:
+            self._fi = open(self.filename, 'rb')
+        self._fi.seek(ref)
+        return serializers.loads_line(self._fi.readline(), self.filename)
+
+    def close(self):
+        if self._fi is not None:
+            self._fi.close()
+            self._fi = None
+
+
+class _ParquetSource(_Source):
+    """Reads rows of a Parquet file, a document is fetched by reading only
+    the row group holding it
+
+    :param row_groups: first row of every row group, as recorded by
+        layout(), read from the file metadata if None
+    """
+
+    def __init__(self, filename, row_groups=None):
+        if sinks.pa is None:
+            raise ImportError("Indexing Parquet files requires the pyarrow package")
+        self.filename = filename
+        self._file = None
+        self._row_groups = row_groups
+        self._groups = OrderedDict()
+
+    def _parquet_file(self):
+        if self._file is None:
+            self._file = sinks.pq.ParquetFile(self.filename)
+        return self._file
+
+    def layout(self):
+        metadata = self._parquet_file().metadata
+        starts, start = [], 0
+        for i in range(metadata.num_row_groups):
+            starts.append(start)
+            start += metadata.row_group(i).num_rows
+        return {'row_groups': starts}
+
+    def scan(self):
+        columns = ['pos', 'centroid'] + list(INDEXED_TAGS)
+        row = 0
+        for batch in self._parquet_file().iter_batches(columns=columns):
+            for doc in batch.to_pylist():
+                yield row, dict((k, v) for k, v in doc.items() if v is not None)
+                row += 1
+
+    def _group(self, group):
+        """Returns a row group as a Table, keeping the most recently used
+        groups"""
+        table = self._groups.pop(group, None)
+        if table is None:
+            table = self._parquet_file().read_row_group(group)
+            if len(self._groups) >= CACHED_ROW_GROUPS:
+                self._groups.popitem(last=False)
+        self._groups[group] = table
+        return table
+
+    @staticmethod
+    def _document(row):
+        # put the tags without a column of their own back into the document
+        doc = dict((k, v) for k, v in row.items() if v is not None and k != 'tags')
+        doc.update(row.get('tags') or [])
+        return doc
+
+    def fetch(self, ref):
+        return self.fetch_many([ref])[0]
+
+    def fetch_many(self, refs):
+        """Returns the documents of several refs, reading each row group
+        holding any of them once"""
+        if self._row_groups is None:
+            self._row_groups = self.layout()['row_groups']
+        by_group = {}
+        for position, ref in enumerate(refs):
+            group = bisect.bisect_right(self._row_groups, ref) - 1
+            by_group.setdefault(group, []).append((ref - self._row_groups[group], position))
+        docs = [None] * len(refs)
+        for group in sorted(by_group):
+            rows, positions = zip(*by_group[group])
+            for position, row in zip(positions, self._group(group).take(list(rows)).to_pylist()):
+                docs[position] = self._document(row)
+        return docs
+
+    def close(self):
+        self._groups.clear()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _source_stamp(filename):
+    """Returns the size and modification time of a source, stored with the
+    index to detect a source that changed after the index was built"""
+    stat = os.stat(filename)
+    return {'source_size': stat.st_size, 'source_mtime': stat.st_mtime}
+
+
+def _read_meta(path):
+    with codecs.open(path + '.json', 'r', encoding='utf-8') as fi:
+        return json.load(fi)
+
+
+def _matches(meta, source_file):
+    stamp = _source_stamp(source_file)
+    return all(meta.get(key) == value for key, value in stamp.items())
+
+
+def is_current(path, source_file=None):
+    """Returns whether the index at path matches its source file as it is
+    now, False if the source changed since the index was built
+
+    :param source_file: source to check, the one the index was built from
+        if None
+    """
+    meta = _read_meta(path)
+    return _matches(meta, source_file or meta['source'])
+
+
+def _files(path, tags):
+    names = {'cells': path + '.cells', 'coords': path + '.coords', 'refs': path + '.refs'}
+    for key in tags:
+        names['tag:' + key] = "{0}.tag_{1}".format(path, key)
+    return names
+
+
+def build_index(source_file, path=None, cell_size=CELL_SIZE, tags=INDEXED_TAGS):
+    """Builds a grid index over a JSON lines or Parquet file
+
+    :param source_file: file written by data.py
+    :param path: base name of the index files, defaults to source_file + '.grid'
+    :param cell_size: size of the grid cells in degrees
+    :param tags: tag keys whose values are stored in the index
+    :return: SpatialIndex opened on the new index
+    """
+    path = path or source_file + '.grid'
+    columns = int(math.ceil(360.0 / cell_size))
+    cells, coords, refs = array('q'), array('d'), array('q')
+    values = dict((key, array('i')) for key in tags)
+    tables = dict((key, {}) for key in tags)
+
+    # stamp the source before reading it, so changes during the build show
+    stamp = _source_stamp(source_file)
+    source = _Source.open(source_file)
+    for ref, doc in source.scan():
+        location = _location(doc)
+        if not location:
+            continue
+        lon, lat = location
+        cells.append(_cell(lon, lat, cell_size, columns))
+        coords.extend((lon, lat))
+        refs.append(ref)
+        for key in tags:
+            value = _tag_value(doc, key)
+            if value is None:
+                values[key].append(-1)
+            else:
+                values[key].append(tables[key].setdefault(value, len(tables[key])))
+
+    # sort every array by cell so each cell is one contiguous range
+    order = sorted(range(len(cells)), key=cells.__getitem__)
+    files = _files(path, tags)
+    sorted_arrays = {
+        'cells': array('q', (cells[i] for i in order)),
+        'coords': array('d', (coords[j] for i in order for j in (2 * i, 2 * i + 1))),
+        'refs': array('q', (refs[i] for i in order)),
+    }
+    for key in tags:
+        sorted_arrays['tag:' + key] = array('i', (values[key][i] for i in order))
+    for name, values_array in sorted_arrays.items():
+        with open(files[name], 'wb') as fo:
+            values_array.tofile(fo)
+
+    meta = {'source': os.path.abspath(source_file),
+            'cell_size': cell_size,
+            'columns': columns,
+            'count': len(cells),
+            'tags': dict((key, sorted(table, key=table.get)) for key, table in tables.items())}
+    meta.update(stamp)
+    meta.update(source.layout())
+    source.close()
+    with codecs.open(path + '.json', 'w', encoding='utf-8') as fo:
+        json.dump(meta, fo)
+    return SpatialIndex(path)
+
+
+def _cell(lon, lat, cell_size, columns):
+    row = int(math.floor((lat + 90.0) / cell_size))
+    column = int(math.floor((lon + 180.0) / cell_size))
+    return row * columns + column
+
+
+class SpatialIndex(object):
+    """Memory mapped grid index with bbox, radius and nearest queries
+
+    Tag filters are given as keyword arguments, e.g. amenity='restaurant'.
+    A document matches a filter on a list valued tag such as cuisine when
+    the list contains the value.
+
+    The index refers to the documents by their byte offset or row, so it
+    cannot be opened once its source changed, for example after
+    changes.apply_to_jsonl: a ValueError asks for the index to be rebuilt.
+    """
+
+    def __init__(self, path, source_file=None):
+        self.path = path
+        self.meta = _read_meta(path)
+        if not _matches(self.meta, source_file or self.meta['source']):
+            raise ValueError("The index {0} is stale: {1} changed since the index was built, "
+                             "rebuild it with build_index".format(
+                                 path, source_file or self.meta['source']))
+        self.cell_size = self.meta['cell_size']
+        self.columns = self.meta['columns']
+        self.tag_tables = self.meta['tags']
+        if source_file is None:
+            self.source = _Source.open(self.meta['source'], self.meta)
+        else:
+            self.source = _Source.open(source_file)
+        self._maps = []
+        files = _files(path, self.tag_tables)
+        self._cells = self._map(files['cells'], 'q')
+        self._coords = self._map(files['coords'], 'd')
+        self._refs = self._map(files['refs'], 'q')
+        self._tags = dict((key, self._map(files['tag:' + key], 'i')) for key in self.tag_tables)
+
+    def _map(self, filename, typecode):
+        if os.path.getsize(filename) == 0:
+            return []
+        with open(filename, 'rb') as fi:
+            mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mm)
+        return _view(mm, typecode)
+
+    def __len__(self):
+        return self.meta['count']
+
+    def close(self):
+        for view in [self._cells, self._coords, self._refs] + list(self._tags.values()):
+            if isinstance(view, memoryview):
+                view.release()
+        for mm in self._maps:
+            mm.close()
+        self._maps = []
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _split_filters(self, filters):
+        """Turns tag filters into sets of accepted value ids for the indexed
+        tags and a dictionary of the remaining filters"""
+        accepted = {}
+        remaining = {}
+        for key, wanted in filters.items():
+            if key in self.tag_tables:
+                accepted[key] = set(i for i, value in enumerate(self.tag_tables[key])
+                                    if value == wanted or wanted in value.split(';'))
+            else:
+                remaining[key] = wanted
+        return accepted, remaining
+
+    def _candidates(self, min_lon, min_lat, max_lon, max_lat, accepted):
+        """Yields (lon, lat, record) of the records inside a bbox that pass
+        the indexed tag filters"""
+        cs, columns = self.cell_size, self.columns
+        first_row = int(math.floor((min_lat + 90.0) / cs))
+        last_row = int(math.floor((max_lat + 90.0) / cs))
+        first_column = int(math.floor((min_lon + 180.0) / cs))
+        last_column = int(math.floor((max_lon + 180.0) / cs))
+        cells, coords = self._cells, self._coords
+        for row in range(first_row, last_row + 1):
+            start = bisect.bisect_left(cells, row * columns + first_column)
+            end = bisect.bisect_right(cells, row * columns + last_column, start)
+            for i in range(start, end):
+                lon, lat = coords[2 * i], coords[2 * i + 1]
+                if not (min_lon <= lon <= max_lon and min_lat <= lat <= max_lat):
+                    continue
+                if any(self._tags[key][i] not in ids for key, ids in accepted.items()):
+                    continue
+                yield lon, lat, i
+
+    def _documents(self, records, remaining):
+        """Returns the documents of the records, None for those failing the
+        filters on tags that are not indexed"""
+        docs = self.source.fetch_many([self._refs[i] for i in records])
+        for j, doc in enumerate(docs):
+            for key, wanted in remaining.items():
+                value = doc.get(key)
+                if value != wanted and not (isinstance(value, list) and wanted in value):
+                    docs[j] = None
+                    break
+        return docs
+
+    def bbox(self, min_lon, min_lat, max_lon, max_lat, **filters):
+        """Returns the documents inside a bounding box"""
+        accepted, remaining = self._split_filters(filters)
+        records = [i for _, _, i in self._candidates(min_lon, min_lat, max_lon, max_lat, accepted)]
+        return [doc for doc in self._documents(records, remaining) if doc is not None]
+
+    def radius(self, lon, lat, meters, **filters):
+        """Returns (distance, document) pairs within a distance of a point,
+        nearest first"""
+        accepted, remaining = self._split_filters(filters)
+        dlat = meters / METERS_PER_DEGREE
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-12)
+        found = []
+        for x, y, i in self._candidates(lon - dlon, lat - dlat, lon + dlon, lat + dlat, accepted):
+            distance = haversine(lon, lat, x, y)
+            if distance <= meters:
+                found.append((distance, i))
+        found.sort()
+        docs = self._documents([i for _, i in found], remaining)
+        return [(distance, doc) for (distance, _), doc in zip(found, docs) if doc is not None]
+
+    def nearest(self, lon, lat, k=1, **filters):
+        """Returns the k nearest (distance, document) pairs to a point
+
+        The search square grows until it holds k matches that are closer
+        than the largest circle fitting in the square.
+        """
+        accepted, remaining = self._split_filters(filters)
+        half = self.cell_size
+        checked = {}
+        while True:
+            dlon = half / max(math.cos(math.radians(lat)), 1e-12)
+            fresh = [(x, y, i) for x, y, i in self._candidates(lon - dlon, lat - half,
+                                                               lon + dlon, lat + half, accepted)
+                     if i not in checked]
+            docs = self._documents([i for _, _, i in fresh], remaining)
+            for (x, y, i), doc in zip(fresh, docs):
+                checked[i] = (haversine(lon, lat, x, y), doc) if doc is not None else None
+            found = sorted((hit for hit in checked.values() if hit is not None),
+                           key=lambda hit: hit[0])
+            inscribed = half * METERS_PER_DEGREE
+            if (len(found) >= k and found[k - 1][0] <= inscribed) or half >= 180:
+                return found[:k]
+            half *= 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spatial queries over data.py output")
+    parser.add_argument('command', choices=['build', 'bbox', 'radius', 'nearest'])
+    parser.add_argument('source', help="JSON lines or Parquet file written by data.py")
+    parser.add_argument('args', nargs='*', type=float,
+                        help="bbox: MIN_LON MIN_LAT MAX_LON MAX_LAT, radius: LON LAT METERS, "
+                             "nearest: LON LAT K")
+    parser.add_argument('--cell-size', type=float, default=CELL_SIZE)
+    parser.add_argument('--tag', action='append', default=[], metavar='KEY=VALUE')
+    args = parser.parse_args()
+
+    path = args.source + '.grid'
+    if (args.command == 'build' or not os.path.exists(path + '.json') or
+            not is_current(path, args.source)):
+        index = build_index(args.source, path, args.cell_size)
+        print("indexed {0} documents".format(len(index)))
+    else:
+        index = SpatialIndex(path)
+    filters = dict(tag.split('=', 1) for tag in args.tag)
+    with index:
+        if args.command == 'bbox':
+            for doc in index.bbox(*args.args, **filters):
+                print(json.dumps(doc))
+        elif args.command == 'radius':
+            for distance, doc in index.radius(*args.args, **filters):
+                print("{0:.0f} m\t{1}".format(distance, json.dumps(doc)))
+        elif args.command == 'nearest':
+            lon, lat, k = args.args
+            for distance, doc in index.nearest(lon, lat, int(k), **filters):
+                print("{0:.0f} m\t{1}".format(distance, json.dumps(doc)))
+
+
+if __name__ == '__main__':
+    main()
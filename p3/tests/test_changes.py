@@ -0,0 +1,191 @@
+"""
+Tests of applying change files to converted JSON lines output
+
+Run from the p3 directory:
+    python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import changes  # noqa: E402
+import data  # noqa: E402
+import osmgen  # noqa: E402
+import osmparse  # noqa: E402
+import serializers  # noqa: E402
+import sinks  # noqa: E402
+from osmparse import ET  # noqa: E402
+
+CHANGE_FILE = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+<modify>
+ <node id="{modified}" version="{modified_version}" changeset="2" timestamp="2019-01-01T00:00:00Z"
+       user="editor" uid="7" lat="40.85" lon="14.25">
+  <tag k="amenity" v="cafe"/>
+  <tag k="addr:street" v="Via Roma"/>
+ </node>
+ <node id="{stale}" version="1" changeset="2" timestamp="2019-01-01T00:00:00Z"
+       user="editor" uid="7" lat="40.85" lon="14.25">
+  <tag k="amenity" v="bar"/>
+ </node>
+</modify>
+<create>
+ <node id="999999999" version="1" changeset="2" timestamp="2019-01-01T00:00:00Z"
+       user="editor" uid="7" lat="40.86" lon="14.26">
+  <tag k="amenity" v="restaurant"/>
+ </node>
+</create>
+<delete>
+ <node id="{deleted}" version="{deleted_version}" changeset="2" timestamp="2019-01-01T00:00:00Z"
+       user="editor" uid="7" lat="40.85" lon="14.25"/>
+</delete>
+</osmChange>
+"""
+
+
+def _elements(osm_file):
+    """Returns the parsed elements of a file by (type, id), the etree backend
+    leaves them intact"""
+    return dict(((element.tag, element.attrib['id']), element)
+                for element in osmparse.iterelements(osm_file, backend='etree'))
+
+
+def write_change(filename, action, elements):
+    """Writes a change file with the elements in one action block, each with
+    its version increased"""
+    root = ET.Element('osmChange', version='0.6')
+    block = ET.SubElement(root, action)
+    for element in elements:
+        element.attrib['version'] = str(int(element.attrib['version']) + 1)
+        block.append(element)
+    ET.ElementTree(root).write(filename, encoding='utf-8')
+
+
+def _documents(json_file):
+    return dict(((doc['type'], doc['id']), doc) for doc in data.iterjson(json_file))
+
+
+def _rows(parquet_file):
+    """Returns the rows of a Parquet file by (type, id), with the ids as
+    strings like the documents"""
+    return dict(((row['type'], str(row['id'])), row)
+                for row in sinks.read_parquet(parquet_file).to_pylist())
+
+
+@pytest.fixture(params=['json', 'parquet'])
+def output(request, tmp_path):
+    """Converted file, its apply function and reader"""
+    osm_file = str(tmp_path / 'synthetic.osm')
+    osmgen.write_osm(osm_file, nodes=1000, ways=100, seed=1)
+    if request.param == 'json':
+        data.process_map(osm_file)
+        return osm_file + '.json', changes.apply_to_jsonl, _documents
+    pytest.importorskip('pyarrow')
+    # small row groups, so the changes span several batches
+    parquet_file = osm_file + '.parquet'
+    data.process_map(osm_file, sink=sinks.ParquetSink(parquet_file, row_group_size=200))
+    return parquet_file, changes.apply_to_parquet, _rows
+
+
+@pytest.fixture
+def converted(tmp_path):
+    """File converted with geometry, its kept node index and elements"""
+    osm_file = str(tmp_path / 'areas.osm')
+    osmgen.write_osm(osm_file, nodes=2000, ways=200, seed=1, relations=20)
+    index_path = osm_file + '.nodes'
+    data.process_map(osm_file, geometry=True, index_path=index_path)
+    return osm_file + '.json', index_path, _elements(osm_file)
+
+
+def test_geometry_resolved_from_index(tmp_path, converted):
+    json_file, index_path, elements = converted
+    before = _documents(json_file)
+    relation = next(element for key, element in elements.items()
+                    if key[0] == 'relation' and 'multipolygon' in before[key])
+    members = set(member.attrib['ref'] for member in relation.findall('member'))
+    way = next(element for key, element in elements.items()
+               if key[0] == 'way' and key[1] not in members and 'geometry' in before[key])
+    node = elements[('node', way.findall('nd')[0].attrib['ref'])]
+    node.attrib['lon'], node.attrib['lat'] = '14.2', '40.8'
+    osc_file = str(tmp_path / 'change.osc')
+    write_change(osc_file, 'modify', [node, way, relation])
+
+    counts = changes.apply_to_jsonl(changes.load_changes(osc_file, index_path=index_path),
+                                    json_file)
+    assert counts == {'create': 0, 'modify': 3, 'delete': 0}
+    after = _documents(json_file)
+    way_key, relation_key = ('way', way.attrib['id']), ('relation', relation.attrib['id'])
+    geometry = before[way_key]['geometry']
+    # the moved node of the change replaces the indexed one, wherever the way uses it
+    first = geometry[0]
+    assert after[way_key]['geometry'] == [[14.2, 40.8] if c == first else c for c in geometry]
+    for key in ('multipolygon', 'bbox', 'centroid'):
+        assert after[relation_key][key] == before[relation_key][key]
+
+
+def test_geometry_required(tmp_path, converted):
+    json_file, _, elements = converted
+    way = next(element for key, element in elements.items() if key[0] == 'way')
+    osc_file = str(tmp_path / 'change.osc')
+    write_change(osc_file, 'modify', [way])
+    with open(json_file, 'rb') as fi:
+        before = fi.read()
+
+    with pytest.raises(ValueError, match='--index'):
+        changes.apply_to_jsonl(changes.load_changes(osc_file), json_file)
+    with open(json_file, 'rb') as fi:
+        assert fi.read() == before
+    assert not os.path.exists(json_file + '.tmp')
+
+
+def test_changed_lines_use_the_sink_serializer(tmp_path):
+    osm_file = str(tmp_path / 'small.osm')
+    osmgen.write_osm(osm_file, nodes=500, ways=50, seed=1)
+    data.process_map(osm_file)
+    node = _elements(osm_file)[('node', '1')]
+    ET.SubElement(node, 'tag', k='name', v=u'Caffè dell’Epoca')
+    osc_file = str(tmp_path / 'change.osc')
+    write_change(osc_file, 'modify', [node])
+
+    changes.apply_to_jsonl(changes.load_changes(osc_file), osm_file + '.json')
+    expected = serializers.get_serializer().dumps(data.shape_document(node)) + b"\n"
+    with open(osm_file + '.json', 'rb') as fi:
+        assert expected in fi.readlines()
+
+
+def test_round_trip(tmp_path, output):
+    filename, apply_changes, read = output
+    before = read(filename)
+    nodes = sorted(int(element_id) for element_type, element_id in before
+                   if element_type == 'node')
+    modified, stale, deleted = [before[('node', str(node_id))] for node_id in nodes[:3]]
+    osc_file = str(tmp_path / 'change.osc')
+    with open(osc_file, 'w') as fo:
+        fo.write(CHANGE_FILE.format(
+            modified=modified['id'], modified_version=int(modified['created']['version']) + 1,
+            stale=stale['id'], deleted=deleted['id'],
+            deleted_version=int(deleted['created']['version']) + 1))
+
+    counts = apply_changes(changes.load_changes(osc_file), filename)
+    assert counts == {'create': 1, 'modify': 1, 'delete': 1}
+    after = read(filename)
+    assert len(after) == len(before)
+    doc = after[('node', str(modified['id']))]
+    assert doc['amenity'] == 'cafe'
+    assert doc['address']['street'] == 'Via Roma'
+    assert after[('node', str(stale['id']))] == stale
+    assert ('node', str(deleted['id'])) not in after
+    assert after[('node', '999999999')]['amenity'] == 'restaurant'
+
+    # the stored versions are now current, so applying the diff again changes nothing
+    with open(filename, 'rb') as fi:
+        content = fi.read()
+    counts = apply_changes(changes.load_changes(osc_file), filename)
+    assert counts == {'create': 0, 'modify': 0, 'delete': 0}
+    assert read(filename) == after
+    if filename.endswith('.json'):
+        with open(filename, 'rb') as fi:
+            assert fi.read() == content
@@ -0,0 +1,80 @@
+"""
+Tests of the serial and parallel conversions and of the pretty output they
+cannot read back
+
+Run from the p3 directory:
+    python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import changes  # noqa: E402
+import data  # noqa: E402
+import osmgen  # noqa: E402
+import serializers  # noqa: E402
+import sinks  # noqa: E402
+import spatialindex  # noqa: E402
+
+CHANGE_FILE = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+<create>
+ <node id="999999999" version="1" changeset="2" timestamp="2019-01-01T00:00:00Z"
+       user="editor" uid="7" lat="40.86" lon="14.26">
+  <tag k="amenity" v="restaurant"/>
+ </node>
+</create>
+</osmChange>
+"""
+
+
+@pytest.fixture
+def osm_file(tmp_path):
+    filename = str(tmp_path / 'synthetic.osm')
+    osmgen.write_osm(filename, nodes=3000, ways=300, seed=1, relations=30)
+    return filename
+
+
+def _content(filename):
+    with serializers.open_input(filename) as fi:
+        return fi.read()
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip', 'zstd'])
+def test_serial_and_parallel_match(osm_file, compression):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    suffix = serializers.COMPRESSIONS[compression]
+    serial_file = osm_file + '.serial.json' + suffix
+    sink = sinks.JsonLinesSink(serial_file, compression=compression)
+    count = data.process_map(osm_file, sink=sink)
+
+    # small ranges, so the output is merged from several shards
+    parallel_count, files = data.process_map_parallel(
+        osm_file, workers=2, chunk_size=64 * 1024, compression=compression)
+    assert parallel_count == count
+    assert files == [osm_file + '.json' + suffix]
+    assert _content(files[0]) == _content(serial_file)
+    assert len(_content(files[0]).splitlines()) == count
+
+
+def test_pretty_rejected(tmp_path, osm_file):
+    data.process_map(osm_file, pretty=True)
+    json_file = osm_file + '.json'
+    with open(json_file, 'rb') as fi:
+        before = fi.read()
+
+    with pytest.raises(ValueError, match='pretty'):
+        list(data.iterjson(json_file))
+    osc_file = str(tmp_path / 'change.osc')
+    with open(osc_file, 'w') as fo:
+        fo.write(CHANGE_FILE)
+    with pytest.raises(ValueError, match='pretty'):
+        changes.apply_to_jsonl(changes.load_changes(osc_file), json_file)
+    with open(json_file, 'rb') as fi:
+        assert fi.read() == before
+    with pytest.raises(ValueError, match='pretty'):
+        spatialindex.build_index(json_file)
@@ -0,0 +1,115 @@
+"""
+Tests of the MongoDB loading and change application against mongomock
+
+Run from the p3 directory:
+    python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+pytest.importorskip('pymongo')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import changes  # noqa: E402
+import data  # noqa: E402
+import osmgen  # noqa: E402
+import sinks  # noqa: E402
+
+BATCH_SIZE = 100
+
+CHANGE_FILE = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+<modify>
+ <node id="{modified}" version="{modified_version}" changeset="2" timestamp="2019-01-01T00:00:00Z"
+       user="editor" uid="7" lat="40.85" lon="14.25">
+  <tag k="amenity" v="cafe"/>
+  <tag k="addr:street" v="Via Roma"/>
+ </node>
+ <node id="{stale}" version="1" changeset="2" timestamp="2019-01-01T00:00:00Z"
+       user="editor" uid="7" lat="40.85" lon="14.25">
+  <tag k="amenity" v="bar"/>
+ </node>
+</modify>
+<create>
+ <node id="999999999" version="1" changeset="2" timestamp="2019-01-01T00:00:00Z"
+       user="editor" uid="7" lat="40.86" lon="14.26">
+  <tag k="amenity" v="restaurant"/>
+ </node>
+</create>
+<delete>
+ <node id="{deleted}" version="{deleted_version}" changeset="2" timestamp="2019-01-01T00:00:00Z"
+       user="editor" uid="7" lat="40.85" lon="14.25"/>
+</delete>
+</osmChange>
+"""
+
+
+@pytest.fixture
+def osm_file(tmp_path):
+    filename = str(tmp_path / 'synthetic.osm')
+    osmgen.write_osm(filename, nodes=1000, ways=100, seed=1)
+    return filename
+
+
+@pytest.fixture
+def loaded(osm_file):
+    """Collection loaded through a MongoSink, and the sink"""
+    collection = mongomock.MongoClient().osm.napoli
+    sink = sinks.MongoSink(collection, batch_size=BATCH_SIZE)
+    data.process_map(osm_file, sink=sink)
+    return collection, sink
+
+
+def test_batched_insert(osm_file, loaded):
+    collection, sink = loaded
+    expected = list(data.iterjson(_json_output(osm_file)))
+    assert sink.count == len(expected) == collection.count_documents({})
+    assert sink.batches == -(-len(expected) // BATCH_SIZE)
+    stored = dict(((doc['type'], doc['id']), doc) for doc in collection.find({}, {'_id': 0}))
+    assert stored == dict(((doc['type'], doc['id']), doc) for doc in expected)
+
+
+def test_indexes(loaded):
+    collection, _ = loaded
+    indexes = collection.index_information()
+    assert indexes['pos_2dsphere']['key'] == [('pos', '2dsphere')]
+    assert indexes['address.street_1']['key'] == [('address.street', 1)]
+    assert indexes['amenity_1']['key'] == [('amenity', 1)]
+
+
+def test_apply_changes(tmp_path, loaded):
+    collection, _ = loaded
+    modified, stale, deleted = collection.find({'type': 'node'}).sort('id', 1).limit(3)
+    osc_file = str(tmp_path / 'change.osc')
+    with open(osc_file, 'w') as fo:
+        fo.write(CHANGE_FILE.format(
+            modified=modified['id'], modified_version=int(modified['created']['version']) + 1,
+            stale=stale['id'], deleted=deleted['id'],
+            deleted_version=int(deleted['created']['version']) + 1))
+    count = collection.count_documents({})
+
+    counts = changes.apply_to_mongo(changes.load_changes(osc_file), collection)
+    assert counts == {'create': 1, 'modify': 1, 'delete': 1}
+    assert collection.count_documents({}) == count
+    doc = collection.find_one({'type': 'node', 'id': modified['id']})
+    assert doc['amenity'] == 'cafe'
+    assert doc['address'] == {'street': 'Via Roma'}
+    assert collection.find_one({'type': 'node', 'id': stale['id']})['created'] == stale['created']
+    assert collection.find_one({'type': 'node', 'id': deleted['id']}) is None
+    assert collection.find_one({'type': 'node', 'id': '999999999'})['amenity'] == 'restaurant'
+
+    # the stored versions are now current, so applying the diff again changes nothing
+    before = list(collection.find({}, {'_id': 0}).sort([('type', 1), ('id', 1)]))
+    counts = changes.apply_to_mongo(changes.load_changes(osc_file), collection)
+    assert counts == {'create': 0, 'modify': 0, 'delete': 0}
+    assert list(collection.find({}, {'_id': 0}).sort([('type', 1), ('id', 1)])) == before
+
+
+def _json_output(osm_file):
+    """Converts the file to JSON lines, the reference for the loaded documents"""
+    data.process_map(osm_file)
+    return osm_file + '.json'
@@ -0,0 +1,59 @@
+"""
+Tests of the external sorts of unsorted node and way indexes
+
+Run from the p3 directory:
+    python -m pytest tests
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nodeindex  # noqa: E402
+
+
+def _point(rnd):
+    return round(rnd.uniform(14, 15), 7), round(rnd.uniform(40, 41), 7)
+
+
+def test_unsorted_nodes(tmp_path, monkeypatch):
+    # small runs and merge chunks, so the sort merges several runs
+    monkeypatch.setattr(nodeindex, 'MERGE_CHUNK_NODES', 64)
+    rnd = random.Random(1)
+    nodes = dict((node_id, _point(rnd)) for node_id in rnd.sample(range(1, 10 ** 6), 2000))
+    writer = nodeindex.NodeIndexWriter(str(tmp_path / 'nodes'))
+    for node_id, (lon, lat) in nodes.items():
+        writer.add(node_id, lon, lat)
+    assert not writer.sorted
+    writer._flush()
+    for fo in (writer._ids_file, writer._coords_file):
+        fo.close()
+    nodeindex._sort_index(writer.path, writer.count, 300)
+    with nodeindex.NodeIndex(writer.path) as index:
+        assert list(index._ids) == sorted(nodes)
+        for node_id, location in nodes.items():
+            assert index.get(node_id) == location
+    assert sorted(os.listdir(str(tmp_path))) == ['nodes.coords', 'nodes.ids']
+
+
+def test_unsorted_ways(tmp_path, monkeypatch):
+    monkeypatch.setattr(nodeindex, 'MERGE_CHUNK_NODES', 16)
+    rnd = random.Random(1)
+    ways = dict((way_id, [_point(rnd) for _ in range(rnd.choice([0, 1, 2, 5, 40]))])
+                for way_id in rnd.sample(range(1, 10 ** 6), 1000))
+    writer = nodeindex.WayIndexWriter(str(tmp_path / 'ways'))
+    for way_id, coords in ways.items():
+        writer.add(way_id, coords)
+    assert not writer.sorted
+    writer._flush()
+    for fo in (writer._ids_file, writer._offsets_file, writer._coords_file):
+        fo.close()
+    # runs bounded by coordinate pairs, one of them shorter than a way
+    for run_pairs in (1, 500, 10 ** 6):
+        nodeindex._sort_ways(writer.path, writer.count, run_pairs)
+        with nodeindex.WayIndex(writer.path) as index:
+            assert list(index._ids) == sorted(ways)
+            for way_id, coords in ways.items():
+                assert index.get(way_id) == coords
+    assert sorted(os.listdir(str(tmp_path))) == ['ways.coords', 'ways.ids', 'ways.offsets']
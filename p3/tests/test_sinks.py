@@ -0,0 +1,63 @@
+"""
+Tests of the compressed JSON lines sinks and of reading them back
+
+Run from the p3 directory:
+    python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data  # noqa: E402
+import osmgen  # noqa: E402
+import serializers  # noqa: E402
+import sinks  # noqa: E402
+
+
+@pytest.fixture
+def json_file(tmp_path):
+    osm_file = str(tmp_path / 'synthetic.osm')
+    osmgen.write_osm(osm_file, nodes=3000, ways=300, seed=1)
+    data.process_map(osm_file)
+    return osm_file + '.json'
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd'])
+@pytest.mark.parametrize('serializer', ['json', 'orjson', 'ujson'])
+def test_compressed_round_trip(json_file, compression, serializer):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    if serializer != 'json':
+        pytest.importorskip(serializer)
+    documents = list(data.iterjson(json_file))
+    compressed_file = json_file + serializers.COMPRESSIONS[compression]
+    # a small buffer, so the output spans many writes
+    with sinks.JsonLinesSink(compressed_file, serializer=serializer, compression=compression,
+                             buffer_size=4096, threads=2) as sink:
+        for doc in documents:
+            sink.write(doc)
+    assert sink.count == len(documents)
+
+    assert serializers.detect_compression(compressed_file) == compression
+    with serializers.open_input(compressed_file) as fi:
+        assert [serializers.loads_line(line, compressed_file) for line in fi] == documents
+    assert list(data.iterjson(compressed_file)) == documents
+
+
+def test_gzip_members_round_trip(tmp_path):
+    gz_file = str(tmp_path / 'lines.json.gz')
+    lines = [u'{{"id": "{0}", "name": "Caff\u00e8 {0}"}}\n'.format(i).encode('utf-8')
+             for i in range(5000)]
+    # small blocks, so the file is many gzip members compressed in threads
+    writer = serializers.ParallelGzipWriter(gz_file, threads=2, block_size=1000)
+    for line in lines:
+        writer.write(line)
+    writer.close()
+
+    with open(gz_file, 'rb') as fi:
+        assert fi.read().count(serializers.GZIP_MAGIC) > 10
+    with serializers.open_input(gz_file) as fi:
+        assert fi.readlines() == lines
@@ -0,0 +1,117 @@
+"""
+Tests of the grid spatial index queries and of the sources it refuses
+
+Run from the p3 directory:
+    python -m pytest tests
+"""
+import gzip
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import changes  # noqa: E402
+import data  # noqa: E402
+import osmgen  # noqa: E402
+import sinks  # noqa: E402
+import spatialindex  # noqa: E402
+
+CENTER = (14.25, 40.85)
+
+CHANGE_FILE = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+<modify>
+ <node id="{id}" version="{version}" changeset="2" timestamp="2019-01-01T00:00:00Z"
+       user="editor" uid="7" lat="40.85" lon="14.25">
+  <tag k="amenity" v="restaurant"/>
+  <tag k="name" v="Da Michele"/>
+ </node>
+</modify>
+</osmChange>
+"""
+
+
+@pytest.fixture
+def json_file(tmp_path):
+    osm_file = str(tmp_path / 'synthetic.osm')
+    osmgen.write_osm(osm_file, nodes=3000, ways=300, seed=1, tag_density=0.5)
+    data.process_map(osm_file)
+    return osm_file + '.json'
+
+
+@pytest.fixture(params=['json', 'parquet'])
+def source_file(request, json_file):
+    if request.param == 'json':
+        return json_file
+    pytest.importorskip('pyarrow')
+    parquet_file = json_file[:-len('.json')] + '.parquet'
+    # small row groups, so fetches span several groups
+    with sinks.ParquetSink(parquet_file, row_group_size=500) as sink:
+        for doc in data.iterjson(json_file):
+            sink.write(doc)
+    return parquet_file
+
+
+def _located(json_file):
+    for doc in data.iterjson(json_file):
+        location = doc.get('pos') or doc.get('centroid')
+        if location:
+            yield location, doc
+
+
+def test_queries_match_a_scan(json_file, source_file):
+    # Parquet documents have int ids, so ids are compared as strings
+    located = list(_located(json_file))
+    lon, lat = CENTER
+    with spatialindex.build_index(source_file) as index:
+        assert len(index) == len(located)
+
+        expected = sorted(doc['id'] for (x, y), doc in located
+                          if 14.2 <= x <= 14.3 and 40.8 <= y <= 40.9)
+        assert sorted(str(doc['id']) for doc in index.bbox(14.2, 40.8, 14.3, 40.9)) == expected
+
+        distances = sorted((spatialindex.haversine(lon, lat, x, y), doc['id'])
+                           for (x, y), doc in located if doc.get('amenity') == 'restaurant')
+        found = index.radius(lon, lat, 5000, amenity='restaurant')
+        assert [str(doc['id']) for _, doc in found] == [i for d, i in distances if d <= 5000]
+        nearest = index.nearest(lon, lat, 5, amenity='restaurant')
+        assert [str(doc['id']) for _, doc in nearest] == [i for _, i in distances[:5]]
+
+
+def test_stale_index(tmp_path, json_file):
+    path = json_file + '.grid'
+    spatialindex.build_index(json_file, path).close()
+    assert spatialindex.is_current(path)
+
+    node = next(doc for doc in data.iterjson(json_file) if doc['type'] == 'node')
+    osc_file = str(tmp_path / 'change.osc')
+    with open(osc_file, 'w') as fo:
+        fo.write(CHANGE_FILE.format(id=node['id'], version=int(node['created']['version']) + 1))
+    changes.apply_to_jsonl(changes.load_changes(osc_file), json_file)
+
+    assert not spatialindex.is_current(path)
+    with pytest.raises(ValueError, match='stale'):
+        spatialindex.SpatialIndex(path)
+    with spatialindex.build_index(json_file, path) as index:
+        nearest = index.nearest(CENTER[0], CENTER[1], 1, name='Da Michele')
+        assert [doc['id'] for _, doc in nearest] == [node['id']]
+
+
+def test_gzip_source_rejected(json_file):
+    gz_file = json_file + '.gz'
+    with open(json_file, 'rb') as fi, gzip.open(gz_file, 'wb') as fo:
+        shutil.copyfileobj(fi, fo)
+    with pytest.raises(ValueError, match='gzip compressed'):
+        spatialindex.build_index(gz_file)
+
+
+def test_zstd_source_rejected(json_file):
+    zstandard = pytest.importorskip('zstandard')
+    zst_file = json_file + '.zst'
+    with open(json_file, 'rb') as fi, open(zst_file, 'wb') as fo:
+        zstandard.ZstdCompressor().copy_stream(fi, fo)
+    with pytest.raises(ValueError, match='zstd compressed'):
+        spatialindex.build_index(zst_file)
@@ -9,6 +9,12 @@ sys.path.append("../tools/")
 
 from feature_format import featureFormat, targetFeatureSplit
 from tester import dump_classifier_and_data
+from splitcache import CachedStratifiedShuffleSplit
+from search import search
+
+# Pass 'grid' to rerun the exhaustive grid searches below, or 'halving' or
+# 'random' to run them with the faster drivers of search.py
+SEARCH = sys.argv[1] if len(sys.argv) > 1 else None
 
 # Task 1: Select what features you'll use.
 # features_list is a list of strings, each of which is a feature name.
@@ -58,7 +64,7 @@ my_dataset = df.T.to_dict()
 
 # Provided to give you a starting point. Try a variety of classifiers.
 from sklearn.pipeline import Pipeline
-from sklearn.model_selection import GridSearchCV, StratifiedShuffleSplit
+from sklearn.model_selection import GridSearchCV
 from sklearn.preprocessing import StandardScaler, MinMaxScaler, MaxAbsScaler, RobustScaler
 from sklearn.feature_selection import SelectKBest, f_classif
 from sklearn.svm import LinearSVC
@@ -103,13 +109,20 @@ param_grid = [
     }
 ]
 
-grid = GridSearchCV(pipe, cv=StratifiedShuffleSplit(n_splits=50, random_state=35),
+# Both grid searches use the same splits, their fold indices are computed once
+# and stored in the split cache, see splitcache.py
+cv = CachedStratifiedShuffleSplit(n_splits=50, random_state=35)
+
+grid = GridSearchCV(pipe, cv=cv,
                     param_grid=param_grid, scoring='f1')
 
-# These lines can be uncommented to reproduce grid search
+# Run with the SEARCH argument to reproduce the grid search
 # The best result was achieved using the top 6 features and a DecisionTreeClassifier
-# grid.fit(features, labels)
-# print grid.best_estimator_
+if SEARCH == 'grid':
+    grid.fit(features, labels)
+    print(grid.best_estimator_)
+elif SEARCH is not None:
+    print(search(SEARCH, pipe, param_grid, features, labels, cv).report())
 
 
 
@@ -140,12 +153,15 @@ tuning_param_grid = [
     }
 ]
 
-tuning_grid = GridSearchCV(tuning_pipe, cv=StratifiedShuffleSplit(n_splits=50, random_state=35),
+tuning_grid = GridSearchCV(tuning_pipe, cv=cv,
                            param_grid=tuning_param_grid, scoring='f1')
 
-# tuning_grid.fit(features, labels)
-# print tuning_grid.best_estimator_
-# The above lines can be uncommented to rerun the gridsearch. The clf classifier below
+if SEARCH == 'grid':
+    tuning_grid.fit(features, labels)
+    print(tuning_grid.best_estimator_)
+elif SEARCH is not None:
+    print(search(SEARCH, tuning_pipe, tuning_param_grid, features, labels, cv).report())
+# The searches above run when poi_id.py is given the SEARCH argument. The clf classifier below
 # has been initialized using the best results
 
 clf = DecisionTreeClassifier(
@@ -0,0 +1,230 @@
+#!/usr/bin/python
+
+""" faster alternatives to the exhaustive GridSearchCV of poi_id.py
+
+    GridSearchCV fits every candidate of the parameter grid on every fold.
+    The drivers below spend the fits on the promising candidates instead:
+
+        halving: successive halving, every candidate is scored on a few
+                 folds, the best 1 / factor of them go on to a round with
+                 factor times as many folds, until the survivors are scored
+                 on all folds
+        random:  candidates are drawn from the grid in random order and
+                 scored on all folds until the time budget runs out
+
+    Both stop scoring a candidate early once its mean score on the folds so
+    far is clearly below the best mean score of the candidates scored on all
+    folds of the search (of the round, for halving): below it by more than
+    prune_z standard errors, after at least min_folds folds.
+
+    The folds are the same for every candidate, so a fold scores the same
+    as in GridSearchCV. Pipelines are fitted through a FoldCache, which fits
+    the steps the candidates share once per fold, see foldcache.py. The
+    result reports the fits made and those saved compared with the
+    exhaustive grid.
+"""
+
+import time
+from collections import namedtuple
+
+import numpy as np
+from sklearn.base import clone
+from sklearn.metrics import check_scoring
+from sklearn.model_selection import ParameterGrid
+from sklearn.pipeline import Pipeline
+
+from foldcache import FoldCache
+
+REPORT_FORMAT_STRING = "\
+best score: {best_score:.5f} on {best_folds} folds\n\
+best params: {best_params}\n\
+fits: {fits} of {exhaustive_fits} for the exhaustive grid, {saved} saved ({saved_fraction:.0%})\n\
+candidates: {scored} of {grid_size}, pruned: {pruned}, scored on all folds: {completed}"
+
+# params: parameters of the candidate
+# scores: array of its scores on the folds it was scored on, in fold order
+# pruned: whether it was pruned before all folds were scored
+Candidate = namedtuple('Candidate', ['params', 'scores', 'pruned'])
+
+
+class SearchResult(namedtuple('SearchResult', ['mode', 'candidates', 'n_folds', 'fits',
+                                               'exhaustive_fits', 'best_params', 'best_score',
+                                               'best_folds'])):
+    """ outcome of a search
+
+        candidates holds the Candidates that were scored, best_score is the
+        mean score of the best candidate on its best_folds folds
+    """
+
+    @property
+    def fits_saved(self):
+        return self.exhaustive_fits - self.fits
+
+    def report(self):
+        """ returns a summary of the best candidate and the fits saved """
+        return REPORT_FORMAT_STRING.format(
+            saved = self.fits_saved,
+            saved_fraction = self.fits_saved / float(self.exhaustive_fits),
+            scored = len(self.candidates),
+            grid_size = self.exhaustive_fits // self.n_folds,
+            pruned = sum(candidate.pruned for candidate in self.candidates),
+            completed = sum(len(candidate.scores) == self.n_folds
+                            for candidate in self.candidates),
+            **self._asdict())
+
+
+class _Scorer(object):
+    """ fits and scores candidates of estimator on the folds
+
+        fits counts the candidate fits, whether or not the fold cache saved
+        refitting their leading pipeline steps
+    """
+
+    def __init__(self, estimator, features, labels, folds, scoring, memory):
+        self.estimator = estimator
+        self.features = np.asarray(features)
+        self.labels = np.asarray(labels)
+        self.folds = folds
+        self.score = check_scoring(estimator, scoring = scoring)
+        self.cache = None
+        if isinstance(estimator, Pipeline):
+            self.cache = FoldCache(estimator, self.features, self.labels, folds, memory)
+        self.fits = 0
+
+    def __call__(self, params, fold):
+        """ returns the score of the candidate on a fold """
+        train_idx, test_idx = self.folds[fold]
+        self.fits += 1
+        if self.cache is not None:
+            estimator, test = self.cache.fit(params, fold)
+            return self.score(estimator, test, self.labels[test_idx])
+        # params may hold estimators, so they are cloned as GridSearchCV does
+        estimator = clone(self.estimator).set_params(**clone(params, safe = False))
+        estimator.fit(self.features[train_idx], self.labels[train_idx])
+        return self.score(estimator, self.features[test_idx], self.labels[test_idx])
+
+
+def _clearly_below(scores, best_score, min_folds, prune_z):
+    """ whether the mean of the scores is more than prune_z standard errors
+        below best_score
+    """
+    if prune_z is None or best_score is None or len(scores) < min_folds:
+        return False
+    sem = np.std(scores, ddof = 1) / np.sqrt(len(scores))
+    return np.mean(scores) + prune_z * sem < best_score
+
+
+def _best(best_score, scores):
+    score = np.mean(scores)
+    return score if best_score is None else max(best_score, score)
+
+
+def _score_folds(scorer, params, scores, stop, best_score, min_folds, prune_z):
+    """ extends the scores of a candidate up to fold stop, pruning early
+
+        :return: tuple of the scores and whether the candidate was pruned
+    """
+    for fold in range(len(scores), stop):
+        scores.append(scorer(params, fold))
+        if _clearly_below(scores, best_score, min_folds, prune_z):
+            return scores, True
+    return scores, False
+
+
+def _result(mode, candidates, scorer, n_candidates, n_folds):
+    # the best candidate is scored on the most folds, as halving compares
+    # candidates on equal numbers of folds
+    best = max(candidates, key = lambda candidate: (not candidate.pruned, len(candidate.scores),
+                                                    np.mean(candidate.scores)))
+    return SearchResult(mode, candidates, n_folds, scorer.fits, n_candidates * n_folds,
+                        best.params, np.mean(best.scores), len(best.scores))
+
+
+def successive_halving(estimator, param_grid, features, labels, cv, scoring = 'f1',
+                       first_folds = 5, factor = 3, min_folds = 10, prune_z = 2.0,
+                       memory = None):
+    """ searches the grid with successive halving over the folds of cv
+
+        :param first_folds: number of folds of the first round
+        :param factor: 1 / factor of the candidates survive each round
+        :param min_folds: number of folds a candidate is scored on before it
+            can be pruned, the F1 scores of a few folds vary too much
+        :param prune_z: pruning threshold in standard errors, None disables
+            pruning
+        :param memory: joblib Memory or directory to store the fold cache
+            of pipelines in, None to keep it in memory for the search
+        :return: SearchResult
+    """
+    folds = list(cv.split(features, labels))
+    scorer = _Scorer(estimator, features, labels, folds, scoring, memory)
+    params = list(ParameterGrid(param_grid))
+    scores = [[] for _ in params]
+    pruned = [False] * len(params)
+    survivors = list(range(len(params)))
+    stop = min(first_folds, len(folds))
+    while True:
+        best_score = None
+        for i in survivors:
+            scores[i], pruned[i] = _score_folds(scorer, params[i], scores[i], stop, best_score,
+                                                min_folds, prune_z)
+            if not pruned[i]:
+                best_score = _best(best_score, scores[i])
+        # survivors are scored best first, so the bar for pruning is high early
+        ranked = sorted((i for i in survivors if not pruned[i]),
+                        key = lambda i: np.mean(scores[i]), reverse = True)
+        if stop == len(folds):
+            break
+        survivors = ranked[:max(1, len(ranked) // factor)]
+        stop = min(stop * factor, len(folds))
+    candidates = [Candidate(p, np.array(s), was_pruned)
+                  for p, s, was_pruned in zip(params, scores, pruned)]
+    return _result('halving', candidates, scorer, len(params), len(folds))
+
+
+def random_search(estimator, param_grid, features, labels, cv, scoring = 'f1',
+                  time_budget = 60.0, n_iter = None, random_state = None, min_folds = 10,
+                  prune_z = 2.0, memory = None):
+    """ scores candidates drawn from the grid without replacement until the
+        time budget or n_iter candidates are used up
+
+        the candidate being scored when the budget runs out is finished
+        :param time_budget: seconds, None for no limit
+        :param n_iter: maximum number of candidates, None for the whole grid
+        :param min_folds: number of folds a candidate is scored on before it
+            can be pruned
+        :param prune_z: pruning threshold in standard errors, None disables
+            pruning
+        :param memory: joblib Memory or directory to store the fold cache
+            of pipelines in, None to keep it in memory for the search
+        :return: SearchResult
+    """
+    start = time.time()
+    folds = list(cv.split(features, labels))
+    scorer = _Scorer(estimator, features, labels, folds, scoring, memory)
+    grid = ParameterGrid(param_grid)
+    order = np.random.RandomState(random_state).permutation(len(grid))
+    if n_iter is not None:
+        order = order[:n_iter]
+    candidates = []
+    best_score = None
+    for index in order:
+        if time_budget is not None and time.time() - start > time_budget:
+            break
+        params = grid[index]
+        scores, pruned = _score_folds(scorer, params, [], len(folds), best_score, min_folds,
+                                      prune_z)
+        candidates.append(Candidate(params, np.array(scores), pruned))
+        if not pruned:
+            best_score = _best(best_score, scores)
+    return _result('random', candidates, scorer, len(grid), len(folds))
+
+
+SEARCHES = {'halving': successive_halving, 'random': random_search}
+
+
+def search(mode, estimator, param_grid, features, labels, cv, **kwargs):
+    """ runs the search driver named mode, 'halving' or 'random' """
+    if mode not in SEARCHES:
+        raise ValueError("Unknown search mode '{0}', expected one of {1}".format(
+            mode, ', '.join(sorted(SEARCHES))))
+    return SEARCHES[mode](estimator, param_grid, features, labels, cv, **kwargs)
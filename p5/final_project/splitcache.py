@@ -0,0 +1,104 @@
+#!/usr/bin/python
+
+""" cache of stratified shuffle split fold indices
+
+    poi_id.py runs two grid searches over the same 50 splits and tester.py
+    evaluates the final classifier on 1000 splits. Instead of drawing the
+    splits again in every run, the train and test indices are computed once
+    for a given labels array, number of splits, test size and seed, and
+    stored as int32 matrices, one row per fold, in an .npz file of the cache
+    directory. Later runs load the file and serve the same folds.
+
+    CachedStratifiedShuffleSplit is a StratifiedShuffleSplit whose split()
+    reads the cache, so it can be passed as cv to GridSearchCV. Splitters
+    without an int random_state are not reproducible and are not cached.
+"""
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import sklearn
+from sklearn.model_selection import StratifiedShuffleSplit
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "split_cache")
+
+
+def splits_key(labels, n_splits, test_size, train_size, random_state):
+    """ returns the name of the cache file of a set of splits
+
+        the scikit-learn version is part of the key, since the algorithm
+        drawing the splits may change between releases
+    """
+    labels = np.ascontiguousarray(labels)
+    digest = hashlib.sha1()
+    digest.update(labels.dtype.str.encode("ascii"))
+    digest.update(labels.tobytes())
+    digest.update(repr((n_splits, test_size, train_size, random_state,
+                        sklearn.__version__)).encode("ascii"))
+    return "sss-{0}-{1}-{2}.npz".format(n_splits, random_state, digest.hexdigest()[:16])
+
+
+def compute_splits(labels, n_splits, test_size = None, train_size = None, random_state = None):
+    """ draws the splits
+
+        :return: tuple of the train and test index matrices, int32 with one
+            row per fold
+    """
+    labels = np.asarray(labels)
+    cv = StratifiedShuffleSplit(n_splits = n_splits, test_size = test_size,
+                                train_size = train_size, random_state = random_state)
+    train, test = zip(*cv.split(np.zeros((len(labels), 1)), labels))
+    return np.array(train, dtype = np.int32), np.array(test, dtype = np.int32)
+
+
+def load_splits(labels, n_splits, test_size = None, train_size = None, random_state = None,
+                cache_dir = CACHE_DIR):
+    """ returns the train and test index matrices of the splits, from the
+        cache if they were computed before, storing them otherwise
+    """
+    path = os.path.join(cache_dir, splits_key(labels, n_splits, test_size, train_size,
+                                              random_state))
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            return cached["train"], cached["test"]
+    train, test = compute_splits(labels, n_splits, test_size, train_size, random_state)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # write to a temporary file and rename, so concurrent runs never read
+    # a partially written file
+    fd, tmp_path = tempfile.mkstemp(suffix = ".npz", dir = cache_dir)
+    try:
+        with os.fdopen(fd, "wb") as fo:
+            np.savez(fo, train = train, test = test)
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return train, test
+
+
+class CachedStratifiedShuffleSplit(StratifiedShuffleSplit):
+    """ StratifiedShuffleSplit serving its folds from the split cache
+
+        :param cache_dir: directory of the cached .npz files
+    """
+
+    def __init__(self, n_splits = 10, test_size = None, train_size = None, random_state = None,
+                 cache_dir = CACHE_DIR):
+        super(CachedStratifiedShuffleSplit, self).__init__(
+            n_splits = n_splits, test_size = test_size, train_size = train_size,
+            random_state = random_state)
+        self.cache_dir = cache_dir
+
+    def split(self, X, y, groups = None):
+        """ yields the (train indices, test indices) of every fold """
+        if not isinstance(self.random_state, (int, np.integer)):
+            for fold in super(CachedStratifiedShuffleSplit, self).split(X, y, groups):
+                yield fold
+            return
+        train, test = load_splits(y, self.n_splits, self.test_size, self.train_size,
+                                  self.random_state, self.cache_dir)
+        for train_idx, test_idx in zip(train, test):
+            yield train_idx, test_idx
@@ -15,10 +15,19 @@
 import pickle
 import sys
 import os
-from sklearn.cross_validation import StratifiedShuffleSplit
+import warnings
+from collections import namedtuple
+
+import numpy as np
+from sklearn.base import clone
+try:
+    import joblib
+except ImportError:
+    from sklearn.externals import joblib
 sys.path.append("../tools/")
 
 from feature_format import featureFormat, targetFeatureSplit
+from splitcache import CachedStratifiedShuffleSplit
 
 PERF_FORMAT_STRING = "\
 \tAccuracy: {:>0.{display_precision}f}\tPrecision: {:>0.{display_precision}f}\t\
@@ -26,57 +35,152 @@ Recall: {:>0.{display_precision}f}\tF1: {:>0.{display_precision}f}\tF2: {:>0.{di
 RESULTS_FORMAT_STRING = "\tTotal predictions: {:4d}\tTrue positives: {:4d}\tFalse positives: {:4d}\
 \tFalse negatives: {:4d}\tTrue negatives: {:4d}"
 
-def test_classifier(clf, dataset, feature_list, folds = 1000):
+
+class EvaluationResult(namedtuple('EvaluationResult', [
+        'clf', 'folds', 'true_positives', 'false_positives', 'false_negatives',
+        'true_negatives', 'invalid_predictions'])):
+    """ confusion counts of a classifier summed over all cross-validation
+        folds, with the metrics derived from them
+
+        the metrics raise ZeroDivisionError when they are undefined, e.g.
+        precision without any positive prediction
+    """
+    __slots__ = ()
+
+    @property
+    def total_predictions(self):
+        return self.true_negatives + self.false_negatives + self.false_positives + self.true_positives
+
+    @property
+    def accuracy(self):
+        return 1.0*(self.true_positives + self.true_negatives)/self.total_predictions
+
+    @property
+    def precision(self):
+        return 1.0*self.true_positives/(self.true_positives+self.false_positives)
+
+    @property
+    def recall(self):
+        return 1.0*self.true_positives/(self.true_positives+self.false_negatives)
+
+    @property
+    def f1(self):
+        return 2.0 * self.true_positives/(2*self.true_positives + self.false_positives+self.false_negatives)
+
+    @property
+    def f2(self):
+        precision, recall = self.precision, self.recall
+        return (1+2.0*2.0) * precision*recall/(4*precision + recall)
+
+    def report(self, display_precision = 5):
+        """ returns the text test_classifier used to print """
+        try:
+            return "\n".join([
+                str(self.clf),
+                PERF_FORMAT_STRING.format(self.accuracy, self.precision, self.recall, self.f1, self.f2,
+                                          display_precision = display_precision),
+                RESULTS_FORMAT_STRING.format(self.total_predictions, self.true_positives,
+                                             self.false_positives, self.false_negatives,
+                                             self.true_negatives),
+                ""])
+        except ZeroDivisionError:
+            return "\n".join([
+                "Got a divide by zero when trying out: {}".format(self.clf),
+                "Precision or recall may be undefined due to a lack of true positive predicitons."])
+
+
+def confusion_counts(truth, predictions):
+    """ returns the [true negatives, false positives, false negatives, true
+        positives] of 0/1 labels and predictions, and the number of
+        predictions that were not counted
+
+        a label or prediction other than 0 or 1 ends the counting, as the
+        original per prediction loop did
+    """
+    truth = np.asarray(truth)
+    predictions = np.asarray(predictions)
+    valid = ((truth == 0) | (truth == 1)) & ((predictions == 0) | (predictions == 1))
+    stop = len(valid) if valid.all() else int(np.argmin(valid))
+    codes = 2 * truth[:stop].astype(np.intp) + predictions[:stop].astype(np.intp)
+    return np.bincount(codes, minlength = 4), len(valid) - stop
+
+
+def _count_folds(clf, features, labels, folds):
+    """ fits and tests clf on each fold in turn
+
+        :return: tuple of the summed confusion counts, the number of invalid
+            predictions and the number of folds
+    """
+    counts = np.zeros(4, dtype = np.int64)
+    invalid = 0
+    n_folds = 0
+    for train_idx, test_idx in folds:
+        ### fit the classifier using training set, and test on test set
+        clf.fit(features[train_idx], labels[train_idx])
+        fold_counts, fold_invalid = confusion_counts(labels[test_idx], clf.predict(features[test_idx]))
+        counts += fold_counts
+        invalid += fold_invalid
+        n_folds += 1
+    return counts, invalid, n_folds
+
+
+def _batches(folds, n_batches):
+    """ splits the folds into n_batches contiguous batches of nearly equal size """
+    bounds = np.linspace(0, len(folds), n_batches + 1).astype(int)
+    return [folds[start:end] for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def evaluate_folds(clf, features, labels, cv, n_jobs = 1, batches_per_job = 4):
+    """ fits and tests clf on every (train indices, test indices) fold of cv
+
+        features and labels are converted to arrays once, and every fold is
+        selected with fancy indexing instead of building lists row by row
+
+        with n_jobs other than 1 the folds are split in order into batches
+        that worker processes evaluate, each with its own clone of clf, and
+        the confusion counts of the batches are summed. Each fold is fit on
+        the same data by an estimator with the same parameters as in the
+        serial run, so the results are identical for estimators with a fixed
+        random_state. clf itself is left unfitted then.
+        :param n_jobs: number of worker processes, -1 for all cores
+        :param batches_per_job: batches per worker, more batches balance the
+            load better at the cost of more transfers
+        :return: EvaluationResult
+    """
+    features = np.asarray(features)
+    labels = np.asarray(labels)
+    n_jobs = joblib.effective_n_jobs(n_jobs)
+    if n_jobs == 1:
+        counts, invalid, folds = _count_folds(clf, features, labels, cv)
+    else:
+        folds = list(cv)
+        results = joblib.Parallel(n_jobs = n_jobs)(
+            joblib.delayed(_count_folds)(clone(clf), features, labels, batch)
+            for batch in _batches(folds, n_jobs * batches_per_job))
+        counts = sum(result[0] for result in results)
+        invalid = sum(result[1] for result in results)
+        folds = len(folds)
+    if invalid:
+        warnings.warn("Found {} predicted labels not == 0 or 1. All predictions should take value "
+                      "0 or 1. Evaluating performance for processed predictions.".format(invalid))
+    true_negatives, false_positives, false_negatives, true_positives = (int(c) for c in counts)
+    return EvaluationResult(clf, folds, true_positives, false_positives, false_negatives,
+                            true_negatives, invalid)
+
+
+def test_classifier(clf, dataset, feature_list, folds = 1000, n_jobs = 1):
+    """ evaluates clf with stratified shuffle split cross validation
+
+        the folds are read from the split cache, see splitcache.py
+
+        :param n_jobs: number of worker processes the folds are spread over,
+            -1 for all cores, see evaluate_folds
+        :return: EvaluationResult, print its report() for the classic output
+    """
     data = featureFormat(dataset, feature_list, sort_keys = True)
     labels, features = targetFeatureSplit(data)
-    cv = StratifiedShuffleSplit(labels, folds, random_state = 42)
-    true_negatives = 0
-    false_negatives = 0
-    true_positives = 0
-    false_positives = 0
-    for train_idx, test_idx in cv: 
-        features_train = []
-        features_test  = []
-        labels_train   = []
-        labels_test    = []
-        for ii in train_idx:
-            features_train.append( features[ii] )
-            labels_train.append( labels[ii] )
-        for jj in test_idx:
-            features_test.append( features[jj] )
-            labels_test.append( labels[jj] )
-        
-        ### fit the classifier using training set, and test on test set
-        clf.fit(features_train, labels_train)
-        predictions = clf.predict(features_test)
-        for prediction, truth in zip(predictions, labels_test):
-            if prediction == 0 and truth == 0:
-                true_negatives += 1
-            elif prediction == 0 and truth == 1:
-                false_negatives += 1
-            elif prediction == 1 and truth == 0:
-                false_positives += 1
-            elif prediction == 1 and truth == 1:
-                true_positives += 1
-            else:
-                print "Warning: Found a predicted label not == 0 or 1."
-                print "All predictions should take value 0 or 1."
-                print "Evaluating performance for processed predictions:"
-                break
-    try:
-        total_predictions = true_negatives + false_negatives + false_positives + true_positives
-        accuracy = 1.0*(true_positives + true_negatives)/total_predictions
-        precision = 1.0*true_positives/(true_positives+false_positives)
-        recall = 1.0*true_positives/(true_positives+false_negatives)
-        f1 = 2.0 * true_positives/(2*true_positives + false_positives+false_negatives)
-        f2 = (1+2.0*2.0) * precision*recall/(4*precision + recall)
-        print clf
-        print PERF_FORMAT_STRING.format(accuracy, precision, recall, f1, f2, display_precision = 5)
-        print RESULTS_FORMAT_STRING.format(total_predictions, true_positives, false_positives, false_negatives, true_negatives)
-        print ""
-    except:
-        print "Got a divide by zero when trying out:", clf
-        print "Precision or recall may be undefined due to a lack of true positive predicitons."
+    cv = CachedStratifiedShuffleSplit(n_splits = folds, random_state = 42).split(features, labels)
+    return evaluate_folds(clf, features, labels, cv, n_jobs = n_jobs)
 
 CLF_PICKLE_FILENAME = "my_classifier.pkl"
 DATASET_PICKLE_FILENAME = "my_dataset.pkl"
@@ -102,8 +206,9 @@ def load_classifier_and_data():
 def main():
     ### load up student's classifier, dataset, and feature_list
     clf, dataset, feature_list = load_classifier_and_data()
-    ### Run testing script
-    test_classifier(clf, dataset, feature_list)
+    ### Run testing script, optionally spreading the folds over n_jobs processes
+    n_jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    print(test_classifier(clf, dataset, feature_list, n_jobs = n_jobs).report())
 
 if __name__ == '__main__':
     main()